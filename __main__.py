@@ -1,12 +1,167 @@
 # !/usr/bin/env python
+import atexit
 import os
+import tempfile
 
+from bot.archive import MessageArchive
+from bot.delivery import DeliveryQueue, SharedChatLimits
+from bot.metrics import FunctionCounter, Metrics, MetricsServer
+from bot.outbox import Outbox
+from bot.scheduling import DIGEST, PriorityUpdateQueue
+from bot.sharding import ShardedSpyBot
 from bot.spybot import SpyBot
+from bot.store import CachingStore, InMemoryStore, SqliteStore
+from bot.tracing import SamplingProfiler, Tracer
+
+
+def make_memory_store():
+    """ Create an InMemoryStore configured with environment variables.
+
+    Return:
+        :obj:`bot.store.InMemoryStore`: the store
+    """
+    snapshot_path = os.getenv('SPYBOT_SNAPSHOT_PATH', '').strip()
+    if not snapshot_path:
+        return InMemoryStore()
+
+    store = InMemoryStore(
+        snapshot_path,
+        snapshot_interval=float(os.getenv(
+            'SPYBOT_SNAPSHOT_INTERVAL', InMemoryStore.SNAPSHOT_INTERVAL_SEC)),
+        delta_log=os.getenv('SPYBOT_DELTA_LOG', '').strip() == '1')
+    store.start()
+    # Take the final snapshot once the bot has stopped
+    atexit.register(store.stop)
+    return store
+
+
+def get_queue_size():
+    """ Return a size of update queues set by environment variables. """
+    return int(os.getenv('SPYBOT_QUEUE_SIZE', PriorityUpdateQueue.MAX_SIZE))
+
+
+def get_overload_policy():
+    """ Return an overload policy set by environment variables. """
+    return os.getenv('SPYBOT_OVERLOAD_POLICY', DIGEST).strip()
+
+
+def make_profiler(shard=None):
+    """ Create a sampling profiler if it is enabled by environment variables.
+
+    Arguments:
+        shard (:obj:`int`): (Optional) a shard number of a worker process
+
+    Return:
+        :obj:`bot.tracing.SamplingProfiler`: the profiler or ``None``
+    """
+    profile_path = os.getenv('SPYBOT_PROFILE_PATH', '').strip()
+    if not profile_path:
+        return None
+    if shard is not None:
+        profile_path += '.{}'.format(shard)
+    return SamplingProfiler(profile_path, interval=float(os.getenv(
+        'SPYBOT_PROFILE_INTERVAL', SamplingProfiler.INTERVAL_SEC)))
+
+
+def make_spybot(token, db_path, workers, shard=None):
+    """ Create a SpyBot configured with environment variables.
+
+    Arguments:
+        token (:obj:`str`): a bot token issued by BotFather
+        db_path (:obj:`str`): a path to an SQLite database or an empty string
+        workers (:obj:`int`): a number of worker processes
+        shard (:obj:`int`): (Optional) a shard number of a worker process
+
+    Return:
+        :obj:`bot.spybot.SpyBot`: the bot
+    """
+    metrics = Metrics()
+    if db_path:
+        store = SqliteStore(db_path)
+    else:
+        store = make_memory_store()
+    cache_ttl = float(os.getenv('SPYBOT_CACHE_TTL', CachingStore.TTL_SEC))
+    if db_path and cache_ttl > 0:
+        store = cached_store = CachingStore(store, ttl=cache_ttl)
+        metrics.add(FunctionCounter(
+            'spybot_store_cache_hits_total', 'Store reads served from cache',
+            lambda: cached_store.hits))
+        metrics.add(FunctionCounter(
+            'spybot_store_cache_misses_total', 'Store reads not cached',
+            lambda: cached_store.misses))
+    outbox_path = os.getenv('SPYBOT_OUTBOX_PATH', '').strip()
+    if outbox_path and shard is not None:
+        # An outbox file cannot be shared between processes
+        outbox_path += '.{}'.format(shard)
+    outbox = Outbox(outbox_path) if outbox_path else None
+    archive_path = os.getenv('SPYBOT_ARCHIVE_PATH', '').strip()
+    # Workers share the index, but write segments of their own
+    archive = MessageArchive(
+        archive_path, prefix='segment' if shard is None
+        else 'segment-{}'.format(shard)) if archive_path else None
+    trace_path = os.getenv('SPYBOT_TRACE_PATH', '').strip()
+    if trace_path and shard is not None:
+        trace_path += '.{}'.format(shard)
+    tracer = Tracer(trace_path, sample=float(os.getenv(
+        'SPYBOT_TRACE_SAMPLE', '1'))) if trace_path else None
+    # Workers share the overall limit of messages every bot can send
+    rate_limits = dict(global_rate=DeliveryQueue.GLOBAL_RATE / float(workers))
+    if shard is not None:
+        # Any worker may send to a report chat, so limits of chats are kept
+        # in the shared database
+        rate_limits['shared_limits'] = SharedChatLimits(db_path)
+    spybot = SpyBot(token, store=store, outbox=outbox, metrics=metrics,
+                    rate_limits=rate_limits, queue_size=get_queue_size(),
+                    overload_policy=get_overload_policy(),
+                    archive=archive,
+                    sender_tokens=[sender_token.strip() for sender_token in
+                                   os.getenv('SPYBOT_SENDER_TOKENS',
+                                             '').split(',')
+                                   if sender_token.strip()],
+                    tracer=tracer, profiler=make_profiler(shard))
+
+    metrics_port = os.getenv('SPYBOT_METRICS_PORT', '').strip()
+    if metrics_port:
+        # Every worker serves its own metrics on the next port
+        port = int(metrics_port) + (shard or 0)
+        MetricsServer(metrics, port,
+                      listen=os.getenv('SPYBOT_METRICS_LISTEN',
+                                       '127.0.0.1')).start()
+    return spybot
+
 
 if __name__ == '__main__':
     token = os.getenv('SPYBOT_TOKEN', '').strip()
     if len(token) > 0:
-        SpyBot(token).run()
+        db_path = os.getenv('SPYBOT_DB_PATH', '').strip()
+        workers = int(os.getenv('SPYBOT_WORKERS', '1'))
+        if workers > 1:
+            if not db_path:
+                # Workers need a store they can share, a temporary one
+                # keeps everything until the bot is stopped
+                db_path = os.path.join(tempfile.mkdtemp(), 'spybot.db')
+            # Create the schema before workers race to do it
+            SqliteStore(db_path).close()
+            SharedChatLimits(db_path).close()
+            spybot = ShardedSpyBot(
+                token, lambda shard: make_spybot(token, db_path, workers,
+                                                 shard), workers,
+                update_queue_size=get_queue_size(),
+                overload_policy=get_overload_policy())
+        else:
+            spybot = make_spybot(token, db_path, workers)
+
+        webhook_url = os.getenv('SPYBOT_WEBHOOK_URL', '').strip()
+        if webhook_url:
+            spybot.run_webhook(
+                webhook_url,
+                listen=os.getenv('SPYBOT_WEBHOOK_LISTEN', '0.0.0.0'),
+                port=int(os.getenv('SPYBOT_WEBHOOK_PORT', '8443')),
+                url_path=os.getenv('SPYBOT_WEBHOOK_PATH', ''),
+                cert=os.getenv('SPYBOT_WEBHOOK_CERT') or None,
+                key=os.getenv('SPYBOT_WEBHOOK_KEY') or None)
+        else:
+            spybot.run()
     else:
         error = """Environment variable 'SPYBOT_TOKEN' is missing or empty.
         Use 'export SPYBOT_TOKEN=<TELEGRAM BOT TOKEN>' (Unix)
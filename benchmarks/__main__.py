@@ -0,0 +1,296 @@
+""" Offline throughput benchmark of the SpyBot.
+
+Replays a synthetic or recorded stream of group messages through the bot
+handlers against a fake Telegram Bot API and reports end-to-end latency
+percentiles, from an update arriving to a message being sent, and sends
+per second.
+
+Usage: python -m benchmarks --help
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from queue import Queue
+
+from telegram import Update
+
+from benchmarks.fake_bot import FakeBot
+from bot.spybot import SpyBot
+from bot.store import InMemoryStore, SqliteStore
+from bot.tracing import Tracer
+
+# A marker of a sequence number appended to every replayed message
+_MARKER = re.compile(r'#(\d+)#')
+
+# Limits that do not get in the way of measuring the bot itself
+_UNTHROTTLED = dict(global_rate=1e6,
+                    private_chat_rate=1e6,
+                    group_chat_rate=1e6)
+
+
+def percentile(values, fraction):
+    """ Return a percentile of sorted values.
+
+    Arguments:
+        values (:obj:`list`): sorted values
+        fraction (:obj:`float`): a fraction in [0, 1]
+
+    Return:
+        :obj:`float`: a percentile or ``0`` for no values
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Benchmark(object):
+    """ A single run of the benchmark. """
+
+    _MASTER_ID_BASE = 1000
+
+    def __init__(self, args):
+        self._args = args
+        self._lock = threading.Lock()
+        self._ingested = dict()
+        self._latencies = []
+        self._last_send = 0
+        self._updates = Queue()
+        self._update_ids = itertools.count(1)
+
+        self._bot = FakeBot(latency=args.latency, jitter=args.jitter,
+                            retry_after=args.retry_after,
+                            migrate=args.migrate,
+                            unauthorized=args.unauthorized,
+                            on_send=self._on_send, seed=args.seed)
+        # Bots sending forwarded messages besides the one receiving updates
+        self._senders = [FakeBot(latency=args.latency, jitter=args.jitter,
+                                 retry_after=args.retry_after,
+                                 on_send=self._on_send,
+                                 seed=None if args.seed is None
+                                 else args.seed + i + 1)
+                         for i in range(args.senders)]
+        for sender in self._senders[:args.revoked]:
+            sender.revoked = True
+
+        if args.store == 'sqlite':
+            self._db_path = tempfile.mktemp(suffix='.db')
+            store = SqliteStore(self._db_path)
+        else:
+            self._db_path = None
+            store = InMemoryStore()
+
+        self._spybot = SpyBot(
+            store=store, bot=self._bot,
+            digest_window=args.digest_window,
+            rate_limits=None if args.throttled else _UNTHROTTLED,
+            sender_bots=self._senders or None,
+            tracer=Tracer(args.trace) if args.trace else None)
+
+    def run(self):
+        messages = self._load_messages()
+        chat_ids = sorted(set(message['chat']['id'] for message in messages))
+        self._subscribe(chat_ids)
+
+        self._spybot.start()
+        dispatcher = threading.Thread(target=self._dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+        started = time.time()
+        self._replay(messages)
+        ingested = time.time()
+        self._drain()
+
+        self._updates.put(None)
+        dispatcher.join()
+        self._spybot.stop()
+        if self._db_path:
+            os.remove(self._db_path)
+
+        self._report(len(messages), ingested - started,
+                     self._last_send - started)
+
+    def _load_messages(self):
+        """ Return a list of message dicts marked with sequence numbers. """
+        args = self._args
+        if args.updates:
+            with open(args.updates) as updates:
+                messages = [json.loads(line).get('message')
+                            for line in updates if line.strip()]
+            messages = [message for message in messages
+                        if message and message.get('text') and
+                        message['chat']['type'] in ('group', 'supergroup')]
+        else:
+            messages = [{
+                'message_id': i,
+                'date': int(time.time()),
+                'chat': {'id': -(i % args.groups) - 1,
+                         'type': 'group',
+                         'title': 'Group {}'.format(i % args.groups)},
+                'from': {'id': i % 97 + 1,
+                         'first_name': 'User',
+                         'last_name': str(i % 97),
+                         'is_bot': False},
+                'text': 'Synthetic message number {} with some words in it'
+                        .format(i)
+            } for i in range(args.messages)]
+
+        for seq, message in enumerate(messages):
+            message['text'] = u'{} #{}#'.format(message['text'], seq)
+        return messages
+
+    def _subscribe(self, chat_ids):
+        """ Register Masters and subscribe them to chats with commands. """
+        bots = [self._bot] + self._senders
+        for bot in bots:
+            bot.failing = False
+        for i in range(self._args.subscribers):
+            master_id = Benchmark._MASTER_ID_BASE + i
+            private_chat = {'id': master_id, 'type': 'private'}
+            self._process(private_chat, master_id, '/start')
+            if self._args.digest:
+                self._process(private_chat, master_id, '/digest')
+            for chat_id in chat_ids:
+                self._process({'id': chat_id, 'type': 'group',
+                               'title': 'Group'}, master_id, '/spy')
+
+        # Do not count replies to commands
+        for bot in bots:
+            bot.sent = 0
+            bot.failing = True
+
+    def _process(self, chat, user_id, text):
+        update_id = next(self._update_ids)
+        self._spybot.process_update(Update.de_json({
+            'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': int(time.time()),
+                        'chat': chat,
+                        'from': {'id': user_id, 'first_name': 'Master',
+                                 'is_bot': False},
+                        'text': text}
+        }, self._bot))
+
+    def _replay(self, messages):
+        interval = 1.0 / self._args.rate if self._args.rate else 0
+        started = time.time()
+        for seq, message in enumerate(messages):
+            if interval:
+                delay = started + seq * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            update = Update.de_json({'update_id': next(self._update_ids),
+                                     'message': message}, self._bot)
+            with self._lock:
+                self._ingested[seq] = time.time()
+            self._updates.put(update)
+
+    def _dispatch(self):
+        while True:
+            # Updates that have arrived meanwhile are processed as a batch
+            batch = [self._updates.get()]
+            while batch[-1] is not None and not self._updates.empty():
+                batch.append(self._updates.get())
+
+            self._spybot.process_updates([update for update in batch
+                                          if update is not None])
+            if batch[-1] is None:
+                return
+
+    def _drain(self):
+        """ Wait until the bot stops sending messages. """
+        while not self._updates.empty():
+            time.sleep(0.1)
+        drained = time.time()
+        while time.time() - max(self._last_send, drained) < self._args.idle:
+            time.sleep(0.1)
+
+    def _on_send(self, chat_id, text):
+        now = time.time()
+        with self._lock:
+            self._last_send = now
+            for seq in _MARKER.findall(text):
+                self._latencies.append(now - self._ingested[int(seq)])
+
+    def _report(self, messages, ingest_time, total_time):
+        latencies = sorted(self._latencies)
+        total_time = max(total_time, 1e-9)
+        bots = [self._bot] + self._senders
+        sent = sum(bot.sent for bot in bots)
+        errors = dict((name, sum(bot.errors[name] for bot in bots))
+                      for name in self._bot.errors)
+
+        print('Messages:   {} in {:.2f}s ({:.1f} msg/s ingested)'.format(
+            messages, ingest_time, messages / max(ingest_time, 1e-9)))
+        print('Sends:      {} in {:.2f}s ({:.1f} sends/s)'.format(
+            sent, total_time, sent / total_time))
+        print('Errors:     {}'.format(', '.join(
+            '{}={}'.format(name, count)
+            for name, count in sorted(errors.items()))))
+        print('Latency ms: p50={:.1f} p90={:.1f} p99={:.1f} max={:.1f}'
+              .format(*[percentile(latencies, fraction) * 1000
+                        for fraction in (0.5, 0.9, 0.99, 1)]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark the SpyBot against a fake Telegram Bot API.')
+    parser.add_argument('--groups', type=int, default=10,
+                        help='a number of spied groups')
+    parser.add_argument('--subscribers', type=int, default=5,
+                        help='a number of Masters subscribed to every group')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='a number of synthetic messages to replay')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second to replay, 0 for no limit')
+    parser.add_argument('--updates',
+                        help='a file of recorded updates, one JSON per line, '
+                             'to replay instead of synthetic messages')
+    parser.add_argument('--store', choices=('memory', 'sqlite'),
+                        default='memory', help='a store to use')
+    parser.add_argument('--digest', action='store_true',
+                        help='make Masters receive digests')
+    parser.add_argument('--digest-window', type=float, default=1,
+                        help='seconds to collect digests for')
+    parser.add_argument('--throttled', action='store_true',
+                        help='apply Telegram message limits')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='a mean round trip of a request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02,
+                        help='a maximum deviation of the round trip')
+    parser.add_argument('--retry-after', type=float, default=0,
+                        help='a probability of a 429 response')
+    parser.add_argument('--migrate', type=float, default=0,
+                        help='a probability of a group migration')
+    parser.add_argument('--unauthorized', type=float, default=0,
+                        help='a probability of being blocked in a chat')
+    parser.add_argument('--senders', type=int, default=0,
+                        help='a number of bots sending forwarded messages, '
+                             '0 to send with the bot receiving updates')
+    parser.add_argument('--revoked', type=int, default=0,
+                        help='a number of senders with revoked tokens')
+    parser.add_argument('--trace',
+                        help='a file to record spans of handled updates to')
+    parser.add_argument('--idle', type=float, default=2,
+                        help='seconds without sends that end the run')
+    parser.add_argument('--seed', type=int, help='a random seed')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show bot logs')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.verbose:
+        # Simulated errors are logged with stack traces
+        logging.disable(logging.CRITICAL)
+    Benchmark(args).run()
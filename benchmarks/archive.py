@@ -0,0 +1,95 @@
+""" Benchmark of the message archive.
+
+Archives synthetic messages of many chats and reports how fast they are
+indexed and percentiles of latency of searches limited to a few chats, like
+the ones a Master subscribes to.
+
+Usage: python -m benchmarks.archive --help
+"""
+import argparse
+import bisect
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.__main__ import percentile
+from bot.archive import MessageArchive
+
+
+def make_vocabulary(size, rand):
+    """ Make random words. Words are used with Zipf-like frequencies, so
+    some of them are very common, like in real chats.
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rand.choice(letters)
+                    for _ in range(rand.randint(3, 10)))
+            for _ in range(size)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.archive',
+        description='Benchmark the message archive')
+    parser.add_argument('--messages', type=int, default=1000000,
+                        help='a number of messages to archive')
+    parser.add_argument('--chats', type=int, default=1000,
+                        help='a number of chats')
+    parser.add_argument('--words', type=int, default=20000,
+                        help='a number of distinct words')
+    parser.add_argument('--subscriptions', type=int, default=20,
+                        help='a number of chats every search is limited to')
+    parser.add_argument('--searches', type=int, default=200,
+                        help='a number of searches')
+    parser.add_argument('--seed', type=int, help='a random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rand = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.words, rand)
+    weights = [1.0 / rank for rank in range(1, len(vocabulary) + 1)]
+    total = sum(weights)
+    cumulative = []
+    for weight in weights:
+        cumulative.append((cumulative[-1] if cumulative else 0) +
+                          weight / total)
+
+    def word():
+        return vocabulary[min(len(vocabulary) - 1,
+                              bisect.bisect(cumulative, rand.random()))]
+
+    directory = tempfile.mkdtemp()
+    try:
+        archive = MessageArchive(directory)
+        started = time.time()
+        for i in range(args.messages):
+            chat_id = -1000 - rand.randint(1, args.chats)
+            archive.add(chat_id, 'Chat {}'.format(chat_id), i % 5000,
+                        'User', 1500000000 + i,
+                        ' '.join(word() for _ in range(rand.randint(3, 20))))
+            if i % 10000 == 9999:
+                archive.flush()
+        archive.flush()
+        print('Indexed {} messages in {:.1f} s'.format(
+            args.messages, time.time() - started))
+
+        latencies = []
+        hits = 0
+        for _ in range(args.searches):
+            chat_ids = [-1000 - rand.randint(1, args.chats)
+                        for _ in range(args.subscriptions)]
+            terms = [word() for _ in range(rand.randint(1, 2))]
+            started = time.time()
+            hits += len(archive.search(terms, chat_ids))
+            latencies.append(time.time() - started)
+        archive.stop()
+
+        latencies.sort()
+        print('Searches:   {} with {} hits'.format(len(latencies), hits))
+        print('Latency ms: p50={:.1f} p90={:.1f} p99={:.1f} max={:.1f}'
+              .format(*(1000 * percentile(latencies, fraction)
+                        for fraction in (0.5, 0.9, 0.99, 1))))
+    finally:
+        shutil.rmtree(directory)
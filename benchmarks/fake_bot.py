@@ -0,0 +1,126 @@
+import itertools
+import random
+import threading
+import time
+
+from telegram.error import ChatMigrated, RetryAfter, Unauthorized
+
+
+class _FakeRequest(object):
+    """ A stand-in for ``telegram.utils.request.Request``. """
+
+    def __init__(self, con_pool_size):
+        self.con_pool_size = con_pool_size
+
+
+class FakeBot(object):
+    """ An in-process stand-in for ``telegram.Bot`` that never touches the
+    network.
+
+    Sending a message takes a simulated round trip and may fail the way
+    Telegram does: with a flood control error, a migration of a group to
+    a supergroup, or with the bot being blocked in a chat. Migrated and
+    blocked chats stay so for the rest of the run. A revoked bot fails every
+    request.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, retry_after=0.0,
+                 migrate=0.0, unauthorized=0.0, on_send=None, seed=None):
+        """ Create a new FakeBot.
+
+        Arguments:
+            latency (:obj:`float`): a mean round trip of a request in seconds
+            jitter (:obj:`float`): a maximum deviation from the mean latency
+            retry_after (:obj:`float`): a probability of a 429 response
+            migrate (:obj:`float`): a probability of a group migration
+            unauthorized (:obj:`float`): a probability of the bot being
+                blocked in a chat
+            on_send (:obj:`callable`): (Optional) a function that receives
+                a chat ID and a text of every sent message
+            seed (:obj:`int`): (Optional) a seed of the random generator
+        """
+        self.id = 1
+        self.first_name = 'SpyBot'
+        self.last_name = None
+        self.username = 'spybot'
+        self.request = _FakeRequest(con_pool_size=128)
+
+        self._latency = latency
+        self._jitter = jitter
+        self._retry_after = retry_after
+        self._migrate = migrate
+        self._unauthorized = unauthorized
+        self._on_send = on_send
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._new_chat_ids = itertools.count(-1000000000000, -1)
+        # A map of IDs of migrated chats to their new IDs
+        self._migrated = dict()
+        # IDs of chats the bot was blocked in
+        self._blocked = set()
+
+        # Whether errors are simulated
+        self.failing = True
+        # Whether the token of the bot has been revoked
+        self.revoked = False
+        # A URL of the webhook set for the bot
+        self.webhook_url = None
+        self.sent = 0
+        self.errors = dict(retry_after=0, migrated=0, unauthorized=0,
+                           revoked=0)
+
+    @property
+    def name(self):
+        return '@' + self.username
+
+    def get_me(self, *args, **kwargs):
+        self._round_trip()
+        if self.revoked:
+            raise Unauthorized('Unauthorized')
+        return self
+
+    def set_webhook(self, url=None, **kwargs):
+        self._round_trip()
+        self.webhook_url = url
+        return True
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._round_trip()
+
+        with self._lock:
+            if self.revoked:
+                self.errors['revoked'] += 1
+                raise Unauthorized('Unauthorized')
+
+            roll = self._random.random() if self.failing else 1
+            if chat_id in self._blocked or roll < self._unauthorized:
+                self._blocked.add(chat_id)
+                self.errors['unauthorized'] += 1
+                raise Unauthorized('Forbidden: bot was blocked by the user')
+
+            roll -= self._unauthorized
+            if chat_id < 0 and (chat_id in self._migrated or
+                                roll < self._migrate):
+                new_chat_id = self._migrated.get(chat_id)
+                if new_chat_id is None:
+                    new_chat_id = self._migrated[chat_id] = \
+                        next(self._new_chat_ids)
+                self.errors['migrated'] += 1
+                raise ChatMigrated(new_chat_id)
+
+            roll -= self._migrate
+            if roll < self._retry_after:
+                self.errors['retry_after'] += 1
+                raise RetryAfter(1)
+
+            self.sent += 1
+
+        if self._on_send:
+            self._on_send(chat_id, text)
+
+    def _round_trip(self):
+        delay = self._latency + self._random.uniform(-self._jitter,
+                                                     self._jitter)
+        if delay > 0:
+            time.sleep(delay)
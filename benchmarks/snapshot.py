@@ -0,0 +1,82 @@
+""" Benchmark of snapshots of the in-memory store.
+
+Fills the store with synthetic Masters and subscriptions, then reports how
+long it takes to write a snapshot and to restore the store from it.
+
+Usage: python -m benchmarks.snapshot --help
+"""
+import argparse
+import gc
+import os
+import random
+import shutil
+import tempfile
+import time
+from array import array
+
+from bot.snapshot import INT64, Snapshot
+from bot.store import InMemoryStore, MasterSettings
+
+
+def fill(store, masters, chats, subscriptions, seed=None):
+    """ Subscribe random Masters to random chats.
+
+    Arguments:
+        store (:obj:`bot.store.InMemoryStore`): a store to fill
+        masters (:obj:`int`): a number of Masters
+        chats (:obj:`int`): a number of chats
+        subscriptions (:obj:`int`): a number of subscriptions to try,
+            duplicates are dropped
+        seed (:obj:`int`): (Optional) a random seed
+    """
+    rand = random.Random(seed)
+    store.save_or_update_masters(
+        MasterSettings(master_id, -master_id, master_id % 2 == 0)
+        for master_id in range(1, masters + 1))
+    store.subscribe_many(
+        (rand.randint(1, masters), -1000000 - rand.randint(1, chats))
+        for _ in range(subscriptions))
+
+
+def count_subscriptions():
+    return sum(len(chat) for chat in InMemoryStore._CHATS.values())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.snapshot',
+        description='Benchmark snapshots of the in-memory store')
+    parser.add_argument('--masters', type=int, default=10000,
+                        help='a number of Masters')
+    parser.add_argument('--chats', type=int, default=100000,
+                        help='a number of chats')
+    parser.add_argument('--subscriptions', type=int, default=1000000,
+                        help='a number of subscriptions')
+    parser.add_argument('--seed', type=int, help='a random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'spybot.snapshot')
+        store = InMemoryStore(snapshot_path=path)
+        fill(store, args.masters, args.chats, args.subscriptions, args.seed)
+        subscriptions = count_subscriptions()
+
+        started = time.time()
+        store.snapshot()
+        print('Wrote {} subscriptions ({:.1f} MB) in {:.3f} s'.format(
+            subscriptions, os.path.getsize(path) / 1e6,
+            time.time() - started))
+
+        # A new process starts with an empty store and no garbage
+        store.load(Snapshot(0, array(INT64), dict(), dict()))
+        gc.collect()
+        started = time.time()
+        InMemoryStore(snapshot_path=path)
+        print('Restored {} subscriptions in {:.3f} s'.format(
+            count_subscriptions(), time.time() - started))
+    finally:
+        shutil.rmtree(directory)
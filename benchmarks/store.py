@@ -0,0 +1,132 @@
+""" Microbenchmark of the in-memory store.
+
+Fills the store with synthetic Masters and subscriptions, then times
+removing Masters, reading subscribers and changing subscriptions, next to
+a store that keeps subscribers of chats only and scans all chats to remove
+a Master, the way the in-memory store used to.
+
+Usage: python -m benchmarks.store --help
+"""
+import argparse
+import random
+import time
+
+from benchmarks.snapshot import fill
+from bot.store import InMemoryStore
+
+
+class ScanningStore(object):
+    """ The in-memory store without a reverse index: Masters are removed by
+    scanning every chat, and subscribers are copied on every read.
+    """
+
+    def __init__(self, masters, chats):
+        """ Copy data of the in-memory store.
+
+        Arguments:
+            masters (:obj:`dict`): a map of Master IDs to Master Settings
+            chats (:obj:`dict`): a map of chat IDs to IDs of subscribed
+                Masters
+        """
+        self._masters = dict(masters)
+        self._chats = dict((chat_id, set(self._masters[master_id]
+                                         for master_id in master_ids))
+                           for chat_id, master_ids in chats.items())
+
+    def remove_master(self, master_id):
+        master_settings = self._masters.pop(master_id)
+        # Chats are listed first, as a chat cannot be deleted while the map
+        # is being iterated
+        for chat_id, subscribers in list(self._chats.items()):
+            if master_settings in subscribers:
+                subscribers -= {master_settings}
+                if not subscribers:
+                    del self._chats[chat_id]
+
+    def subscribe(self, master_id, chat_id):
+        master_settings = self._masters[master_id]
+        if chat_id in self._chats:
+            self._chats[chat_id] |= {master_settings}
+        else:
+            self._chats[chat_id] = {master_settings}
+
+    def unsubscribe(self, chat_id, master_id):
+        self._chats[chat_id] -= {self._masters[master_id]}
+
+    def get_subscribers(self, chat_id):
+        if chat_id in self._chats:
+            return list(self._chats[chat_id])
+        return list()
+
+
+def measure(operation, calls):
+    """ Call an operation and return microseconds per call.
+
+    Arguments:
+        operation (:obj:`callable`): a function to call
+        calls (:obj:`list`): tuples of arguments of every call
+
+    Return:
+        :obj:`float`: microseconds per call
+    """
+    started = time.time()
+    for call in calls:
+        operation(*call)
+    return (time.time() - started) * 1e6 / len(calls)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.store',
+        description='Benchmark operations of the in-memory store')
+    parser.add_argument('--masters', type=int, default=10000,
+                        help='a number of Masters')
+    parser.add_argument('--chats', type=int, default=100000,
+                        help='a number of chats')
+    parser.add_argument('--subscriptions', type=int, default=300000,
+                        help='a number of subscriptions')
+    parser.add_argument('--removals', type=int, default=100,
+                        help='a number of Masters to remove')
+    parser.add_argument('--reads', type=int, default=200000,
+                        help='a number of reads of subscribers')
+    parser.add_argument('--seed', type=int, help='a random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rand = random.Random(args.seed)
+    store = InMemoryStore()
+    fill(store, args.masters, args.chats, args.subscriptions, args.seed)
+    scanning = ScanningStore(InMemoryStore._MASTERS, InMemoryStore._CHATS)
+
+    chat_ids = list(InMemoryStore._CHATS)
+    reads = [(rand.choice(chat_ids),) for _ in range(args.reads)]
+    changes = [(rand.choice(chat_ids), rand.randint(1, args.masters))
+               for _ in range(args.reads // 10)]
+    removals = [(master_id,) for master_id in
+                rand.sample(range(1, args.masters + 1), args.removals)]
+
+    print('{} chats, {} subscriptions'.format(
+        len(chat_ids), sum(len(chat) for chat in
+                           InMemoryStore._CHATS.values())))
+    print('{:<24} {:>12} {:>12} {:>8}'.format(
+        'us per call', 'scanning', 'indexed', 'gain'))
+    results = [
+        # Subscribers are cached by the first read of a chat
+        ('get_subscribers, cold', measure(scanning.get_subscribers, reads),
+         measure(store.get_subscribers, reads)),
+        ('get_subscribers, cached', measure(scanning.get_subscribers, reads),
+         measure(store.get_subscribers, reads)),
+        ('subscribe', measure(lambda chat_id, master_id: scanning.subscribe(
+            master_id, chat_id), changes),
+         measure(lambda chat_id, master_id: store.subscribe(
+             master_id, chat_id), changes)),
+        ('unsubscribe', measure(scanning.unsubscribe, changes),
+         measure(store.unsubscribe, changes)),
+        ('remove_master', measure(scanning.remove_master, removals),
+         measure(store.remove_master, removals)),
+    ]
+    for name, before, after in results:
+        print('{:<24} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            name, before, after, before / after))
@@ -1,4 +1,6 @@
+from sharding import ShardedSpyBot
 from spybot import SpyBot
-from store import AbstractStore, InMemoryStore
+from store import AbstractStore, CachingStore, InMemoryStore, SqliteStore
 
-__all__ = ['SpyBot', 'AbstractStore', 'InMemoryStore']
+__all__ = ['SpyBot', 'ShardedSpyBot', 'AbstractStore', 'CachingStore',
+           'InMemoryStore', 'SqliteStore']
@@ -0,0 +1,440 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+# Words of a search query, anything else is ignored
+_WORD = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def _chat_prefix(chat_id):
+    # Words are indexed with a prefix of their chat, which cannot contain
+    # a minus, and ends with a letter so that it does not run into the word
+    return u'c{}x'.format(chat_id).replace(u'-', u'n')
+
+
+def index_text(chat_id, text):
+    """ Return words of a message as they are indexed.
+
+    Arguments:
+        chat_id (:obj:`int`): an id of a chat the message was sent to
+        text (:obj:`str`): a message text
+
+    Return:
+        :obj:`str`: words of the text prefixed by the chat
+    """
+    prefix = _chat_prefix(chat_id)
+    return u' '.join(prefix + word for word in _WORD.findall(text))
+
+
+def title_key(title):
+    """ Return a title of a chat as it is looked up, in any case.
+
+    SQLite lowers the case of ASCII letters only, so titles are lowered
+    by Python before they are stored and looked up.
+
+    Arguments:
+        title (:obj:`str`): a title of a chat, or ``None``
+
+    Return:
+        :obj:`str`: the title in lower case, or ``None``
+    """
+    return title.lower() if title else None
+
+
+def build_query(terms, chat_ids):
+    """ Build a full-text query for messages of chats with all terms.
+
+    Arguments:
+        terms (:obj:`list`): search terms
+        chat_ids (:obj:`list`): IDs of chats to search in
+
+    Return:
+        :obj:`str`: an FTS5 query, or ``None`` if there is nothing to search
+    """
+    words = [word for term in terms for word in _WORD.findall(term)]
+    if not words or not chat_ids:
+        return None
+    return u' OR '.join(
+        u'({})'.format(u' AND '.join(u'"{}{}"'.format(_chat_prefix(chat_id),
+                                                      word)
+                                     for word in words))
+        for chat_id in chat_ids)
+
+
+class ArchivedMessage(object):
+    """ A message found in the archive. """
+
+    def __init__(self, chat_id, chat_title, user_id, user_name, date, text):
+        """ Create a new ArchivedMessage.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a chat the message was sent to
+            chat_title (:obj:`str`): a title of the chat
+            user_id (:obj:`int`): an id of an author of the message
+            user_name (:obj:`str`): a full name of the author
+            date (:obj:`int`): a time the message was sent at in seconds
+                since the epoch
+            text (:obj:`str`): a message text
+        """
+        self.chat_id = chat_id
+        self.chat_title = chat_title
+        self.user_id = user_id
+        self.user_name = user_name
+        self.date = date
+        self.text = text
+
+    def to_json(self):
+        return json.dumps({'chat_id': self.chat_id,
+                           'chat_title': self.chat_title,
+                           'user_id': self.user_id,
+                           'user_name': self.user_name,
+                           'date': self.date,
+                           'text': self.text})
+
+    @staticmethod
+    def de_json(data):
+        entry = json.loads(data.decode('utf-8'))
+        return ArchivedMessage(entry['chat_id'], entry['chat_title'],
+                               entry['user_id'], entry['user_name'],
+                               entry['date'], entry['text'])
+
+
+class MessageArchive(object):
+    """ A searchable archive of spied messages.
+
+    Messages are appended to segment files as JSON lines, and indexed in
+    an SQLite FTS5 table that keeps only the index and locations of messages
+    in segments, not their texts. Messages are added to a buffer, which is
+    written and indexed in background in a single transaction per batch, so
+    forwarding never waits for the disk.
+
+    Words are indexed together with the chats they were sent to, so a
+    search only walks the index of the chats it is limited to, however
+    common its words are in other chats. Several processes can share an
+    archive directory as long as every one of them writes its own segments,
+    named by a prefix.
+    """
+
+    # Seconds between writes of buffered messages
+    FLUSH_INTERVAL_SEC = 1.0
+    # A size of a segment file that makes the archive start a new one
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # A maximum number of messages returned by a search
+    MAX_RESULTS = 10
+    # A number of the most recent matches of a search ranked by relevance
+    MAX_RANKED = 500
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY,
+            segment TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            title_key TEXT
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_index
+            USING fts5(text, content='');
+    """
+
+    _ADD_MESSAGE = """
+        INSERT INTO messages (segment, position, length) VALUES (?, ?, ?)
+    """
+    _INDEX_MESSAGE = """
+        INSERT INTO message_index (rowid, text) VALUES (?, ?)
+    """
+    _SAVE_CHAT = """
+        INSERT OR REPLACE INTO chats (chat_id, title, title_key)
+        VALUES (?, ?, ?)
+    """
+    _SET_TITLE_KEY = """
+        UPDATE chats SET title_key = ? WHERE chat_id = ?
+    """
+    _INDEXED_END = """
+        SELECT MAX(position + length) FROM messages WHERE segment = ?
+    """
+    # Only the most recent matches are ranked, ranking every message with
+    # a common word would take the whole index
+    _SEARCH = """
+        SELECT m.segment, m.position, m.length
+        FROM (SELECT rowid, bm25(message_index) AS score
+              FROM message_index WHERE message_index MATCH ?
+              ORDER BY rowid DESC LIMIT ?) i
+        JOIN messages m ON m.message_id = i.rowid
+        ORDER BY i.score LIMIT ?
+    """
+    _FIND_CHATS = """
+        SELECT chat_id FROM chats WHERE title_key = ?
+    """
+
+    def __init__(self, path, prefix='segment',
+                 flush_interval=FLUSH_INTERVAL_SEC,
+                 segment_size=SEGMENT_SIZE):
+        """ Open or create an archive.
+
+        Arguments:
+            path (:obj:`str`): a path to the archive directory
+            prefix (:obj:`str`): a prefix of names of segment files written
+                by this archive
+            flush_interval (:obj:`float`): seconds between writes of
+                buffered messages
+            segment_size (:obj:`int`): a size of a segment file that makes
+                the archive start a new one
+        """
+        self._log = logging.getLogger(MessageArchive.__name__)
+        self._path = path
+        self._prefix = prefix
+        self._flush_interval = flush_interval
+        self._segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Messages are indexed in background and searched by handlers, with
+        # connections of their own, so searches do not wait for indexing
+        index_path = os.path.join(path, 'index.db')
+        self._writer = sqlite3.connect(index_path, check_same_thread=False,
+                                       isolation_level=None)
+        self._writer.execute('PRAGMA journal_mode = WAL')
+        self._writer.execute('PRAGMA synchronous = NORMAL')
+        self._writer.executescript(MessageArchive._SCHEMA)
+        self._migrate()
+        self._reader = sqlite3.connect(index_path, check_same_thread=False)
+        self._read_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        # Messages not written yet
+        self._buffer = []
+        # Serializes writes of batches
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        numbers = self._list_segments()
+        self._recover(numbers)
+        self._number = numbers[-1] if numbers else 1
+        self._file = self._open_segment()
+
+    def add(self, chat_id, chat_title, user_id, user_name, date, text):
+        """ Archive a message. Never blocks on the disk.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a chat the message was sent to
+            chat_title (:obj:`str`): a title of the chat
+            user_id (:obj:`int`): an id of an author of the message
+            user_name (:obj:`str`): a full name of the author
+            date (:obj:`int`): a time the message was sent at in seconds
+                since the epoch
+            text (:obj:`str`): a message text
+        """
+        message = ArchivedMessage(chat_id, chat_title, user_id, user_name,
+                                  date, text)
+        with self._lock:
+            self._buffer.append(message)
+
+    def search(self, terms, chat_ids, limit=MAX_RESULTS):
+        """ Find messages with all terms, the most relevant first. Only the
+        most recent ``MAX_RANKED`` matches are ranked.
+
+        Arguments:
+            terms (:obj:`list`): search terms
+            chat_ids (:obj:`list`): IDs of chats to search in
+            limit (:obj:`int`): a maximum number of messages to return
+
+        Return:
+            :obj:`list`: a list of ``ArchivedMessage``
+        """
+        query = build_query(terms, chat_ids)
+        if query is None:
+            return []
+
+        with self._read_lock:
+            locations = self._reader.execute(
+                MessageArchive._SEARCH,
+                (query, MessageArchive.MAX_RANKED, limit)).fetchall()
+
+        # Read messages segment by segment
+        messages = dict()
+        for segment in set(location[0] for location in locations):
+            with open(self._segment_path(segment), 'rb') as data:
+                for location in locations:
+                    if location[0] == segment:
+                        data.seek(location[1])
+                        messages[location] = ArchivedMessage.de_json(
+                            data.read(location[2]))
+        return [messages[location] for location in locations]
+
+    def find_chats(self, title):
+        """ Return IDs of archived chats with a title.
+
+        Arguments:
+            title (:obj:`str`): a title of a chat, in any case
+
+        Return:
+            :obj:`list`: a list of chat IDs
+        """
+        with self._read_lock:
+            return [row[0] for row in self._reader.execute(
+                MessageArchive._FIND_CHATS, (title_key(title),))]
+
+    def start(self):
+        """ Start writing messages to the archive in background. """
+        self._thread = threading.Thread(target=self._run, name='archive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Write remaining messages and close the archive. """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._file.close()
+        self._writer.close()
+        with self._read_lock:
+            self._reader.close()
+
+    def flush(self):
+        """ Write and index buffered messages. """
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+        if not buffer:
+            return
+
+        with self._write_lock:
+            entries = []
+            for message in buffer:
+                if self._file.tell() >= self._segment_size:
+                    self._rotate()
+                line = (message.to_json() + '\n').encode('utf-8')
+                entries.append((message, self._segment_name(self._number),
+                                self._file.tell(), len(line)))
+                self._file.write(line)
+            self._file.flush()
+            self._index(entries)
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self._log.exception("Failed to write the archive %s",
+                                    self._path)
+
+    def _index(self, entries):
+        """ Index written messages in a single transaction.
+
+        Arguments:
+            entries (:obj:`list`): tuples of an ``ArchivedMessage``,
+                a segment name, a position and a length of the message in
+                the segment
+        """
+        db = self._writer
+        # Take the write lock at once, other processes may share the index
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            titles = dict()
+            for message, segment, position, length in entries:
+                message_id = db.execute(MessageArchive._ADD_MESSAGE,
+                                        (segment, position, length)).lastrowid
+                db.execute(MessageArchive._INDEX_MESSAGE,
+                           (message_id,
+                            index_text(message.chat_id, message.text)))
+                titles[message.chat_id] = message.chat_title
+            db.executemany(MessageArchive._SAVE_CHAT,
+                           [(chat_id, title, title_key(title))
+                            for chat_id, title in titles.items()])
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _migrate(self):
+        """ Upgrade archives created by earlier versions. """
+        db = self._writer
+        # Other processes sharing the index may be upgrading it too
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            columns = [row[1] for row in
+                       db.execute('PRAGMA table_info(chats)')]
+            if 'title_key' not in columns:
+                db.execute('ALTER TABLE chats ADD COLUMN title_key TEXT')
+                db.executemany(MessageArchive._SET_TITLE_KEY,
+                               [(title_key(title), chat_id) for chat_id, title
+                                in db.execute('SELECT chat_id, title '
+                                              'FROM chats').fetchall()])
+            db.execute('CREATE INDEX IF NOT EXISTS chats_title_key '
+                       'ON chats (title_key)')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _rotate(self):
+        """ Start writing a new segment. """
+        self._file.close()
+        self._number += 1
+        self._file = self._open_segment()
+
+    def _open_segment(self):
+        segment = open(self._segment_path(self._segment_name(self._number)),
+                       'ab')
+        # Positions of messages are taken from the end of the file
+        segment.seek(0, os.SEEK_END)
+        return segment
+
+    def _recover(self, numbers):
+        """ Index messages that were written but not indexed when the
+        process died, and cut off a message torn in the middle of a write.
+
+        Arguments:
+            numbers (:obj:`list`): numbers of segments of this archive
+        """
+        # Only the last segments may be behind the index
+        for number in reversed(numbers):
+            segment = self._segment_name(number)
+            path = self._segment_path(segment)
+            indexed = self._writer.execute(MessageArchive._INDEXED_END,
+                                           (segment,)).fetchone()[0] or 0
+            if indexed >= os.path.getsize(path):
+                break
+
+            entries = []
+            with open(path, 'rb') as data:
+                data.seek(indexed)
+                position = indexed
+                for line in data:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("A torn line")
+                        message = ArchivedMessage.de_json(line)
+                    except ValueError:
+                        break
+                    entries.append((message, segment, position, len(line)))
+                    position += len(line)
+
+            with open(path, 'r+b') as data:
+                data.truncate(position)
+            self._index(entries)
+            self._log.info("Recovered %s messages of %s",
+                           len(entries), segment)
+
+    def _list_segments(self):
+        """ Return numbers of segments written by this archive in order. """
+        pattern = re.compile(r'^{}-(\d+)\.jsonl$'.format(
+            re.escape(self._prefix)))
+        return sorted(int(match.group(1)) for match in
+                      (pattern.match(name)
+                       for name in os.listdir(self._path)) if match)
+
+    def _segment_name(self, number):
+        return '{}-{:06d}.jsonl'.format(self._prefix, number)
+
+    def _segment_path(self, segment):
+        return os.path.join(self._path, segment)
@@ -0,0 +1,894 @@
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from telegram.error import BadRequest, ChatMigrated, NetworkError, \
+    RetryAfter, Unauthorized
+
+
+class Redirected(Exception):
+    """ Raised by a send function that has passed a delivery on to another
+    queue. The delivery is neither retried nor finished by the queue it was
+    taken from.
+    """
+
+
+class TokenBucket(object):
+    """ A token bucket rate limiter.
+
+    The bucket is not thread-safe, callers are expected to synchronize access
+    to it.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """ Create a new TokenBucket.
+
+        Arguments:
+            rate (:obj:`float`): a number of tokens added to the bucket
+                per second
+            capacity (:obj:`int`): a maximum number of tokens in the bucket,
+                i.e. the size of a burst
+        """
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._timestamp = time.time()
+
+    def delay(self, now):
+        """ Return a number of seconds to wait until a token is available.
+
+        Arguments:
+            now (:obj:`float`): current time in seconds since the epoch
+
+        Return:
+            :obj:`float`: a delay in seconds or ``0`` if a token is available
+        """
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def consume(self, now):
+        """ Take a token from the bucket.
+
+        Arguments:
+            now (:obj:`float`): current time in seconds since the epoch
+        """
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now):
+        """ Return ``True`` if the bucket has refilled to its capacity, so
+        that it limits nothing a new bucket would not.
+
+        Arguments:
+            now (:obj:`float`): current time in seconds since the epoch
+        """
+        self._refill(now)
+        return self._tokens >= self._capacity
+
+    def _refill(self, now):
+        elapsed = now - self._timestamp
+        if elapsed > 0:
+            self._tokens = min(self._capacity,
+                               self._tokens + elapsed * self._rate)
+            self._timestamp = now
+
+
+class SharedChatLimits(object):
+    """ Message limits of chats shared by processes through an SQLite
+    database.
+
+    Every message to a chat reserves a time to be sent at, an interval of the
+    chat limit after the time reserved for the previous message by any
+    process. Reservations are made in write transactions, so processes never
+    reserve the same time.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_limits (
+            chat_id INTEGER PRIMARY KEY,
+            next_at REAL NOT NULL
+        )
+    """
+    _GET_NEXT = """
+        SELECT next_at FROM chat_limits WHERE chat_id = ?
+    """
+    _SET_NEXT = """
+        INSERT OR REPLACE INTO chat_limits (chat_id, next_at) VALUES (?, ?)
+    """
+
+    def __init__(self, path):
+        """ Open or create the limits.
+
+        Arguments:
+            path (:obj:`str`): a path to the database file, e.g. of
+                a ``bot.store.SqliteStore``
+        """
+        # The connection is shared by sender threads, access to it is
+        # serialized with a lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute(SharedChatLimits._SCHEMA)
+
+    def close(self):
+        """ Close the database connection. """
+        with self._lock:
+            self._db.close()
+
+    def reserve(self, chat_id, rate, now):
+        """ Reserve a time to send a message to a chat at.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a Telegram chat
+            rate (:obj:`float`): messages per second allowed in the chat
+            now (:obj:`float`): current time in seconds since the epoch
+
+        Return:
+            :obj:`float`: the reserved time in seconds since the epoch, not
+                earlier than ``now``
+        """
+        with self._lock:
+            # Other processes wait for the write lock until the transaction
+            # is over
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(SharedChatLimits._GET_NEXT,
+                                       (chat_id,)).fetchone()
+                send_at = max(now, row[0]) if row else now
+                self._db.execute(SharedChatLimits._SET_NEXT,
+                                 (chat_id, send_at + 1.0 / rate))
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        return send_at
+
+
+class Delivery(object):
+    """ A message pending delivery to a chat. """
+
+    def __init__(self, chat_id, text, master_ids, outbox_id=None,
+                 media=None, trace=None):
+        """ Create a new Delivery.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a Telegram chat to send message to
+            text (:obj:`str`): a message text, or a caption of media
+            master_ids (:obj:`list`): Telegram user ids of the Masters the
+                message is delivered to
+            outbox_id (:obj:`int`): (Optional) an id of the delivery record
+                in the outbox
+            media (:obj:`dict`): (Optional) a description of media to send,
+                or a list of descriptions of media to send as an album. See
+                ``bot.media.MediaCache``.
+            trace (:obj:`tuple`): (Optional) a context of a trace of the
+                update the message is forwarded from, see
+                ``bot.tracing.Tracer``
+        """
+        self.chat_id = chat_id
+        self.text = text
+        self.master_ids = master_ids
+        self.outbox_id = outbox_id
+        self.media = media
+        self.trace = trace
+        # A number of failed attempts to send the message
+        self.attempts = 0
+        # A time reserved to send the message at in limits shared with
+        # other processes, see ``SharedChatLimits``
+        self.send_at = None
+
+    def __str__(self):
+        return 'Delivery({chat_id}, {master_ids})' \
+            .format(chat_id=self.chat_id, master_ids=self.master_ids)
+
+
+class CircuitBreaker(object):
+    """ A circuit breaker of deliveries to a single chat.
+
+    The circuit opens after a number of consecutive failures, and no
+    deliveries to the chat are attempted until a cooldown is over. Then a
+    single delivery is let through: if it succeeds, the circuit closes,
+    otherwise it opens again for twice as long.
+
+    The breaker is not thread-safe, callers are expected to synchronize access
+    to it.
+    """
+
+    def __init__(self, threshold, cooldown, max_cooldown):
+        """ Create a new CircuitBreaker.
+
+        Arguments:
+            threshold (:obj:`int`): consecutive failures that open the circuit
+            cooldown (:obj:`float`): seconds the circuit stays open first
+            max_cooldown (:obj:`float`): a maximum of seconds the circuit
+                stays open
+        """
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._failures = 0
+        self.open_until = 0
+
+    def failure(self, now):
+        """ Register a failed delivery.
+
+        Arguments:
+            now (:obj:`float`): current time in seconds since the epoch
+
+        Return:
+            :obj:`bool`: ``True`` if the circuit has opened
+        """
+        self._failures += 1
+        if self._failures < self._threshold:
+            return False
+
+        self.open_until = now + self._cooldown
+        self._cooldown = min(self._cooldown * 2, self._max_cooldown)
+        return True
+
+    def is_open(self, now):
+        return self.open_until > now
+
+
+class DeliveryQueue(object):
+    """ A queue of outgoing messages drained by a pool of sender threads.
+
+    Senders respect Telegram message limits: a global limit for the whole bot
+    and a limit for every destination chat. A chat waiting for its limit does
+    not block deliveries to other chats. Deliveries to the same chat are sent
+    one at a time in the order they were queued. Limits of chats can be shared
+    with other processes sending as the same bot. More details about limits at
+    https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+
+    Failed deliveries are retried without blocking a sender: a chat is not
+    scheduled again until its retry time comes. Flood control errors are
+    retried after the time requested by Telegram, network errors after
+    a jittered exponential backoff. Deliveries to a migrated chat are moved
+    to its new ID. Repeated network errors in a chat open its circuit breaker,
+    so that a dead chat does not take up senders.
+    """
+
+    # Messages per second the bot is allowed to send overall
+    GLOBAL_RATE = 30
+    # Messages per second the bot is allowed to send to a private chat
+    PRIVATE_CHAT_RATE = 1
+    # Messages per second the bot is allowed to send to a group
+    GROUP_CHAT_RATE = 20 / 60.0
+
+    # Attempts to send a message before giving up on network errors
+    MAX_ATTEMPTS = 8
+    # The first and the maximum backoff after a network error in seconds
+    BACKOFF_SEC = 0.5
+    MAX_BACKOFF_SEC = 60
+    # Consecutive network errors in a chat that open its circuit breaker
+    BREAKER_THRESHOLD = 5
+    # The first and the maximum time a circuit breaker stays open in seconds
+    BREAKER_COOLDOWN_SEC = 30
+    MAX_BREAKER_COOLDOWN_SEC = 600
+    # Rate limiters of chats kept before idle ones are dropped
+    MIN_CHAT_LIMITS = 1024
+
+    def __init__(self, send, done=None, workers=4, metrics=None,
+                 redirect=None, global_rate=GLOBAL_RATE,
+                 private_chat_rate=PRIVATE_CHAT_RATE,
+                 group_chat_rate=GROUP_CHAT_RATE, shared_limits=None):
+        """ Create a new DeliveryQueue.
+
+        Arguments:
+            send (:obj:`callable`): a function that sends a ``Delivery``
+            done (:obj:`callable`): (Optional) a function called with
+                a ``Delivery`` once it has been sent or given up on
+            workers (:obj:`int`): a number of sender threads
+            metrics (:obj:`bot.metrics.Metrics`): (Optional) metrics to count
+                retries in
+            redirect (:obj:`callable`): (Optional) a function called with
+                a list of deliveries moved to a migrated chat to queue them
+                elsewhere. By default they stay in this queue.
+            global_rate (:obj:`float`): messages per second for all chats
+            private_chat_rate (:obj:`float`): messages per second for
+                a single private chat
+            group_chat_rate (:obj:`float`): messages per second for
+                a single group
+            shared_limits (:obj:`SharedChatLimits`): (Optional) limits of
+                chats shared with other processes, used instead of limits
+                of this queue alone
+        """
+        self._log = logging.getLogger(DeliveryQueue.__name__)
+        self._send = send
+        self._done = done
+        self._redirect = redirect
+        self._workers = workers
+        self._retries = metrics.retries if metrics is not None else None
+        self._private_chat_rate = private_chat_rate
+        self._group_chat_rate = group_chat_rate
+        self._shared_limits = shared_limits
+
+        self._cond = threading.Condition()
+        self._global_limit = TokenBucket(global_rate)
+        # A map of chat IDs to rate limiters of these chats
+        self._chat_limits = dict()
+        # A number of rate limiters to drop idle ones at
+        self._max_chat_limits = DeliveryQueue.MIN_CHAT_LIMITS
+        # A map of chat IDs to circuit breakers of chats with failures
+        self._breakers = dict()
+        # A map of chat IDs to queues of pending deliveries
+        self._pending = dict()
+        # A heap of (not before, sequence, chat ID) of chats ready to send.
+        # A chat with pending deliveries is either in the heap or in flight.
+        self._ready = []
+        self._sequence = itertools.count()
+        # IDs of chats with a delivery being sent right now
+        self._in_flight = set()
+        self._size = 0
+
+        self._running = False
+        self._threads = []
+
+    def __len__(self):
+        """ Return a number of queued deliveries. """
+        return self._size
+
+    @property
+    def open_circuits(self):
+        """ Return a number of chats with open circuit breakers. """
+        now = time.time()
+        with self._cond:
+            return sum(1 for breaker in self._breakers.values()
+                       if breaker.is_open(now))
+
+    def start(self):
+        """ Start sender threads. """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run,
+                                      name='delivery-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stop sender threads. Deliveries that were not sent are dropped.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def put(self, delivery):
+        """ Queue a message for delivery. Never blocks.
+
+        Arguments:
+            delivery (:obj:`Delivery`): a message to deliver
+        """
+        chat_id = delivery.chat_id
+
+        with self._cond:
+            queue = self._pending.get(chat_id)
+            if queue is None:
+                queue = self._pending[chat_id] = deque()
+            queue.append(delivery)
+            self._size += 1
+
+            # Schedule the chat unless it is scheduled or being sent to
+            if len(queue) == 1 and chat_id not in self._in_flight:
+                self._schedule(chat_id, time.time())
+                self._cond.notify()
+
+    def drain(self, chat_id=None):
+        """ Take all queued deliveries out of the queue.
+
+        Arguments:
+            chat_id (:obj:`int`): (Optional) an id of a chat to take
+                deliveries to, all chats by default
+
+        Return:
+            :obj:`list`: deliveries that were not sent, in the order they
+                were queued for every chat
+        """
+        with self._cond:
+            if chat_id is not None:
+                queue = self._pending.pop(chat_id, None) or deque()
+                self._ready = [entry for entry in self._ready
+                               if entry[2] != chat_id]
+                heapq.heapify(self._ready)
+                self._size -= len(queue)
+                return list(queue)
+
+            deliveries = [delivery for queue in self._pending.values()
+                          for delivery in queue]
+            self._pending.clear()
+            self._ready = []
+            self._size = 0
+        return deliveries
+
+    def _run(self):
+        while True:
+            with self._cond:
+                delivery = self._take()
+            if delivery is None:
+                return
+            if self._shared_limits is not None and \
+                    not self._reserve(delivery):
+                continue
+
+            chat_id = delivery.chat_id
+            try:
+                self._send(delivery)
+
+            except RetryAfter as err:
+                self._log.warning("Flood control exceeded in chat %s, "
+                                  "retrying in %s seconds",
+                                  chat_id, err.retry_after)
+                self._retry(chat_id, delivery, err.retry_after)
+
+            except ChatMigrated as err:
+                self._migrate(chat_id, err.new_chat_id, delivery)
+
+            except Redirected:
+                # Another queue sends the delivery now
+                with self._cond:
+                    self._complete(chat_id, time.time())
+
+            except BadRequest:
+                # The message itself is wrong, sending it again won't help
+                self._log.exception("Telegram rejected %s", delivery)
+                self._finish(chat_id, delivery)
+
+            except NetworkError:
+                self._log.warning("Failed to send %s", delivery,
+                                  exc_info=True)
+                self._fail(chat_id, delivery)
+
+            except Exception:
+                self._log.exception("Failed to send %s", delivery)
+                self._finish(chat_id, delivery)
+
+            else:
+                with self._cond:
+                    self._breakers.pop(chat_id, None)
+                self._finish(chat_id, delivery)
+
+    def _take(self):
+        """ Wait for a delivery that can be sent without exceeding limits.
+
+        Must be called with the condition held.
+
+        Return:
+            :obj:`Delivery`: a delivery or ``None`` if the queue was stopped
+        """
+        while self._running:
+            if not self._ready:
+                self._cond.wait()
+                continue
+
+            now = time.time()
+            not_before, _, chat_id = self._ready[0]
+            delay = max(not_before - now, self._global_limit.delay(now))
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+
+            heapq.heappop(self._ready)
+            self._global_limit.consume(now)
+            limit = self._chat_limits.get(chat_id)
+            if limit is not None:
+                limit.consume(now)
+
+            queue = self._pending[chat_id]
+            delivery = queue.popleft()
+            if not queue:
+                del self._pending[chat_id]
+            self._size -= 1
+
+            self._in_flight.add(chat_id)
+            return delivery
+
+        return None
+
+    def _reserve(self, delivery):
+        """ Reserve a time to send a delivery at in the shared limits of its
+        chat, unless it has one. A delivery whose time has not come is put
+        back ahead of other deliveries to the chat until then.
+
+        Return:
+            :obj:`bool`: ``True`` if the delivery can be sent now
+        """
+        chat_id = delivery.chat_id
+        if delivery.send_at is None:
+            try:
+                delivery.send_at = self._shared_limits.reserve(
+                    chat_id, self._chat_rate(chat_id), time.time())
+            except sqlite3.Error:
+                # Telegram still enforces the limit with flood control
+                self._log.warning("Failed to reserve a time to send %s",
+                                  delivery, exc_info=True)
+                return True
+
+        send_at = delivery.send_at
+        if send_at <= time.time():
+            # Every attempt to send takes a time of its own
+            delivery.send_at = None
+            return True
+
+        with self._cond:
+            self._requeue(chat_id, delivery)
+            self._complete(chat_id, send_at)
+        return False
+
+    def _finish(self, chat_id, delivery):
+        """ Complete a delivery that has been sent or given up on. """
+        with self._cond:
+            self._complete(chat_id, time.time())
+        if self._done:
+            self._done(delivery)
+
+    def _retry(self, chat_id, delivery, delay):
+        """ Send a delivery again, ahead of other deliveries to the chat. """
+        if self._retries is not None:
+            self._retries.inc()
+
+        with self._cond:
+            self._requeue(chat_id, delivery)
+            self._complete(chat_id, time.time() + delay)
+
+    def _fail(self, chat_id, delivery):
+        """ Retry a delivery after a network error or give up on it. """
+        delivery.attempts += 1
+        now = time.time()
+
+        with self._cond:
+            breaker = self._breakers.get(chat_id)
+            if breaker is None:
+                breaker = self._breakers[chat_id] = CircuitBreaker(
+                    DeliveryQueue.BREAKER_THRESHOLD,
+                    DeliveryQueue.BREAKER_COOLDOWN_SEC,
+                    DeliveryQueue.MAX_BREAKER_COOLDOWN_SEC)
+            if breaker.failure(now):
+                self._log.warning("Too many failures in chat %s, pausing "
+                                  "deliveries for %.0f seconds",
+                                  chat_id, breaker.open_until - now)
+
+        if delivery.attempts >= DeliveryQueue.MAX_ATTEMPTS:
+            self._log.error("Giving up on %s after %s attempts",
+                            delivery, delivery.attempts)
+            self._finish(chat_id, delivery)
+            return
+
+        # Exponential backoff with full jitter
+        backoff = min(DeliveryQueue.MAX_BACKOFF_SEC,
+                      DeliveryQueue.BACKOFF_SEC * 2 ** (delivery.attempts - 1))
+        self._retry(chat_id, delivery, random.uniform(0, backoff))
+
+    def _migrate(self, chat_id, new_chat_id, delivery):
+        """ Move a delivery and all pending deliveries to a migrated chat. """
+        if self._retries is not None:
+            self._retries.inc()
+
+        with self._cond:
+            queue = self._pending.pop(chat_id, None) or deque()
+            queue.appendleft(delivery)
+            for pending in queue:
+                pending.chat_id = new_chat_id
+            self._in_flight.discard(chat_id)
+
+            if self._redirect is not None:
+                # The deliveries are queued wherever the new chat belongs
+                self._size -= len(queue) - 1
+            else:
+                self._size += 1
+                target = self._pending.get(new_chat_id)
+                if target is not None:
+                    # The new chat is already scheduled or being sent to
+                    target.extend(queue)
+                else:
+                    self._pending[new_chat_id] = queue
+                    if new_chat_id not in self._in_flight:
+                        self._schedule(new_chat_id, time.time())
+                self._cond.notify()
+                return
+
+        self._redirect(list(queue))
+
+    def _requeue(self, chat_id, delivery):
+        """ Return a delivery to the head of the chat queue.
+
+        Must be called with the condition held.
+        """
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+        queue.appendleft(delivery)
+        self._size += 1
+
+    def _complete(self, chat_id, not_before):
+        """ Mark a delivery to a chat as finished and schedule the next one.
+
+        Must be called with the condition held.
+        """
+        self._in_flight.discard(chat_id)
+        if chat_id in self._pending:
+            self._schedule(chat_id, not_before)
+            self._cond.notify()
+
+    def _schedule(self, chat_id, not_before):
+        """ Schedule the next delivery to a chat.
+
+        Must be called with the condition held.
+        """
+        if self._shared_limits is None:
+            now = time.time()
+            limit = self._chat_limits.get(chat_id)
+            if limit is None:
+                if len(self._chat_limits) >= self._max_chat_limits:
+                    self._drop_idle_limits(now)
+                limit = self._chat_limits[chat_id] = TokenBucket(
+                    self._chat_rate(chat_id))
+            not_before = max(not_before, now + limit.delay(now))
+
+        breaker = self._breakers.get(chat_id)
+        if breaker is not None:
+            not_before = max(not_before, breaker.open_until)
+
+        heapq.heappush(self._ready, (not_before,
+                                     next(self._sequence), chat_id))
+
+    def _drop_idle_limits(self, now):
+        """ Drop rate limiters of chats with no pending deliveries that
+        have fully refilled, the way empty chat queues are dropped.
+
+        Limiters are dropped once their number doubles since the last time,
+        so that every chat the bot sends to takes a constant time on average.
+
+        Must be called with the condition held.
+        """
+        for chat_id in [chat_id for chat_id, limit
+                        in self._chat_limits.items()
+                        if chat_id not in self._pending and
+                        chat_id not in self._in_flight and
+                        limit.is_full(now)]:
+            del self._chat_limits[chat_id]
+        self._max_chat_limits = max(DeliveryQueue.MIN_CHAT_LIMITS,
+                                    2 * len(self._chat_limits))
+
+    def _chat_rate(self, chat_id):
+        """ Return messages per second allowed in a chat. """
+        # Group chats have negative IDs in Telegram
+        if chat_id < 0:
+            return self._group_chat_rate
+        return self._private_chat_rate
+
+
+class SenderPool(object):
+    """ Delivers messages through several bots to send more messages than
+    a single bot is allowed to. Every bot has its own delivery queue, with
+    its own rate limits and sender threads.
+
+    Every chat is assigned to one of the bots by rendezvous hashing, so
+    deliveries to a chat are sent by the same bot in order, and only chats of
+    a bot taken out of the pool move to other bots. A bot whose token has been
+    revoked is taken out of the pool, and its queued deliveries are passed on
+    to the other bots. The last bot is never taken out. Deliveries to
+    a migrated chat are passed on to the bot of its new ID.
+
+    A main bot, if there is one, is not in rotation. It sends media, whose
+    file IDs only it can use, and messages to chats that refused the bot of
+    the chat, from a queue of its own, so that it stays within its limits.
+    """
+
+    def __init__(self, bots, send, done=None, workers=4, metrics=None,
+                 main_bot=None, **rate_limits):
+        """ Create a new SenderPool.
+
+        Arguments:
+            bots (:obj:`list`): ``telegram.Bot`` instances to send with
+            send (:obj:`callable`): a function that sends a ``Delivery``
+                with a ``telegram.Bot``
+            done (:obj:`callable`): (Optional) a function called with
+                a ``Delivery`` once it has been sent or given up on
+            workers (:obj:`int`): a number of sender threads of every bot
+            metrics (:obj:`bot.metrics.Metrics`): (Optional) metrics to count
+                retries in
+            main_bot (:obj:`telegram.Bot`): (Optional) a bot to send media
+                with, it may be one of the bots
+            rate_limits: message limits of every bot, see ``DeliveryQueue``
+        """
+        self._log = logging.getLogger(SenderPool.__name__)
+        self._send = send
+        self._bots = list(bots)
+        # Indexes of bots in rotation
+        self._active = list(range(len(self._bots)))
+        # An index of the main bot
+        self._main = None
+        if main_bot is not None:
+            indexes = [index for index, bot in enumerate(self._bots)
+                       if bot is main_bot]
+            if not indexes:
+                self._bots.append(main_bot)
+            self._main = indexes[0] if indexes else len(self._bots) - 1
+        self._queues = [DeliveryQueue(functools.partial(self._send_with, bot),
+                                      done=done, workers=workers,
+                                      metrics=metrics, redirect=self._put_all,
+                                      **rate_limits)
+                        for bot in self._bots]
+
+        self._lock = threading.Lock()
+        # A map of chat IDs to indexes of bots they are assigned to
+        self._routes = dict()
+        # IDs of chats that refused the bot assigned to them
+        self._main_chats = set()
+
+    def __len__(self):
+        """ Return a number of queued deliveries. """
+        return sum(len(queue) for queue in self._queues)
+
+    @property
+    def active(self):
+        """ Return a number of bots in rotation. """
+        return len(self._active)
+
+    @property
+    def open_circuits(self):
+        """ Return a number of chats with open circuit breakers. """
+        return sum(queue.open_circuits for queue in self._queues)
+
+    def start(self):
+        """ Start sender threads of all bots. """
+        for queue in self._queues:
+            queue.start()
+
+    def stop(self):
+        """ Stop sender threads of all bots. Deliveries that were not sent
+        are dropped.
+        """
+        for queue in self._queues:
+            queue.stop()
+
+    def put(self, delivery):
+        """ Queue a message for delivery by the bot of its chat. Never
+        blocks.
+
+        Arguments:
+            delivery (:obj:`Delivery`): a message to deliver
+        """
+        self._put_all([delivery])
+
+    def retire(self, bot, delivery):
+        """ Take a bot out of the pool if its token has been revoked, and pass
+        its deliveries on to other bots. Called by the send function when the
+        bot is not authorized to send a delivery.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): a bot that failed to send the delivery
+            delivery (:obj:`Delivery`): the delivery, it is passed on ahead of
+                other deliveries to its chat
+
+        Return:
+            :obj:`bool`: ``True`` if the delivery was passed on to another
+                bot, ``False`` if the bot is authorized and the chat is to
+                blame, or the bot is the last one
+
+        Raises:
+            :obj:`telegram.error.NetworkError`: if the bot could not be
+                checked
+        """
+        indexes = [index for index, pooled in enumerate(self._bots)
+                   if pooled is bot]
+        if not indexes:
+            return False
+        index = indexes[0]
+
+        with self._lock:
+            retired = index not in self._active
+            if not retired and len(self._active) == 1:
+                return False
+        if not retired:
+            try:
+                # A chat that blocked the bot does not make the bot invalid
+                bot.get_me()
+                return False
+            except Unauthorized:
+                pass
+
+        with self._lock:
+            if index in self._active and len(self._active) == 1:
+                return False
+            deliveries = [delivery]
+            if index in self._active:
+                self._active.remove(index)
+                self._routes.clear()
+                deliveries.extend(self._queues[index].drain())
+                self._log.error("Bot %s is not authorized anymore, passing "
+                                "%s deliveries on to %s other bots", index,
+                                len(deliveries), len(self._active))
+            # Deliveries in flight when the bot was taken out follow the ones
+            # it passed on
+            for pending in deliveries:
+                self._queues[self._route(pending)].put(pending)
+        return True
+
+    def refuse(self, delivery):
+        """ Send the delivery and all later deliveries to its chat with
+        the main bot. Called by the send function when the bot of the chat
+        is not allowed to send there.
+
+        Arguments:
+            delivery (:obj:`Delivery`): the delivery, it is passed on to
+                the main bot
+
+        Return:
+            :obj:`bool`: ``True`` if the delivery was passed on, ``False`` if
+                there is no main bot to pass it on to
+        """
+        if self._main is None:
+            return False
+        chat_id = delivery.chat_id
+        with self._lock:
+            self._main_chats.add(chat_id)
+            deliveries = [delivery]
+            index = self._routes.get(chat_id)
+            if index is not None and index != self._main:
+                # Deliveries queued after it keep their order
+                deliveries.extend(self._queues[index].drain(chat_id))
+            for pending in deliveries:
+                self._queues[self._main].put(pending)
+        return True
+
+    def migrate(self, chat_id, new_chat_id):
+        """ Send to a migrated chat with the main bot if it sent to the old
+        chat. Called by the send function before the delivery is retried in
+        the new chat.
+
+        Arguments:
+            chat_id (:obj:`int`): an old ID of the chat
+            new_chat_id (:obj:`int`): a new ID of the chat
+        """
+        with self._lock:
+            if chat_id in self._main_chats:
+                self._main_chats.add(new_chat_id)
+
+    def _put_all(self, deliveries):
+        """ Queue deliveries by the bots of their chats, e.g. deliveries
+        moved to a migrated chat.
+        """
+        with self._lock:
+            for delivery in deliveries:
+                self._queues[self._route(delivery)].put(delivery)
+
+    def _send_with(self, bot, delivery):
+        self._send(delivery, bot)
+
+    def _route(self, delivery):
+        """ Return an index of a bot to send a delivery with: the main bot
+        for media, otherwise the bot its chat is assigned to.
+
+        Must be called with the lock held.
+        """
+        chat_id = delivery.chat_id
+        if self._main is not None and (delivery.media is not None or
+                                       chat_id in self._main_chats):
+            return self._main
+
+        index = self._routes.get(chat_id)
+        if index is None:
+            index = self._routes[chat_id] = max(
+                self._active, key=lambda active: hashlib.md5(
+                    '{}:{}'.format(chat_id, active).encode()).digest())
+        return index
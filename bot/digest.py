@@ -0,0 +1,195 @@
+import threading
+import time
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+
+def split_message(texts, separator='\n\n', limit=MAX_MESSAGE_LENGTH):
+    """ Join messages into as few chunks as fit into a Telegram message.
+
+    Messages are never split unless a single message exceeds the limit.
+    A message is split outside of Markdown entities and escapes, at a line
+    break or a space where possible, so that every chunk is valid Markdown.
+
+    Arguments:
+        texts (:obj:`list`): a list of message texts in Telegram Markdown
+        separator (:obj:`str`): a separator between messages
+        limit (:obj:`int`): a maximum length of a chunk
+
+    Return:
+        :obj:`list`: a list of chunks
+    """
+    chunks = []
+    chunk = ''
+    for text in texts:
+        if chunk and len(chunk) + len(separator) + len(text) <= limit:
+            chunk += separator + text
+            continue
+
+        if chunk:
+            chunks.append(chunk)
+        # Cut messages that do not fit into a single chunk
+        while len(text) > limit:
+            position = _cut_position(text, limit)
+            chunks.append(text[:position])
+            text = text[position:]
+        chunk = text
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _cut_position(text, limit):
+    """ Find where to cut a Markdown text to fit the first part into a limit.
+
+    Return:
+        :obj:`int`: the last position after a line break, or else before
+            a word, or else anywhere outside of entities and escapes, that
+            leaves at least half of the limit in the first part. The limit
+            itself if there is no such position.
+    """
+    line = word = anywhere = 0
+    position = 0
+    while position <= limit:
+        # Nothing before the position is left open, so it is safe to cut
+        anywhere = position
+        if position and text[position - 1] == '\n':
+            line = position
+        elif position and text[position - 1] == ' ':
+            word = position
+        if position == limit:
+            break
+
+        if text[position] == '\\':
+            # An escaped character
+            end = position + 2
+        elif text.startswith('```', position):
+            end = _end_of(text, '```', position + 3)
+        elif text[position] in '*_`':
+            end = _end_of(text, text[position], position + 1)
+        elif text[position] == '[':
+            # A link, its text may not contain brackets
+            end = _end_of(text, '](', position + 1)
+            end = _end_of(text, ')', end) if end >= 0 else end
+        else:
+            end = position + 1
+        if end < 0:
+            # An entity that is never closed
+            break
+        position = end
+
+    for cut in (line, word, anywhere):
+        if cut >= limit // 2:
+            return cut
+    return limit
+
+
+def _end_of(text, mark, start):
+    """ Return a position after the first mark in a text from a start, or -1
+    if there is none.
+    """
+    position = text.find(mark, start)
+    return position + len(mark) if position >= 0 else -1
+
+
+class _Digest(object):
+    """ Messages collected for a single chat. """
+
+    def __init__(self, now):
+        self.created = now
+        self.texts = []
+        self.size = 0
+        self.master_ids = set()
+        self.outbox_ids = []
+
+
+class DigestBuffer(object):
+    """ Collects forwarded messages bound for the same chat and releases them
+    in bulk, either when a time window is over or when enough text has been
+    collected to fill a Telegram message.
+    """
+
+    # Seconds to collect messages for before a digest is sent
+    WINDOW_SEC = 60
+    # Characters to collect before a digest is sent regardless of the window
+    MAX_SIZE = MAX_MESSAGE_LENGTH
+
+    def __init__(self, flush, window=WINDOW_SEC, max_size=MAX_SIZE):
+        """ Create a new DigestBuffer.
+
+        Arguments:
+            flush (:obj:`callable`): a function that receives a chat ID,
+                a list of digest texts that fit into a message each,
+                a set of IDs of Masters the digest is delivered to,
+                and a list of outbox IDs of the collected messages
+            window (:obj:`float`): seconds to collect messages for
+            max_size (:obj:`int`): characters to collect before flushing
+        """
+        self._flush = flush
+        self._window = window
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # A map of chat IDs to collected messages
+        self._digests = dict()
+
+    def __len__(self):
+        """ Return a number of chats with pending digests. """
+        return len(self._digests)
+
+    def __contains__(self, chat_id):
+        """ Return whether a digest for the chat is being collected. """
+        return chat_id in self._digests
+
+    def add(self, chat_id, text, master_ids, outbox_id=None):
+        """ Add a message to the digest for the chat.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a Telegram chat to send digest to
+            text (:obj:`str`): a message text
+            master_ids (:obj:`iterable`): IDs of Masters the message
+                is delivered to
+            outbox_id (:obj:`int`): (Optional) an id of the message record
+                in the outbox
+        """
+        with self._lock:
+            digest = self._digests.get(chat_id)
+            if digest is None:
+                digest = self._digests[chat_id] = _Digest(time.time())
+            digest.texts.append(text)
+            digest.size += len(text)
+            digest.master_ids.update(master_ids)
+            if outbox_id is not None:
+                digest.outbox_ids.append(outbox_id)
+
+            if digest.size < self._max_size:
+                return
+            del self._digests[chat_id]
+
+        self._send(chat_id, digest)
+
+    def flush_expired(self):
+        """ Send digests that were collected for longer than the window. """
+        deadline = time.time() - self._window
+        with self._lock:
+            expired = [(chat_id, digest)
+                       for chat_id, digest in self._digests.items()
+                       if digest.created <= deadline]
+            for chat_id, _ in expired:
+                del self._digests[chat_id]
+
+        for chat_id, digest in expired:
+            self._send(chat_id, digest)
+
+    def flush_all(self):
+        """ Send all collected digests. """
+        with self._lock:
+            digests = self._digests
+            self._digests = dict()
+
+        for chat_id, digest in digests.items():
+            self._send(chat_id, digest)
+
+    def _send(self, chat_id, digest):
+        self._flush(chat_id, split_message(digest.texts), digest.master_ids,
+                    digest.outbox_ids)
@@ -0,0 +1,227 @@
+import threading
+from collections import deque
+
+
+# A maximum number of filter patterns of a Master in a chat
+MAX_PATTERNS = 20
+# A maximum length of a filter pattern
+MAX_PATTERN_LENGTH = 64
+
+
+def parse_pattern(pattern):
+    """ Parse a filter pattern given by a Master.
+
+    A pattern is a keyword matched anywhere in a message regardless of case.
+    Regular expressions are not accepted: some of them take exponential time
+    to match, and matching cannot be interrupted.
+
+    Arguments:
+        pattern (:obj:`str`): a filter pattern
+
+    Return:
+        :obj:`str`: a keyword
+
+    Raises:
+        :obj:`ValueError`: if a pattern is a regular expression or is too long
+    """
+    if len(pattern) > 2 and pattern.startswith('/') and pattern.endswith('/'):
+        raise ValueError('regular expressions are not supported')
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise ValueError('keywords can be at most {} characters long'.format(
+            MAX_PATTERN_LENGTH))
+    return pattern.lower()
+
+
+class AhoCorasick(object):
+    """ An Aho-Corasick automaton finding all of a set of keywords in a text
+    in a single pass, no matter how many keywords there are.
+    """
+
+    def __init__(self, keywords):
+        """ Build an automaton.
+
+        Arguments:
+            keywords (:obj:`list`): a list of keywords
+        """
+        # Transitions, failure links and indices of keywords ending in every
+        # state of the automaton. State 0 is the root.
+        self._goto = [dict()]
+        self._fail = [0]
+        self._output = [()]
+
+        for index, keyword in enumerate(keywords):
+            self._add(keyword, index)
+        self._link()
+
+    def _add(self, keyword, index):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] += (index,)
+
+    def _link(self):
+        """ Compute failure links in breadth-first order. """
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                if fail == next_state:
+                    fail = 0
+
+                self._fail[next_state] = fail
+                self._output[next_state] += self._output[fail]
+
+    def search(self, text):
+        """ Find keywords in a text.
+
+        Arguments:
+            text (:obj:`str`): a text to search
+
+        Return:
+            :obj:`set`: indices of keywords found in the text
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class ChatFilter(object):
+    """ Filters of all Masters subscribed to a single chat.
+
+    Keywords of all Masters are compiled into a single automaton, so the cost
+    of matching a message depends on its length rather than on the number of
+    Masters or keywords.
+    """
+
+    def __init__(self, filters):
+        """ Compile filters.
+
+        Arguments:
+            filters (:obj:`dict`): a map of Master IDs to lists of patterns.
+                Patterns saved by earlier versions as regular expressions are
+                matched as keywords.
+        """
+        self.master_ids = frozenset(filters)
+
+        keywords = dict()
+        for master_id, patterns in filters.items():
+            for pattern in patterns:
+                keywords.setdefault(pattern.lower(), set()).add(master_id)
+
+        self._keywords = list(keywords)
+        self._keyword_masters = [keywords[keyword]
+                                 for keyword in self._keywords]
+        self._automaton = AhoCorasick(self._keywords) \
+            if self._keywords else None
+
+    def match(self, text):
+        """ Return Masters whose filters match a message.
+
+        Arguments:
+            text (:obj:`str`): a message text
+
+        Return:
+            :obj:`set`: IDs of Masters with matching filters
+        """
+        matched = set()
+        if self._automaton is not None:
+            for index in self._automaton.search(text.lower()):
+                matched.update(self._keyword_masters[index])
+        return matched
+
+
+class FilterIndex(object):
+    """ Compiled filters of spied chats.
+
+    Filters of a chat are loaded from a store and compiled when the first
+    message from the chat arrives, and compiled again only after they have
+    been invalidated.
+    """
+
+    # An empty filter of chats where nobody filters messages
+    _NO_FILTERS = ChatFilter(dict())
+
+    def __init__(self, store):
+        """ Create a new FilterIndex.
+
+        Arguments:
+            store (:obj:`bot.store.AbstractStore`): a store to load filters
+                from
+        """
+        self._store = store
+        self._lock = threading.Lock()
+        # A map of chat IDs to compiled filters
+        self._chats = dict()
+        # Incremented on every invalidation, so that filters loaded before
+        # it are not cached
+        self._generation = 0
+
+    def filter(self, chat_id, text, subscribers):
+        """ Select subscribers that should receive a message.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a chat the message was sent to
+            text (:obj:`str`): a message text
+            subscribers (:obj:`list`): a list of ``MasterSettings``
+
+        Return:
+            :obj:`list`: subscribers without filters or with matching filters
+        """
+        chat_filter = self._chats.get(chat_id)
+        if chat_filter is None:
+            chat_filter = self._load(chat_id)
+        if not chat_filter.master_ids:
+            return subscribers
+
+        matched = chat_filter.match(text)
+        filtered = chat_filter.master_ids
+        return [subscriber for subscriber in subscribers
+                if subscriber.master_id not in filtered or
+                subscriber.master_id in matched]
+
+    def invalidate(self, chat_id=None):
+        """ Drop compiled filters after they have changed in the store.
+
+        Arguments:
+            chat_id (:obj:`int`): (Optional) an id of a chat. If not set,
+                filters of all chats are dropped.
+        """
+        with self._lock:
+            self._generation += 1
+            if chat_id is None:
+                self._chats.clear()
+            else:
+                self._chats.pop(chat_id, None)
+
+    def _load(self, chat_id):
+        generation = self._generation
+        filters = self._store.get_filters(chat_id)
+        chat_filter = ChatFilter(filters) if filters \
+            else FilterIndex._NO_FILTERS
+        with self._lock:
+            if generation == self._generation:
+                self._chats[chat_id] = chat_filter
+        return chat_filter
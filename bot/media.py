@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+
+from telegram.ext import BaseFilter
+
+# Types of media that can be sent with a caption
+CAPTIONED_TYPES = frozenset(('photo', 'video', 'document', 'audio', 'voice'))
+# Types of media that can be sent in an album
+ALBUM_TYPES = frozenset(('photo', 'video'))
+# Metadata of media kept along with a file_id, by media types
+_METADATA = {
+    'video': ('width', 'height', 'duration'),
+}
+
+
+class _VideoNoteFilter(BaseFilter):
+    """ Filters messages that contain a video note. """
+
+    def filter(self, message):
+        return bool(message.video_note)
+
+
+video_note = _VideoNoteFilter()
+
+
+class MediaCache(object):
+    """ Describes media attached to spied messages.
+
+    Media are forwarded by their ``file_id``, so files are never downloaded
+    or uploaded again. A description of a file is a JSON-serializable dict of
+    its media type, ``file_id`` and metadata needed to send it. It is built
+    once per message and shared by deliveries to all Masters. Descriptions
+    are kept in a bounded LRU cache by ``file_id``, so files reposted in many
+    chats, like stickers, share a single description too.
+    """
+
+    # A number of file descriptions to keep
+    CACHE_SIZE = 1000
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        """ Create a new MediaCache.
+
+        Arguments:
+            cache_size (:obj:`int`): a number of file descriptions to keep
+        """
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        # A map of file IDs to file descriptions
+        self._files = OrderedDict()
+
+    def __len__(self):
+        """ Return a number of cached descriptions. """
+        return len(self._files)
+
+    def describe(self, message):
+        """ Describe media attached to a message.
+
+        Arguments:
+            message (:obj:`telegram.Message`): a message
+
+        Return:
+            :obj:`dict`: a description of the media, or ``None`` if the
+                message has no media that can be forwarded. It is shared and
+                must not be modified.
+        """
+        media_type, media = MediaCache._find(message)
+        if media is None:
+            return None
+
+        with self._lock:
+            description = self._files.pop(media.file_id, None)
+            if description is None:
+                description = {'type': media_type, 'file_id': media.file_id}
+                for name in _METADATA.get(media_type, ()):
+                    description[name] = getattr(media, name)
+            # Move the description to the end of the LRU
+            self._files[media.file_id] = description
+            if len(self._files) > self._cache_size:
+                self._files.popitem(last=False)
+        return description
+
+    @staticmethod
+    def _find(message):
+        if message.photo:
+            # Photos come in several sizes, the largest one is forwarded
+            return 'photo', max(message.photo,
+                                key=lambda size: size.width * size.height)
+        for media_type in ('video', 'document', 'audio', 'voice', 'sticker',
+                           'video_note'):
+            media = getattr(message, media_type)
+            if media:
+                return media_type, media
+        return None, None
+
+
+class _Album(object):
+    """ Messages of a single media group. """
+
+    def __init__(self, now):
+        self.updated = now
+        self.updates = []
+
+
+class AlbumBuffer(object):
+    """ Collects messages of media groups, which Telegram delivers one by
+    one, so that every album can be forwarded at once.
+
+    An album is released once no new messages of it have arrived for a while,
+    or once it is full.
+    """
+
+    # Seconds to wait for more messages of an album
+    WAIT_SEC = 1.0
+    # A maximum number of messages in an album
+    MAX_SIZE = 10
+
+    def __init__(self, flush, wait=WAIT_SEC):
+        """ Create a new AlbumBuffer.
+
+        Arguments:
+            flush (:obj:`callable`): a function that receives a list of
+                updates with messages of an album in the order they arrived
+            wait (:obj:`float`): seconds to wait for more messages of
+                an album
+        """
+        self._flush = flush
+        self._wait = wait
+        self._lock = threading.Lock()
+        # A map of (chat ID, media group ID) to collected messages
+        self._albums = dict()
+
+    def __len__(self):
+        """ Return a number of albums being collected. """
+        return len(self._albums)
+
+    def add(self, update):
+        """ Add a message of a media group.
+
+        Arguments:
+            update (:obj:`telegram.Update`): an update with a message of
+                a media group
+        """
+        key = (update.effective_chat.id, update.message.media_group_id)
+        with self._lock:
+            album = self._albums.get(key)
+            if album is None:
+                album = self._albums[key] = _Album(time.time())
+            album.updated = time.time()
+            album.updates.append(update)
+
+            if len(album.updates) < AlbumBuffer.MAX_SIZE:
+                return
+            del self._albums[key]
+
+        self._flush(album.updates)
+
+    def flush_expired(self):
+        """ Release albums that have not grown for long enough. """
+        deadline = time.time() - self._wait
+        with self._lock:
+            expired = [(key, album) for key, album in self._albums.items()
+                       if album.updated <= deadline]
+            for key, _ in expired:
+                del self._albums[key]
+
+        for _, album in expired:
+            self._flush(album.updates)
+
+    def flush_all(self):
+        """ Release all collected albums. """
+        with self._lock:
+            albums = self._albums
+            self._albums = dict()
+
+        for album in albums.values():
+            self._flush(album.updates)
@@ -0,0 +1,407 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from store import AbstractStore
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for name, value in zip(names, values)) + '}'
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _Metric(object):
+    """ A base class for metrics with optional labels.
+
+    Children of a metric with particular label values are created once and
+    can be kept by callers, so that updating them does not look labels up.
+    """
+
+    _TYPE = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self._documentation = documentation
+        self._label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        # A map of label values to children
+        self._children = dict()
+        if not self._label_names:
+            # Metrics without labels are reported from the start
+            self.labels()
+
+    def labels(self, *values):
+        """ Return a child of the metric with the specified label values. """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        """ Render the metric in Prometheus text format.
+
+        Return:
+            :obj:`list`: a list of lines
+        """
+        lines = ['# HELP {} {}'.format(self.name, self._documentation),
+                 '# TYPE {} {}'.format(self.name, self._TYPE)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_child(self, values, child):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """ A monotonically increasing counter. """
+
+    _TYPE = 'counter'
+
+    def inc(self, amount=1):
+        """ Increment the counter without labels. """
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, values, child):
+        return ['{}{} {}'.format(self.name,
+                                 _format_labels(self._label_names, values),
+                                 child.value)]
+
+
+class Histogram(_Metric):
+    """ A histogram of observed values in fixed buckets. """
+
+    _TYPE = 'histogram'
+
+    # Buckets suitable for latencies in seconds
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                       0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, label_names)
+
+    def observe(self, value):
+        """ Observe a value without labels. """
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self._buckets)
+
+    def _render_child(self, values, child):
+        label_names = self._label_names + ('le',)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + ('+Inf',), child.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _format_labels(label_names, values + (bound,)),
+                cumulative))
+        labels = _format_labels(self._label_names, values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, child.sum))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Gauge(object):
+    """ A value that is read from a function when metrics are collected. """
+
+    _TYPE = 'gauge'
+
+    def __init__(self, name, documentation, function, label_names=()):
+        """ Create a new Gauge.
+
+        Arguments:
+            name (:obj:`str`): a name of the metric
+            documentation (:obj:`str`): a description of the metric
+            function (:obj:`callable`): a function that returns the value,
+                or a map of tuples of label values to values if the gauge
+                has labels
+            label_names (:obj:`tuple`): (Optional) names of labels
+        """
+        self.name = name
+        self._documentation = documentation
+        self._function = function
+        self._label_names = tuple(label_names)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self._documentation),
+                 '# TYPE {} {}'.format(self.name, self._TYPE)]
+        if not self._label_names:
+            lines.append('{} {}'.format(self.name, self._function()))
+            return lines
+
+        for values, value in sorted(self._function().items()):
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self._label_names, values), value))
+        return lines
+
+
+class FunctionCounter(Gauge):
+    """ A counter that is read from a function when metrics are collected.
+    """
+
+    _TYPE = 'counter'
+
+
+class Metrics(object):
+    """ Metrics of the SpyBot.
+
+    Metrics are kept in memory and are cheap enough to be always on. They
+    can be served in Prometheus text format by a ``MetricsServer``.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+        self.handler_latency = self.add(Histogram(
+            'spybot_handler_latency_seconds',
+            'Time spent in update handlers', ('handler',)))
+        self.store_latency = self.add(Histogram(
+            'spybot_store_latency_seconds',
+            'Time spent in store calls', ('method',)))
+        self.sends = self.add(Counter(
+            'spybot_sends_total', 'Messages sent to Masters'))
+        self.retries = self.add(Counter(
+            'spybot_retries_total', 'Retried sends of messages'))
+        self.migrations = self.add(Counter(
+            'spybot_migrations_total', 'Report chats migrated to a new ID'))
+        self.removals = self.add(Counter(
+            'spybot_unauthorized_removals_total',
+            'Masters removed because the bot was blocked in a report chat'))
+        self.dropped_updates = self.add(Counter(
+            'spybot_dropped_updates_total',
+            'Updates dropped because the update queue was full',
+            ('priority',)))
+
+    def add(self, metric):
+        """ Register a metric.
+
+        Arguments:
+            metric (:obj:`_Metric`): a metric
+
+        Return:
+            :obj:`_Metric`: the metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Render all metrics in Prometheus text format.
+
+        Return:
+            :obj:`str`: a text of all metrics
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedStore(AbstractStore):
+    """ A store that measures the latency of calls to another store. """
+
+    def __init__(self, store, latency):
+        """ Wrap a store.
+
+        Arguments:
+            store (:obj:`bot.store.AbstractStore`): a store to wrap
+            latency (:obj:`Histogram`): a histogram with a ``method`` label
+        """
+        self._store = store
+        self._save_or_update_master = latency.labels('save_or_update_master')
+        self._get_master = latency.labels('get_master')
+        self._remove_master = latency.labels('remove_master')
+        self._subscribe = latency.labels('subscribe')
+        self._unsubscribe = latency.labels('unsubscribe')
+        self._get_subscribers = latency.labels('get_subscribers')
+        self._set_filters = latency.labels('set_filters')
+        self._get_filters = latency.labels('get_filters')
+        self._save_or_update_masters = latency.labels(
+            'save_or_update_masters')
+        self._subscribe_many = latency.labels('subscribe_many')
+        self._unsubscribe_many = latency.labels('unsubscribe_many')
+        self._get_subscribers_many = latency.labels('get_subscribers_many')
+        self._get_chats = latency.labels('get_chats')
+
+    def save_or_update_master(self, master_settings):
+        start = time.time()
+        try:
+            return self._store.save_or_update_master(master_settings)
+        finally:
+            self._save_or_update_master.observe(time.time() - start)
+
+    def get_master(self, master_id):
+        start = time.time()
+        try:
+            return self._store.get_master(master_id)
+        finally:
+            self._get_master.observe(time.time() - start)
+
+    def remove_master(self, master_id):
+        start = time.time()
+        try:
+            return self._store.remove_master(master_id)
+        finally:
+            self._remove_master.observe(time.time() - start)
+
+    def subscribe(self, master_id, chat_id):
+        start = time.time()
+        try:
+            return self._store.subscribe(master_id, chat_id)
+        finally:
+            self._subscribe.observe(time.time() - start)
+
+    def unsubscribe(self, chat_id, master_id=None):
+        start = time.time()
+        try:
+            return self._store.unsubscribe(chat_id, master_id)
+        finally:
+            self._unsubscribe.observe(time.time() - start)
+
+    def get_subscribers(self, chat_id):
+        start = time.time()
+        try:
+            return self._store.get_subscribers(chat_id)
+        finally:
+            self._get_subscribers.observe(time.time() - start)
+
+    def set_filters(self, master_id, chat_id, patterns):
+        start = time.time()
+        try:
+            return self._store.set_filters(master_id, chat_id, patterns)
+        finally:
+            self._set_filters.observe(time.time() - start)
+
+    def get_filters(self, chat_id):
+        start = time.time()
+        try:
+            return self._store.get_filters(chat_id)
+        finally:
+            self._get_filters.observe(time.time() - start)
+
+    def save_or_update_masters(self, masters_settings):
+        start = time.time()
+        try:
+            return self._store.save_or_update_masters(masters_settings)
+        finally:
+            self._save_or_update_masters.observe(time.time() - start)
+
+    def subscribe_many(self, subscriptions):
+        start = time.time()
+        try:
+            return self._store.subscribe_many(subscriptions)
+        finally:
+            self._subscribe_many.observe(time.time() - start)
+
+    def unsubscribe_many(self, subscriptions):
+        start = time.time()
+        try:
+            return self._store.unsubscribe_many(subscriptions)
+        finally:
+            self._unsubscribe_many.observe(time.time() - start)
+
+    def get_subscribers_many(self, chat_ids):
+        start = time.time()
+        try:
+            return self._store.get_subscribers_many(chat_ids)
+        finally:
+            self._get_subscribers_many.observe(time.time() - start)
+
+    def get_chats(self, master_id):
+        start = time.time()
+        try:
+            return self._store.get_chats(master_id)
+        finally:
+            self._get_chats.observe(time.time() - start)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be logged
+        pass
+
+
+class MetricsServer(object):
+    """ A local HTTP server exposing metrics at ``/metrics``. """
+
+    def __init__(self, metrics, port, listen='127.0.0.1'):
+        """ Create a new MetricsServer.
+
+        Arguments:
+            metrics (:obj:`Metrics`): metrics to serve
+            port (:obj:`int`): a port to listen on
+            listen (:obj:`str`): an address to listen on
+        """
+        self._log = logging.getLogger(MetricsServer.__name__)
+        self._httpd = HTTPServer((listen, port), _MetricsHandler)
+        self._httpd.metrics = metrics
+        self._thread = None
+
+    def start(self):
+        """ Start serving metrics in background. """
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        self._log.info("Serving metrics at http://%s:%s/metrics",
+                       *self._httpd.server_address[:2])
+
+    def stop(self):
+        """ Stop serving metrics. """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
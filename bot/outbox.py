@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+class OutboxRecord(object):
+    """ A delivery recorded in the outbox. """
+
+    def __init__(self, record_id, chat_id, text, master_ids, media=None):
+        """ Create a new OutboxRecord.
+
+        Arguments:
+            record_id (:obj:`int`): an id of the record in the outbox
+            chat_id (:obj:`int`): an id of a Telegram chat to send message to
+            text (:obj:`str`): a message text, or a caption of media
+            master_ids (:obj:`list`): Telegram user ids of the Masters the
+                message is delivered to
+            media (:obj:`dict`): (Optional) a description of media to send,
+                or a list of them
+        """
+        self.record_id = record_id
+        self.chat_id = chat_id
+        self.text = text
+        self.master_ids = master_ids
+        self.media = media
+
+    def to_json(self):
+        return json.dumps({'id': self.record_id,
+                           'chat_id': self.chat_id,
+                           'text': self.text,
+                           'master_ids': self.master_ids,
+                           'media': self.media})
+
+
+class Outbox(object):
+    """ An append-only on-disk journal of pending deliveries.
+
+    Every delivery is recorded before it is queued and acknowledged once it
+    has been sent or given up on, so deliveries that were pending when
+    the process died can be replayed on the next start. Records are written
+    and fsynced in batches by a background thread, so recording a delivery
+    costs no disk I/O on the caller's thread. A delivery sent right before
+    a crash may be sent again after the restart.
+
+    The journal is rewritten with pending records only once enough records
+    have been acknowledged.
+    """
+
+    # Seconds between writes of recorded deliveries to the disk
+    FLUSH_INTERVAL_SEC = 0.05
+    # A number of acknowledged records that triggers compaction
+    COMPACT_THRESHOLD = 10000
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL_SEC,
+                 compact_threshold=COMPACT_THRESHOLD):
+        """ Open or create an outbox.
+
+        Arguments:
+            path (:obj:`str`): a path to the outbox file
+            flush_interval (:obj:`float`): seconds between writes to the disk
+            compact_threshold (:obj:`int`): a number of acknowledged records
+                that triggers compaction
+        """
+        self._log = logging.getLogger(Outbox.__name__)
+        self._path = path
+        self._flush_interval = flush_interval
+        self._compact_threshold = compact_threshold
+
+        self._lock = threading.Lock()
+        # A map of record IDs to pending records in the order of IDs
+        self._pending = self._load(path)
+        self._next_id = max(self._pending) + 1 if self._pending else 1
+        # Records and acknowledged record IDs not written yet
+        self._buffer = []
+        self._acked = 0
+
+        self._file = open(path, 'ab')
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        """ Return a number of pending records. """
+        return len(self._pending)
+
+    def pending(self):
+        """ Return records that have not been acknowledged yet.
+
+        Return:
+            :obj:`list`: a list of ``OutboxRecord`` in the order they
+                were appended
+        """
+        with self._lock:
+            return list(self._pending.values())
+
+    def append(self, chat_id, text, master_ids, media=None):
+        """ Record a pending delivery.
+
+        Arguments:
+            chat_id (:obj:`int`): an id of a Telegram chat to send message to
+            text (:obj:`str`): a message text, or a caption of media
+            master_ids (:obj:`list`): Telegram user ids of the Masters the
+                message is delivered to
+            media (:obj:`dict`): (Optional) a description of media to send,
+                or a list of them
+
+        Return:
+            :obj:`int`: an id of the record
+        """
+        with self._lock:
+            record = OutboxRecord(self._next_id, chat_id, text,
+                                  list(master_ids), media)
+            self._next_id += 1
+            self._pending[record.record_id] = record
+            self._buffer.append(record)
+        return record.record_id
+
+    def ack(self, record_id):
+        """ Acknowledge a delivery has been sent or given up on.
+
+        Arguments:
+            record_id (:obj:`int`): an id of the record
+        """
+        with self._lock:
+            if self._pending.pop(record_id, None):
+                self._buffer.append(record_id)
+                self._acked += 1
+
+    def start(self):
+        """ Start writing records to the disk in background. """
+        self._thread = threading.Thread(target=self._run, name='outbox')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Write remaining records to the disk and close the outbox. """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._file.close()
+
+    def flush(self):
+        """ Write buffered records to the disk and compact the outbox if
+        enough records have been acknowledged.
+        """
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+            compact = self._acked >= self._compact_threshold
+
+        if buffer:
+            lines = [record.to_json() if isinstance(record, OutboxRecord)
+                     else json.dumps({'ack': record})
+                     for record in buffer]
+            self._file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+        if compact:
+            self._compact()
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self._log.exception("Failed to write the outbox %s",
+                                    self._path)
+
+    def _compact(self):
+        """ Atomically replace the outbox with a file of pending records.
+
+        Records appended after the buffer was taken end up both in the new
+        file and in the next batch, duplicates are dropped when loading.
+        """
+        with self._lock:
+            records = list(self._pending.values())
+            self._acked = 0
+
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'wb') as temp:
+            for record in records:
+                temp.write((record.to_json() + '\n').encode('utf-8'))
+            temp.flush()
+            os.fsync(temp.fileno())
+
+        self._file.close()
+        os.rename(temp_path, self._path)
+        # Make the rename durable
+        directory = os.open(os.path.dirname(os.path.abspath(self._path)),
+                            os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._file = open(self._path, 'ab')
+
+        self._log.info("Compacted the outbox %s to %s records",
+                       self._path, len(records))
+
+    @staticmethod
+    def _load(path):
+        """ Read pending records, and cut off a record torn in the middle of
+        a write, so that the next record is not appended to it.
+        """
+        pending = OrderedDict()
+        if not os.path.exists(path):
+            return pending
+
+        with open(path, 'rb') as journal:
+            position = 0
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    # A record torn by a crash in the middle of a write
+                    break
+                position += len(line)
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # A torn record that a later one was appended to
+                    continue
+
+                if 'ack' in entry:
+                    pending.pop(entry['ack'], None)
+                else:
+                    pending[entry['id']] = OutboxRecord(
+                        entry['id'], entry['chat_id'], entry['text'],
+                        entry['master_ids'], entry.get('media'))
+
+        if position < os.path.getsize(path):
+            with open(path, 'r+b') as journal:
+                journal.truncate(position)
+
+        return OrderedDict(sorted(pending.items()))
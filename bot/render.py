@@ -0,0 +1,133 @@
+import re
+import threading
+from collections import OrderedDict
+
+# Characters that have a meaning in Telegram Markdown outside of entities
+_MARKDOWN_CHARS = re.compile(r'([_*`\[])')
+# Italic entities cannot contain underscores, they are closed and reopened
+_ITALIC_UNDERSCORE = re.compile(r'_')
+
+
+def escape_markdown(text):
+    """ Escape text to be shown as is in a Telegram Markdown message.
+
+    Arguments:
+        text (:obj:`str`): a text to escape
+
+    Return:
+        :obj:`str`: the escaped text
+    """
+    return _MARKDOWN_CHARS.sub(r'\\\1', text)
+
+
+def italic(text):
+    """ Render text in italic in a Telegram Markdown message.
+
+    Arguments:
+        text (:obj:`str`): a text to render
+
+    Return:
+        :obj:`str`: the italic entity
+    """
+    return u'_{}_'.format(_ITALIC_UNDERSCORE.sub(r'_\\__', text))
+
+
+def user_link(user_id, name):
+    """ Render a link to a user profile in a Telegram Markdown message.
+
+    Arguments:
+        user_id (:obj:`int`): an id of a Telegram user
+        name (:obj:`str`): a text of the link
+
+    Return:
+        :obj:`str`: the link entity, or just the name if it cannot be a text
+            of a link
+    """
+    # Brackets cannot be escaped in a link text
+    if '[' in name or ']' in name:
+        return escape_markdown(name)
+    return u'[{}](tg://user?id={})'.format(name, user_id)
+
+
+class MessageRenderer(object):
+    """ Renders spied messages to be forwarded to Masters.
+
+    A message is rendered once no matter how many Masters receive it. The
+    header with the author and the chat rarely changes for a busy group, so
+    rendered headers are kept in a bounded LRU cache keyed by the chat and
+    the author, and rendered again only when their names change.
+    """
+
+    # A number of rendered headers to keep
+    CACHE_SIZE = 10000
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        """ Create a new MessageRenderer.
+
+        Arguments:
+            cache_size (:obj:`int`): a number of rendered headers to keep
+        """
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        # A map of (chat ID, user ID) to (names, rendered header)
+        self._headers = OrderedDict()
+
+    def __len__(self):
+        """ Return a number of cached headers. """
+        return len(self._headers)
+
+    def render(self, chat, user, text):
+        """ Render a message.
+
+        Arguments:
+            chat (:obj:`telegram.Chat`): a chat the message was sent to
+            user (:obj:`telegram.User`): an author of the message
+            text (:obj:`str`): a message text
+
+        Return:
+            :obj:`str`: a Markdown text to forward
+        """
+        return self.header(chat, user) + escape_markdown(text)
+
+    def header(self, chat, user):
+        """ Return a rendered header of a message.
+
+        Arguments:
+            chat (:obj:`telegram.Chat`): a chat the message was sent to
+            user (:obj:`telegram.User`): an author of the message
+
+        Return:
+            :obj:`str`: a Markdown header ending with a new line
+        """
+        key = (chat.id, user.id)
+        names = (chat.title, chat.username, user.first_name, user.last_name)
+
+        with self._lock:
+            cached = self._headers.pop(key, None)
+            if cached is not None and cached[0] == names:
+                # Move the header to the end of the LRU
+                self._headers[key] = cached
+                return cached[1]
+
+        header = MessageRenderer._render_header(chat, user)
+
+        with self._lock:
+            self._headers[key] = (names, header)
+            if len(self._headers) > self._cache_size:
+                self._headers.popitem(last=False)
+        return header
+
+    @staticmethod
+    def _render_header(chat, user):
+        # Use a reference to a chat whenever possible,
+        # otherwise just show chat name in italic
+        chat_ref = escape_markdown('@' + chat.username) if chat.username \
+            else italic(chat.title or 'Untitled')
+
+        # Show full user name whenever possible
+        user_name = user.first_name
+        if user.last_name:
+            user_name += ' ' + user.last_name
+
+        return u'{user} @ {chat}:\n'.format(
+            user=user_link(user.id, user_name), chat=chat_ref)
@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+# Priority classes of updates, from the most urgent one
+COMMAND = 0
+STATUS = 1
+FORWARD = 2
+PRIORITIES = ('command', 'status', 'forward')
+
+# Overload policies, applied when the queue of forwarded messages is full
+DROP_OLDEST = 'drop_oldest'
+DIGEST = 'digest'
+REJECT = 'reject'
+POLICIES = (DROP_OLDEST, DIGEST, REJECT)
+
+
+class PriorityUpdateQueue(object):
+    """ A queue of updates that hands out commands ahead of status updates,
+    and status updates ahead of spied messages to forward, so that a Master's
+    orders are not stuck behind a backlog of messages. Updates of the same
+    class are handed out in the order they were received.
+
+    Every class of updates is bounded. When spied messages to forward fill
+    their queue, an overload policy decides what happens to them:
+
+    - ``drop_oldest``: the oldest queued message is dropped
+    - ``reject``: the new message is dropped
+    - ``digest``: nothing is dropped, receiving updates waits for room in
+      the queue, and messages are forwarded in digests while the queue is
+      at least half full, so that they take fewer sends to catch up
+
+    Commands and status updates are never dropped, receiving them waits for
+    room instead. The queue can replace the update queue of an updater and
+    its dispatcher.
+    """
+
+    # A maximum number of queued updates of every class
+    MAX_SIZE = 10000
+
+    def __init__(self, classify, max_size=MAX_SIZE, policy=DIGEST,
+                 metrics=None):
+        """ Create a new PriorityUpdateQueue.
+
+        Arguments:
+            classify (:obj:`callable`): a function that returns a priority
+                class of an update
+            max_size (:obj:`int`): a maximum number of queued updates of
+                every class
+            policy (:obj:`str`): an overload policy of forwarded messages,
+                one of ``POLICIES``
+            metrics (:obj:`bot.metrics.Metrics`): (Optional) metrics to count
+                dropped updates in
+
+        Raises:
+            :obj:`ValueError`: if the policy is unknown
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown overload policy {}, expected one of {}"
+                             .format(policy, ', '.join(POLICIES)))
+
+        self._log = logging.getLogger(PriorityUpdateQueue.__name__)
+        self._classify = classify
+        self._max_size = max_size
+        self._policy = policy
+        self._dropped = [metrics.dropped_updates.labels(name)
+                         for name in PRIORITIES] \
+            if metrics is not None else None
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # Queues of updates by priority classes
+        self._queues = [deque() for _ in PRIORITIES]
+        # Time the last warning about dropped updates was logged
+        self._warned = 0
+
+    def __len__(self):
+        """ Return a number of queued updates. """
+        return sum(len(queue) for queue in self._queues)
+
+    @property
+    def policy(self):
+        """ Return the overload policy. """
+        return self._policy
+
+    @property
+    def depths(self):
+        """ Return numbers of queued updates by priority classes.
+
+        Return:
+            :obj:`dict`: a map of names of priority classes to numbers of
+                queued updates
+        """
+        return dict((name, len(queue))
+                    for name, queue in zip(PRIORITIES, self._queues))
+
+    @property
+    def overloaded(self):
+        """ Return whether forwarded messages should be collected into
+        digests to catch up with the backlog.
+        """
+        return self._policy == DIGEST and \
+            len(self._queues[FORWARD]) * 2 >= self._max_size
+
+    def put(self, update):
+        """ Queue an update. Blocks while the queue of its class is full,
+        unless the update can be dropped.
+
+        Arguments:
+            update (:obj:`telegram.Update`): an update, or an error to pass
+                to error handlers
+        """
+        priority = self._classify(update)
+        with self._lock:
+            queue = self._queues[priority]
+            if len(queue) >= self._max_size:
+                if priority == FORWARD and self._policy == DROP_OLDEST:
+                    queue.popleft()
+                    self._drop(priority)
+                elif priority == FORWARD and self._policy == REJECT:
+                    self._drop(priority)
+                    return
+                else:
+                    while len(queue) >= self._max_size:
+                        self._not_full.wait()
+
+            queue.append(update)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """ Take the most urgent update.
+
+        Arguments:
+            block (:obj:`bool`): whether to wait for an update
+            timeout (:obj:`float`): (Optional) seconds to wait for
+
+        Return:
+            :obj:`telegram.Update`: the update
+
+        Raises:
+            :obj:`queue.Empty`: if there is no update to take
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while True:
+                for queue in self._queues:
+                    if queue:
+                        update = queue.popleft()
+                        self._not_full.notify_all()
+                        return update
+
+                if not block:
+                    raise Empty
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+
+    def _drop(self, priority):
+        """ Count a dropped update. Called with the lock held. """
+        if self._dropped is not None:
+            self._dropped[priority].inc()
+        now = time.time()
+        # Do not flood the log while overloaded
+        if now - self._warned >= 60:
+            self._warned = now
+            self._log.warning("Update queue is full, dropping %s updates "
+                              "with the %s policy",
+                              PRIORITIES[priority], self._policy)
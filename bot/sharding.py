@@ -0,0 +1,197 @@
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+
+from telegram import Update
+from telegram.ext import Updater, TypeHandler
+
+from scheduling import DIGEST, PriorityUpdateQueue
+from spybot import SpyBot
+
+# A maximum number of updates a worker processes as a batch
+_BATCH_SIZE = 100
+# Seconds a worker waits for updates before it checks whether to stop
+_POLL_SEC = 0.5
+
+
+def _receive(spybot, updates, received):
+    """ Pass updates from the ingestion process to the bot's queue, where
+    they are ordered by priority. Runs in a worker process.
+
+    Arguments:
+        spybot (:obj:`bot.spybot.SpyBot`): the bot of the worker
+        updates (:obj:`multiprocessing.Queue`): a queue of updates in JSON
+        received (:obj:`threading.Event`): an event set once all updates
+            have been received
+    """
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                return
+            spybot.queue_update(Update.de_json(json.loads(data), spybot.bot))
+    finally:
+        received.set()
+
+
+def _run_worker(make_bot, shard, updates):
+    """ Process updates of a single shard. Runs in a worker process.
+
+    Arguments:
+        make_bot (:obj:`callable`): a function that creates a ``SpyBot``
+            for a shard number
+        shard (:obj:`int`): a shard number
+        updates (:obj:`multiprocessing.Queue`): a queue of updates in JSON
+    """
+    # Workers are stopped by the ingestion process rather than by Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    spybot = make_bot(shard)
+    spybot.start()
+    try:
+        received = threading.Event()
+        receiver = threading.Thread(target=_receive,
+                                    args=(spybot, updates, received),
+                                    name='receiver')
+        receiver.daemon = True
+        receiver.start()
+
+        while True:
+            # All updates are queued once they have been received
+            done = received.is_set()
+            # Take all updates that have arrived, so that they are processed
+            # as a batch
+            if not spybot.process_queued(_BATCH_SIZE, timeout=_POLL_SEC) \
+                    and done:
+                return
+    finally:
+        spybot.stop()
+
+
+class ShardedSpyBot(object):
+    """ Runs the SpyBot in several worker processes.
+
+    A single ingestion process receives updates and routes each of them to
+    a worker process by the ID of the chat it came from, so updates of the
+    same chat are handled by the same worker in the order they were
+    received. Every worker runs its own ``SpyBot`` with its own delivery
+    queue, so workers should share a store that works across processes, like
+    ``bot.store.SqliteStore``, and limits of chats they may all send to, see
+    ``bot.delivery.SharedChatLimits``.
+
+    Both the ingestion process and the workers take updates by priority,
+    so commands are not stuck behind spied messages on the way to
+    a worker or in it.
+    """
+
+    # A number of updates waiting for a worker before ingestion blocks
+    QUEUE_SIZE = 10000
+
+    def __init__(self, token, make_bot, workers, queue_size=QUEUE_SIZE,
+                 update_queue_size=PriorityUpdateQueue.MAX_SIZE,
+                 overload_policy=DIGEST):
+        """ Create a new ShardedSpyBot.
+
+        Arguments:
+            token (:obj:`str`): a bot token issued by BotFather
+            make_bot (:obj:`callable`): a function that creates a ``SpyBot``
+                for a shard number. Called in a worker process.
+            workers (:obj:`int`): a number of worker processes
+            queue_size (:obj:`int`): a number of updates waiting for
+                a worker before ingestion blocks
+            update_queue_size (:obj:`int`): a maximum number of received
+                updates of every priority class waiting to be routed, see
+                ``bot.scheduling.PriorityUpdateQueue``. Workers should
+                limit their bots the same way.
+            overload_policy (:obj:`str`): what to do with spied messages
+                when their queue is full, see
+                ``bot.scheduling.PriorityUpdateQueue``
+        """
+        self._log = logging.getLogger(ShardedSpyBot.__name__)
+        self._make_bot = make_bot
+        self._queues = [multiprocessing.Queue(queue_size)
+                        for _ in range(workers)]
+        self._processes = []
+
+        self._updater = Updater(token=token)
+        updates = PriorityUpdateQueue(SpyBot.classify,
+                                      max_size=update_queue_size,
+                                      policy=overload_policy)
+        self._updater.update_queue = updates
+        self._updater.dispatcher.update_queue = updates
+        self._updater.dispatcher.add_handler(TypeHandler(Update, self._route))
+
+    def run(self):
+        """ Run the bot receiving updates with long polling. """
+        self._run(self._updater.start_polling)
+
+    def run_webhook(self, webhook_url, listen='0.0.0.0', port=8443,
+                    url_path='', cert=None, key=None):
+        """ Run the bot receiving updates through a webhook.
+
+        See ``SpyBot.run_webhook`` for the arguments.
+        """
+        def start_webhook():
+            self._updater.start_webhook(listen=listen, port=port,
+                                        url_path=url_path, cert=cert,
+                                        key=key, webhook_url=webhook_url)
+            # The updater registers the webhook only when it serves TLS
+            if not (cert and key):
+                self._updater.bot.set_webhook(url=webhook_url)
+
+        self._run(start_webhook)
+
+    def _run(self, start_updates):
+        """ Run the bot until it is interrupted.
+
+        Arguments:
+            start_updates (:obj:`callable`): a function that starts
+                receiving updates
+        """
+        self._log.info("Starting the SpyBot with %s workers...",
+                       len(self._queues))
+        self.start()
+        try:
+            start_updates()
+            self._updater.idle()
+        finally:
+            self.stop()
+
+    def start(self):
+        """ Start worker processes. """
+        for shard, updates in enumerate(self._queues):
+            process = multiprocessing.Process(
+                target=_run_worker, args=(self._make_bot, shard, updates),
+                name='spybot-{}'.format(shard))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+    def stop(self):
+        """ Stop worker processes once they have handled queued updates. """
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join()
+        self._processes = []
+
+    def process_update(self, update):
+        """ Route an update received by other means than the updater.
+
+        Arguments:
+            update (:obj:`telegram.Update`): An update from the server
+        """
+        self._route(self._updater.bot, update)
+
+    def _route(self, bot, update):
+        """ Pass an update to the worker of its chat.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            update (:obj:`telegram.Update`): An update from the server
+        """
+        chat = update.effective_chat
+        shard = chat.id % len(self._queues) if chat else 0
+        self._queues[shard].put(update.to_json())
@@ -0,0 +1,284 @@
+import gc
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from contextlib import contextmanager
+
+
+def _int64_typecode():
+    # 'q' is not available in Python 2, where 'l' is 64-bit on Unix
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    raise ImportError("No 64-bit integer arrays on this platform")
+
+
+INT64 = _int64_typecode()
+
+# A magic number, a byte order mark, a generation, numbers of Masters,
+# chats, Masters with subscriptions and subscriptions, and a size of filters.
+# Chats of Masters are derived from subscribers of chats, they are written
+# by earlier versions only.
+_HEADER = struct.Struct('=8s7q')
+_MAGIC = b'SPYSNAP1'
+
+
+@contextmanager
+def collections_paused():
+    """ Pause garbage collection while millions of new objects are built,
+    which would trigger needless collections.
+    """
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def _from_bytes(data):
+    values = array(INT64)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+def _to_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') \
+        else values.tostring()
+
+
+class Snapshot(object):
+    """ A snapshot of Masters, subscriptions and filters.
+
+    A snapshot is stored in a compact binary format of native 64-bit integer
+    arrays, so it is written and loaded without parsing every value:
+
+    - a header with a generation of the snapshot and sizes of arrays
+    - a master ID, a report chat ID and a digest flag of every Master
+    - chat IDs, numbers of their subscribers and subscribers' IDs
+    - filters in JSON
+    """
+
+    def __init__(self, generation, masters, chats, filters):
+        """ Create a new Snapshot.
+
+        Arguments:
+            generation (:obj:`int`): a number of the snapshot
+            masters (:obj:`array`): triples of a Master ID, a report chat ID
+                and a digest flag
+            chats (:obj:`dict`): a map of chat IDs to sets of Master IDs.
+                Loaded sets are frozen.
+            filters (:obj:`dict`): a map of chat IDs to maps of Master IDs
+                to tuples of patterns
+        """
+        self.generation = generation
+        self.masters = masters
+        self.chats = chats
+        self.filters = filters
+
+    def pack(self):
+        """ Serialize the snapshot.
+
+        Return:
+            :obj:`list`: chunks of bytes to write
+        """
+        filters = json.dumps(dict(
+            (str(chat_id), dict((str(master_id), list(patterns))
+                                for master_id, patterns in chat.items()))
+            for chat_id, chat in self.filters.items())).encode('utf-8')
+        subscriptions = sum(len(members) for members in self.chats.values())
+
+        chat_ids = list(self.chats)
+        sizes = array(INT64)
+        members = array(INT64)
+        for chat_id in chat_ids:
+            subscribers = self.chats[chat_id]
+            sizes.append(len(subscribers))
+            members.extend(subscribers)
+        return [_HEADER.pack(_MAGIC, 1, self.generation,
+                             len(self.masters) // 3, len(chat_ids), 0,
+                             subscriptions, len(filters)),
+                _to_bytes(self.masters), _to_bytes(array(INT64, chat_ids)),
+                _to_bytes(sizes), _to_bytes(members), filters]
+
+    @staticmethod
+    def save(path, chunks):
+        """ Atomically replace a snapshot file with a packed snapshot.
+
+        Arguments:
+            path (:obj:`str`): a path to the snapshot file
+            chunks (:obj:`list`): chunks of bytes returned by ``pack``
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as snapshot:
+            for chunk in chunks:
+                snapshot.write(chunk)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+
+        os.rename(temp_path, path)
+        # Make the rename durable
+        directory = os.open(os.path.dirname(os.path.abspath(path)),
+                            os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    @staticmethod
+    def read(path):
+        """ Load a snapshot file.
+
+        Arguments:
+            path (:obj:`str`): a path to the snapshot file
+
+        Return:
+            :obj:`Snapshot`: the snapshot
+
+        Raises:
+            :obj:`ValueError`: if the file is not a snapshot
+        """
+        with open(path, 'rb') as snapshot:
+            try:
+                data = mmap.mmap(snapshot.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # An empty file cannot be mapped
+                raise ValueError("{} is not a snapshot".format(path))
+        try:
+            try:
+                magic, byte_order, generation, masters, chats, \
+                    master_chats, subscriptions, filters_size = \
+                    _HEADER.unpack_from(data, 0)
+            except struct.error:
+                raise ValueError("{} is not a snapshot".format(path))
+            if magic != _MAGIC or byte_order != 1:
+                raise ValueError("{} is not a snapshot of this platform"
+                                 .format(path))
+
+            offset = [_HEADER.size]
+
+            def read_ints(count):
+                start = offset[0]
+                offset[0] += count * 8
+                if offset[0] > len(data):
+                    raise ValueError("{} is truncated".format(path))
+                return _from_bytes(data[start:offset[0]])
+
+            masters = read_ints(masters * 3)
+            chat_ids = read_ints(chats)
+            sizes = read_ints(chats)
+            members = read_ints(subscriptions).tolist()
+            # Chats of Masters written by earlier versions are skipped
+            if master_chats:
+                offset[0] += (master_chats * 2 + subscriptions) * 8
+
+            chats = dict()
+            with collections_paused():
+                position = 0
+                for chat_id, size in zip(chat_ids, sizes):
+                    chats[chat_id] = frozenset(
+                        members[position:position + size])
+                    position += size
+
+            if offset[0] + filters_size > len(data):
+                raise ValueError("{} is truncated".format(path))
+            filters = json.loads(
+                data[offset[0]:offset[0] + filters_size].decode('utf-8'))
+        finally:
+            data.close()
+
+        filters = dict(
+            (int(chat_id), dict((int(master_id), tuple(patterns))
+                                for master_id, patterns in chat.items()))
+            for chat_id, chat in filters.items())
+        return Snapshot(generation, masters, chats, filters)
+
+
+class DeltaLog(object):
+    """ A log of changes made since a snapshot.
+
+    Every change is a JSON line with a name of a store method, its arguments
+    and a generation of the snapshot it follows. When a new snapshot is
+    taken, the log is rotated: changes are written to a new file, which
+    replaces the old one once the snapshot is written. Changes are flushed
+    to the OS but not fsynced, so they survive a crash of the process but
+    not of the machine.
+    """
+
+    def __init__(self, path):
+        """ Open a delta log for appending.
+
+        Arguments:
+            path (:obj:`str`): a path to the log file
+        """
+        self._log = logging.getLogger(DeltaLog.__name__)
+        self._path = path
+        self._file = open(path, 'ab')
+
+    def append(self, generation, method, args, kwargs):
+        """ Record a change.
+
+        Arguments:
+            generation (:obj:`int`): a generation of the last snapshot
+            method (:obj:`str`): a name of a store method
+            args (:obj:`list`): JSON-serializable arguments
+            kwargs (:obj:`dict`): JSON-serializable keyword arguments
+        """
+        self._file.write((json.dumps({'g': generation, 'op': method,
+                                      'args': args, 'kwargs': kwargs}) +
+                          '\n').encode('utf-8'))
+        self._file.flush()
+
+    def rotate(self):
+        """ Start writing changes to a new file. Called when a snapshot
+        is taken, before it is written.
+        """
+        self._file.close()
+        self._file = open(self._path + '.new', 'wb')
+
+    def commit(self):
+        """ Replace the log with the new file. Called once a snapshot
+        has been written.
+        """
+        os.rename(self._path + '.new', self._path)
+
+    def close(self):
+        self._file.close()
+
+    def replay(self, generation):
+        """ Return changes made since a snapshot.
+
+        Arguments:
+            generation (:obj:`int`): a generation of the snapshot
+
+        Return:
+            :obj:`list`: tuples of a method name, arguments and keyword
+                arguments in the order the changes were made
+        """
+        changes = []
+        # A new file is left if the process died while taking a snapshot
+        for path in (self._path, self._path + '.new'):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # A change torn by a crash in the middle of a write
+                        continue
+                    if entry['g'] >= generation:
+                        changes.append((entry['op'], entry['args'],
+                                        entry['kwargs']))
+        return changes
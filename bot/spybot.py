@@ -1,11 +1,27 @@
 import logging
 import time
+from datetime import datetime
+from queue import Empty
 
-from telegram import ParseMode
+from telegram import Bot, InputMediaPhoto, InputMediaVideo, ParseMode, \
+    Update
+from telegram.constants import MAX_CAPTION_LENGTH
 from telegram.error import *
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.utils.helpers import to_timestamp
+from telegram.utils.request import Request
 
+from delivery import Delivery, Redirected, SenderPool
+from digest import DigestBuffer, split_message
+from filters import MAX_PATTERNS, FilterIndex, parse_pattern
+from media import ALBUM_TYPES, CAPTIONED_TYPES, AlbumBuffer, MediaCache, \
+    video_note
+from metrics import Gauge, InstrumentedStore, Metrics
+from render import MessageRenderer, escape_markdown, italic, user_link
+from scheduling import COMMAND, DIGEST, FORWARD, STATUS, \
+    PriorityUpdateQueue
 from store import MasterSettings, InMemoryStore
+from tracing import TracedStore, Tracer
 
 logging.basicConfig(
     format='%(asctime)s - [%(levelname)s] - %(name)s - %(message)s',
@@ -16,10 +32,13 @@ class SpyBot(object):
     """ A Telegram bot that listens to all text messages in groups where he is
     a member and forwards these messages to the specified channel."""
 
-    # A delay between forwards of a message from a group to all subscribers.
-    # Required to avoid hitting Telegram message limits. More details at
-    # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
-    _FORWARD_DELAY_SEC = 0.1  # 100ms
+    # A number of threads sending forwarded messages with every bot
+    _DELIVERY_WORKERS = 4
+
+    # Messages forwarded to Masters
+    _FORWARDED = Filters.group & (
+        Filters.text | Filters.photo | Filters.video | Filters.document |
+        Filters.audio | Filters.voice | Filters.sticker | video_note)
 
     # Commands
     _START_CMD = 'start'
@@ -27,6 +46,12 @@ class SpyBot(object):
     _SPY_CMD = 'spy'
     _DISMISS_CMD = 'dismiss'
     _REPORT_HERE_CMD = 'report_here'
+    _DIGEST_CMD = 'digest'
+    _FILTER_CMD = 'filter'
+    _SEARCH_CMD = 'search'
+
+    # Characters of a message text shown in search results
+    _SEARCH_TEXT_LENGTH = 300
 
     _HELP = """
 Greetings, Master! I am SpyBot. I can help you to track what people are \
@@ -40,32 +65,406 @@ watching this chat or group.
 group or chat.
  * If you want to change the destination where my reports are getting sent, \
 issue a /{report_here} command in the new destination chat.
+ * Use a /{digest} command to receive reports in digests instead of one by \
+one, and a /{digest} off command to get every report at once again.
+ * Use a /{filter} command with keywords in a chat to get only messages \
+that mention any of them, and a /{filter} command without \
+arguments to get all messages again.
+ * Use a /{search} command with words to find messages with all of them in \
+the groups I spy on for you, and add a group title or ID as the last word to \
+search only in that group.
 
 Easy, isn't it? Try it now. I'm awaiting your orders.
     """.format(start=_START_CMD,
                spy=_SPY_CMD,
                dismiss=_DISMISS_CMD,
-               report_here=_REPORT_HERE_CMD)
+               report_here=_REPORT_HERE_CMD,
+               digest=_DIGEST_CMD,
+               filter=_FILTER_CMD,
+               search=_SEARCH_CMD)
 
-    def __init__(self, token, store=InMemoryStore()):
+    def __init__(self, token=None, store=InMemoryStore(),
+                 digest_window=DigestBuffer.WINDOW_SEC,
+                 digest_size=DigestBuffer.MAX_SIZE,
+                 outbox=None, bot=None, rate_limits=None, metrics=None,
+                 queue_size=PriorityUpdateQueue.MAX_SIZE,
+                 overload_policy=DIGEST, archive=None, sender_tokens=None,
+                 sender_bots=None, tracer=None, profiler=None):
         """ Creates a new instance of SpyBot.
 
         Arguments:
-            token (:obj:`str`): a bot token issued by BotFather
+            token (:obj:`str`): a bot token issued by BotFather. Mutually
+                exclusive with ``bot``.
             store (:obj:`bot.store.AbstractStore`): a type of a persistent
                 store to use for the bot. Defaults to an in-memory store.
+            digest_window (:obj:`float`): seconds to collect messages for
+                before a digest is sent to a Master
+            digest_size (:obj:`int`): characters to collect before a digest
+                is sent to a Master regardless of the window
+            outbox (:obj:`bot.outbox.Outbox`): (Optional) an outbox to record
+                pending deliveries in, so that they survive a restart
+            bot (:obj:`telegram.Bot`): (Optional) a bot to use instead of
+                creating one from the token
+            rate_limits (:obj:`dict`): (Optional) message limits to use
+                instead of the Telegram ones, see
+                ``bot.delivery.DeliveryQueue`` for the keys. Every sender
+                bot is limited on its own.
+            metrics (:obj:`bot.metrics.Metrics`): (Optional) metrics to
+                collect the bot's performance into
+            queue_size (:obj:`int`): a maximum number of received updates of
+                every priority class waiting to be handled
+            overload_policy (:obj:`str`): what to do with spied messages
+                when their queue is full, see
+                ``bot.scheduling.PriorityUpdateQueue``
+            archive (:obj:`bot.archive.MessageArchive`): (Optional) an
+                archive to keep forwarded messages in for searches
+            sender_tokens (:obj:`list`): (Optional) tokens of bots to send
+                forwarded messages with, each within its own rate limits,
+                instead of the bot receiving updates. Mutually exclusive with
+                ``sender_bots``.
+            sender_bots (:obj:`list`): (Optional) ``telegram.Bot`` instances
+                to use instead of creating them from the sender tokens
+            tracer (:obj:`bot.tracing.Tracer`): (Optional) a tracer to record
+                spans of handling updates with. It is closed when the bot
+                is stopped.
+            profiler (:obj:`bot.tracing.SamplingProfiler`): (Optional)
+                a profiler to run while the bot is started
         """
         self._log = logging.getLogger(SpyBot.__name__)
-        self._store = store
-        self._updater = Updater(token=token)
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._tracer = tracer if tracer is not None else Tracer()
+        if self._tracer.enabled:
+            store = TracedStore(store, self._tracer)
+        self._store = InstrumentedStore(store, self._metrics.store_latency)
+        self._outbox = outbox
+        self._archive = archive
+        self._profiler = profiler
+        self._renderer = MessageRenderer()
+        self._media = MediaCache()
+        self._filters = FilterIndex(self._store)
+        self._timed_forward = self._timed(self._forward)
+        if bot is not None:
+            self._updater = Updater(bot=bot)
+        else:
+            # Reserve an HTTP connection for every delivery worker on top of
+            # the connections used by the updater itself
+            self._updater = Updater(token=token, request_kwargs={
+                'con_pool_size': 8 + SpyBot._DELIVERY_WORKERS
+            })
         self._dispatcher = self._updater.dispatcher
+        # Received updates are handled by priority rather than in order
+        self._updates = PriorityUpdateQueue(SpyBot.classify,
+                                            max_size=queue_size,
+                                            policy=overload_policy,
+                                            metrics=self._metrics)
+        self._updater.update_queue = self._updates
+        self._dispatcher.update_queue = self._updates
+        if sender_bots is None and sender_tokens:
+            # Every sender has HTTP connections of its own
+            sender_bots = [Bot(sender_token, request=Request(
+                con_pool_size=SpyBot._DELIVERY_WORKERS + 1))
+                for sender_token in sender_tokens]
+        # Media and chats that refused a sender, e.g. a Master has not
+        # started it or added it to the group, are sent by the main bot
+        self._deliveries = SenderPool(sender_bots or [self._updater.bot],
+                                      self._send, done=self._delivered,
+                                      workers=SpyBot._DELIVERY_WORKERS,
+                                      metrics=self._metrics,
+                                      main_bot=self._updater.bot,
+                                      **(rate_limits or {}))
+        self._digests = DigestBuffer(self._send_digest,
+                                     window=digest_window,
+                                     max_size=digest_size)
+        self._updater.job_queue.run_repeating(
+            self._flush_digests, interval=min(1, digest_window))
+        self._albums = AlbumBuffer(self._forward_album)
+        self._updater.job_queue.run_repeating(
+            self._flush_albums, interval=AlbumBuffer.WAIT_SEC / 2)
+        if self._tracer.enabled:
+            self._updater.job_queue.run_repeating(
+                self._flush_traces, interval=Tracer.FLUSH_INTERVAL_SEC)
         self._add_handlers()
-        self._dispatcher.add_error_handler(self._error)
+        self._dispatcher.add_error_handler(self._timed(self._error))
+        self._add_gauges()
 
     def run(self):
+        """ Run the bot receiving updates with long polling. """
+        self._run(self._updater.start_polling)
+
+    def run_webhook(self, webhook_url, listen='0.0.0.0', port=8443,
+                    url_path='', cert=None, key=None):
+        """ Run the bot receiving updates through a webhook.
+
+        See ``start_webhook`` for the arguments.
+        """
+        self._run(lambda: self.start_webhook(webhook_url, listen=listen,
+                                             port=port, url_path=url_path,
+                                             cert=cert, key=key))
+
+    def start_webhook(self, webhook_url, listen='0.0.0.0', port=8443,
+                      url_path='', cert=None, key=None):
+        """ Start receiving updates through a webhook. Returns at once, the
+        updates are received until the bot is stopped.
+
+        Updates are received by a local HTTP server. If a certificate is not
+        set, TLS should be terminated by a reverse proxy in front of it.
+
+        Arguments:
+            webhook_url (:obj:`str`): a public URL Telegram sends updates to
+            listen (:obj:`str`): an address to listen on
+            port (:obj:`int`): a port to listen on
+            url_path (:obj:`str`): a path of the local webhook endpoint
+            cert (:obj:`str`): (Optional) a path to a TLS certificate file
+            key (:obj:`str`): (Optional) a path to a TLS private key file
+        """
+        self._updater.start_webhook(listen=listen, port=port,
+                                    url_path=url_path, cert=cert, key=key,
+                                    webhook_url=webhook_url)
+        # The updater registers the webhook only when it serves TLS
+        if not (cert and key):
+            self._updater.bot.set_webhook(url=webhook_url)
+
+    def _run(self, start_updates):
+        """ Run the bot until it is interrupted.
+
+        Arguments:
+            start_updates (:obj:`callable`): a function that starts
+                receiving updates
+        """
         self._log.info("Starting the SpyBot...")
-        self._updater.start_polling()
-        self._updater.idle()
+        self.start()
+        try:
+            start_updates()
+            self._updater.idle()
+        finally:
+            self.stop()
+
+    def start(self):
+        """ Start sending messages without receiving updates.
+
+        Updates can be passed to the bot with ``process_update``.
+        """
+        if self._profiler is not None:
+            self._profiler.start()
+        if self._outbox is not None:
+            self._outbox.start()
+            self._replay_outbox()
+        if self._archive is not None:
+            self._archive.start()
+        self._deliveries.start()
+        self._updater.job_queue.start()
+
+    def stop(self):
+        """ Stop receiving updates and sending messages. """
+        if self._updater.running:
+            self._updater.stop()
+        self._updater.job_queue.stop()
+        # Collected albums are kept in the outbox until the next start
+        self._albums.flush_all()
+        self._deliveries.stop()
+        if self._outbox is not None:
+            self._outbox.stop()
+        if self._archive is not None:
+            self._archive.stop()
+        # Workers of a sharded bot exit without running exit handlers
+        self._tracer.close()
+        if self._profiler is not None:
+            self._profiler.stop()
+
+    @property
+    def bot(self):
+        """ Return a ``telegram.Bot`` the SpyBot sends messages with. """
+        return self._updater.bot
+
+    def process_update(self, update):
+        """ Process an update received by other means than the updater.
+
+        Arguments:
+            update (:obj:`telegram.Update`): An update from the server
+        """
+        self._dispatcher.process_update(update)
+
+    def process_updates(self, updates):
+        """ Process a batch of updates received by other means than
+        the updater.
+
+        Subscribers of all chats in a run of consecutive spied messages are
+        looked up with a single store call. Other updates, like commands,
+        may change subscriptions, so they end a run.
+
+        Arguments:
+            updates (:obj:`list`): Updates from the server in the order
+                they were received
+        """
+        run = []
+        for update in updates:
+            if update.message is not None and \
+                    SpyBot._FORWARDED(update.message):
+                run.append(update)
+                continue
+
+            self._process_run(run)
+            run = []
+            self.process_update(update)
+        self._process_run(run)
+
+    def queue_update(self, update):
+        """ Queue an update received by other means than the updater, to be
+        processed by ``process_queued`` by priority. Blocks or drops spied
+        messages by the overload policy when their queue is full.
+
+        Arguments:
+            update (:obj:`telegram.Update`): An update from the server
+        """
+        self._updates.put(update)
+
+    def process_queued(self, max_updates, timeout=None):
+        """ Process a batch of queued updates, the most urgent ones first.
+
+        Arguments:
+            max_updates (:obj:`int`): a maximum number of updates to process
+            timeout (:obj:`float`): (Optional) seconds to wait for an update
+
+        Return:
+            :obj:`int`: a number of processed updates, zero if none arrived
+                in time
+        """
+        try:
+            batch = [self._updates.get(True, timeout)]
+        except Empty:
+            return 0
+        while len(batch) < max_updates:
+            try:
+                batch.append(self._updates.get(False))
+            except Empty:
+                break
+        self.process_updates(batch)
+        return len(batch)
+
+    def _process_run(self, updates):
+        """ Process spied messages with their subscribers looked up at once.
+
+        Arguments:
+            updates (:obj:`list`): Updates with spied messages
+        """
+        if len(updates) < 2:
+            for update in updates:
+                self.process_update(update)
+            return
+
+        prefetched = self._store.get_subscribers_many(
+            set(update.effective_chat.id for update in updates))
+        for update in updates:
+            # Spied messages always reach the forward handler, so it is
+            # called directly, handling errors the way the dispatcher does
+            try:
+                self._timed_forward(self.bot, update, prefetched=prefetched)
+            except TelegramError as error:
+                self._log.warning("A TelegramError was raised while "
+                                  "processing the update")
+                try:
+                    self._dispatcher.dispatch_error(update, error)
+                except Exception:
+                    self._log.exception("An uncaught error was raised while "
+                                        "handling the error")
+            except Exception:
+                self._log.exception("An uncaught error was raised while "
+                                    "processing the update")
+
+    @staticmethod
+    def classify(update):
+        """ Return a priority class of a received update.
+
+        Arguments:
+            update (:obj:`telegram.Update`): An update from the server, or an
+                error passed to error handlers
+
+        Return:
+            :obj:`int`: a priority class from ``bot.scheduling``
+        """
+        message = update.message if isinstance(update, Update) else None
+        if message is None:
+            return STATUS
+        if Filters.command(message):
+            return COMMAND
+        if SpyBot._FORWARDED(message):
+            return FORWARD
+        return STATUS
+
+    def _replay_outbox(self):
+        """ Queue deliveries that were pending when the bot was stopped.
+
+        Replayed deliveries are queued before any new update is processed,
+        so they are sent ahead of new messages to the same chats.
+        """
+        records = self._outbox.pending()
+        if records:
+            self._log.info("Replaying %s pending deliveries", len(records))
+        for record in records:
+            self._deliveries.put(Delivery(record.chat_id, record.text,
+                                          record.master_ids,
+                                          outbox_id=record.record_id,
+                                          media=record.media))
+
+    def _add_gauges(self):
+        """ Add metrics of the bot's backlog. """
+        self._metrics.add(Gauge(
+            'spybot_delivery_backlog',
+            'Messages waiting to be sent',
+            lambda: len(self._deliveries)))
+        self._metrics.add(Gauge(
+            'spybot_update_queue_depth',
+            'Received updates waiting to be handled by priority classes',
+            lambda: dict(((name,), depth) for name, depth
+                         in self._updates.depths.items()),
+            label_names=('priority',)))
+        self._metrics.add(Gauge(
+            'spybot_update_queue_overloaded',
+            'Whether spied messages are forwarded in digests to catch up',
+            lambda: int(self._updates.overloaded)))
+        self._metrics.add(Gauge(
+            'spybot_active_senders',
+            'Bots sending forwarded messages',
+            lambda: self._deliveries.active))
+        self._metrics.add(Gauge(
+            'spybot_open_circuits',
+            'Report chats with deliveries paused after repeated failures',
+            lambda: self._deliveries.open_circuits))
+        self._metrics.add(Gauge(
+            'spybot_digest_backlog',
+            'Report chats with digests being collected',
+            lambda: len(self._digests)))
+        if self._outbox is not None:
+            self._metrics.add(Gauge(
+                'spybot_outbox_pending',
+                'Deliveries recorded in the outbox and not sent yet',
+                lambda: len(self._outbox)))
+
+    def _timed(self, callback):
+        """ Wrap a handler callback to measure its latency and trace
+        the update it handles.
+
+        Arguments:
+            callback (:obj:`callable`): A handler callback
+
+        Return:
+            :obj:`callable`: a callback with the same arguments
+        """
+        name = callback.__name__.lstrip('_')
+        latency = self._metrics.handler_latency.labels(name)
+        tracer = self._tracer
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                # Handlers are called with a bot and an update
+                with tracer.trace('handler.' + name, update_id=getattr(
+                        args[1], 'update_id', None)):
+                    return callback(*args, **kwargs)
+            finally:
+                latency.observe(time.time() - start)
+
+        return timed
 
     def _add_handlers(self):
         """ Add Telegram updates handlers.
@@ -76,23 +475,38 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
         # Command handlers
         self._dispatcher.add_handler(CommandHandler(
             command=SpyBot._START_CMD,
-            callback=self._start_cmd
+            callback=self._timed(self._start_cmd)
         ))
         self._dispatcher.add_handler(CommandHandler(
             command=SpyBot._HELP_CMD,
-            callback=self._help_cmd
+            callback=self._timed(self._help_cmd)
         ))
         self._dispatcher.add_handler(CommandHandler(
             command=SpyBot._SPY_CMD,
-            callback=self._spy_cmd
+            callback=self._timed(self._spy_cmd)
         ))
         self._dispatcher.add_handler(CommandHandler(
             command=SpyBot._DISMISS_CMD,
-            callback=self._dismiss_cmd
+            callback=self._timed(self._dismiss_cmd)
         ))
         self._dispatcher.add_handler(CommandHandler(
             command=SpyBot._REPORT_HERE_CMD,
-            callback=self._report_here_cmd
+            callback=self._timed(self._report_here_cmd)
+        ))
+        self._dispatcher.add_handler(CommandHandler(
+            command=SpyBot._DIGEST_CMD,
+            callback=self._timed(self._digest_cmd),
+            pass_args=True
+        ))
+        self._dispatcher.add_handler(CommandHandler(
+            command=SpyBot._FILTER_CMD,
+            callback=self._timed(self._filter_cmd),
+            pass_args=True
+        ))
+        self._dispatcher.add_handler(CommandHandler(
+            command=SpyBot._SEARCH_CMD,
+            callback=self._timed(self._search_cmd),
+            pass_args=True
         ))
 
         # Groups status updates handler
@@ -100,13 +514,13 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
             Filters.status_update.left_chat_member
         self._dispatcher.add_handler(MessageHandler(
             filters=status_update_filters,
-            callback=self._status_update
+            callback=self._timed(self._status_update)
         ))
 
         # Groups text messages handler
         self._dispatcher.add_handler(MessageHandler(
-            filters=Filters.text & Filters.group,
-            callback=self._forward
+            filters=SpyBot._FORWARDED,
+            callback=self._timed_forward
         ))
 
     def _start_cmd(self, bot, update):
@@ -173,6 +587,7 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
         if master_settings and chat_id != master_settings.report_chat_id:
             # Unsubscribe the Master from this chat
             self._store.unsubscribe(chat_id, master_id=sender_id)
+            self._filters.invalidate(chat_id)
 
             self._log.info(
                 "Stopped watching chat '%s' (%s) for user '%s' (%s)",
@@ -196,7 +611,8 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
         master_settings = self._store.get_master(sender_id)
         if master_settings:
             # Update the report chat ID
-            new_master_settings = MasterSettings(sender_id, chat_id)
+            new_master_settings = MasterSettings(sender_id, chat_id,
+                                                 master_settings.digest)
             self._store.save_or_update_master(new_master_settings)
 
             self._log.info(
@@ -208,53 +624,498 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
             update.message.reply_text(
                 'Sure, Master, I will report my findings here.')
 
-    def _forward(self, bot, update):
+    def _digest_cmd(self, bot, update, args):
+        """ Handle /digest command.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            update (:obj:`telegram.Update`): An update from the server
+            args (:obj:`list`): Command arguments
+        """
+        sender_id = update.effective_user.id
+
+        master_settings = self._store.get_master(sender_id)
+        if master_settings:
+            # Digests are turned on unless asked otherwise
+            digest = not args or args[0].lower() != 'off'
+            new_master_settings = MasterSettings(
+                sender_id, master_settings.report_chat_id, digest)
+            self._store.save_or_update_master(new_master_settings)
+
+            self._log.info(
+                "Sending reports for user '%s' (%s) %s",
+                update.effective_user.username or 'N/A', sender_id,
+                'in digests' if digest else 'one by one')
+
+            # Reply
+            if digest:
+                update.message.reply_text(
+                    'Of course, Master, I will gather my findings and '
+                    'report them in digests.')
+            else:
+                update.message.reply_text(
+                    'Of course, Master, I will report every finding at once.')
+
+    def _filter_cmd(self, bot, update, args):
+        """ Handle /filter command.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            update (:obj:`telegram.Update`): An update from the server
+            args (:obj:`list`): Command arguments
+        """
+        sender_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+
+        # Is the message sent by a Master watching this chat?
+        master_settings = self._store.get_master(sender_id)
+        if master_settings and \
+                master_settings in self._store.get_subscribers(chat_id):
+            if len(args) > MAX_PATTERNS:
+                update.message.reply_text(
+                    u"Forgive me, Master, I can only watch for {} keywords "
+                    u"at once.".format(MAX_PATTERNS))
+                return
+            for pattern in args:
+                try:
+                    parse_pattern(pattern)
+                except ValueError as err:
+                    update.message.reply_text(
+                        u"Forgive me, Master, I cannot make sense of "
+                        u"{}: {}".format(pattern, err))
+                    return
+
+            self._store.set_filters(sender_id, chat_id, args)
+            self._filters.invalidate(chat_id)
+
+            self._log.info(
+                "Filtering chat '%s' (%s) for user '%s' (%s) by %s",
+                update.effective_chat.title or 'N/A', chat_id,
+                update.effective_user.username or 'N/A', sender_id,
+                args or 'nothing')
+
+            # Reply
+            if args:
+                update.message.reply_text(
+                    'Understood, Master, I will only report messages '
+                    'that mention any of it.')
+            else:
+                update.message.reply_text(
+                    'Understood, Master, I will report every message '
+                    'from this group.')
+
+    def _search_cmd(self, bot, update, args):
+        """ Handle /search command.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            update (:obj:`telegram.Update`): An update from the server
+            args (:obj:`list`): Command arguments
+        """
+        sender_id = update.effective_user.id
+
+        master_settings = self._store.get_master(sender_id)
+        if not master_settings:
+            return
+        if self._archive is None:
+            update.message.reply_text(
+                'Alas, Master, I was not ordered to remember anything.')
+            return
+
+        # Masters only search chats they spy on
+        chat_ids = self._store.get_chats(sender_id)
+        terms = args
+        # The last arguments may name a chat to search in, a longer title
+        # wins over a shorter one
+        for count in range(len(args) - 1, 0, -1):
+            found = self._find_chats(' '.join(args[-count:]), chat_ids)
+            if found:
+                terms, chat_ids = args[:-count], found
+                break
+        if not terms:
+            update.message.reply_text(
+                'What shall I look for, Master? Tell me some words, like '
+                '/{} release notes'.format(SpyBot._SEARCH_CMD))
+            return
+
+        messages = self._archive.search(terms, chat_ids)
+
+        self._log.info(
+            "Found %s messages by %s for user '%s' (%s)", len(messages),
+            terms, update.effective_user.username or 'N/A', sender_id)
+
+        # Results are reported where other reports go
+        if not messages:
+            bot.send_message(master_settings.report_chat_id,
+                             'I found nothing, Master.')
+            return
+        for text in split_message([SpyBot._render_search_result(message)
+                                   for message in messages]):
+            bot.send_message(master_settings.report_chat_id, text,
+                             parse_mode=ParseMode.MARKDOWN)
+
+    def _find_chats(self, name, chat_ids):
+        """ Find chats by an ID or a title among chats a Master spies on.
+
+        Arguments:
+            name (:obj:`str`): an ID or a title of a chat
+            chat_ids (:obj:`list`): IDs of chats the Master spies on
+
+        Return:
+            :obj:`list`: IDs of found chats
+        """
+        found = [chat_id for chat_id in chat_ids if str(chat_id) == name]
+        return found or [chat_id for chat_id in self._archive.find_chats(name)
+                         if chat_id in chat_ids]
+
+    @staticmethod
+    def _render_search_result(message):
+        """ Render a message found in the archive.
+
+        Arguments:
+            message (:obj:`bot.archive.ArchivedMessage`): A found message
+
+        Return:
+            :obj:`str`: a Markdown text
+        """
+        text = message.text
+        if len(text) > SpyBot._SEARCH_TEXT_LENGTH:
+            text = text[:SpyBot._SEARCH_TEXT_LENGTH] + u'\u2026'
+        return u'{user} @ {chat}, {date} UTC:\n{text}'.format(
+            user=user_link(message.user_id, message.user_name),
+            chat=italic(message.chat_title or 'Untitled'),
+            date=datetime.utcfromtimestamp(message.date)
+            .strftime('%Y-%m-%d %H:%M'),
+            text=escape_markdown(text))
+
+    def _forward(self, bot, update, prefetched=None):
         """ Forward spied message to all Masters subscribed on this chat.
 
+        Messages are queued for delivery, once per destination chat, so the
+        handler returns immediately. Media are forwarded by their file IDs.
+
         Arguments:
             bot (:obj:`telegram.Bot`): An instance of the SpyBot
             update (:obj:`telegram.Update`): An update from the server
+            prefetched (:obj:`dict`): (Optional) subscribers of chats looked
+                up for a batch of updates
         """
-        from_chat_id = update.effective_chat.id
+        message = update.message
+        media = self._media.describe(message)
+        if media is not None and message.media_group_id and \
+                media['type'] in ALBUM_TYPES:
+            # Messages of an album are forwarded together
+            self._albums.add(update)
+            return
+
+        self._archive_message(update, message.text or message.caption)
         forwarded_message = self._create_forwarded_message(update)
+        parts = SpyBot._text_parts(forwarded_message) if media is None \
+            else SpyBot._attach(forwarded_message, media)
+        self._fan_out(update.effective_chat.id,
+                      message.text or message.caption or '', parts,
+                      prefetched)
+
+    def _flush_albums(self, bot, job):
+        """ Forward albums collected for long enough. Called by the job queue.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            job (:obj:`telegram.ext.Job`): The job being run
+        """
+        self._albums.flush_expired()
+
+    def _flush_traces(self, bot, job):
+        """ Write recorded spans to the trace file, so that they are not
+        lost if the process dies. Called by the job queue.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            job (:obj:`telegram.ext.Job`): The job being run
+        """
+        self._tracer.flush()
+
+    def _forward_album(self, updates):
+        """ Forward an album to all Masters subscribed on its chat.
+
+        Arguments:
+            updates (:obj:`list`): Updates with messages of the album
+        """
+        first = updates[0]
+        items = [self._media.describe(update.message) for update in updates]
+        captions = [update.message.caption for update in updates
+                    if update.message.caption]
+        caption = '\n'.join(captions)
+        self._archive_message(first, caption)
+        forwarded_message = self._renderer.render(
+            first.effective_chat, first.effective_user, caption)
+
+        if len(items) == 1:
+            # An album should have at least two items
+            parts = SpyBot._attach(forwarded_message, items[0])
+        elif len(forwarded_message) <= MAX_CAPTION_LENGTH:
+            # The album is captioned by its first item
+            parts = [(None, [dict(items[0], caption=forwarded_message)] +
+                      items[1:])]
+        else:
+            parts = SpyBot._text_parts(forwarded_message) + [(None, items)]
+        self._fan_out(first.effective_chat.id, caption, parts)
+
+    def _archive_message(self, update, text):
+        """ Keep a spied message in the archive, if there is one.
+
+        Arguments:
+            update (:obj:`telegram.Update`): An update with the message
+            text (:obj:`str`): A text of the message to search by
+        """
+        if self._archive is None or not text:
+            return
+        user = update.effective_user
+        user_name = user.first_name
+        if user.last_name:
+            user_name += ' ' + user.last_name
+        self._archive.add(update.effective_chat.id,
+                          update.effective_chat.title, user.id, user_name,
+                          to_timestamp(update.message.date), text)
+
+    @staticmethod
+    def _attach(text, media):
+        """ Compose messages to forward media with a text.
+
+        Arguments:
+            text (:obj:`str`): A forwarded message text
+            media (:obj:`dict`): A description of media
 
-        subscribers = self._store.get_subscribers(from_chat_id)
+        Return:
+            :obj:`list`: a list of tuples of a text and media of every
+                message to send. A text that cannot be a caption of the media
+                is sent in messages of its own.
+        """
+        if media['type'] in CAPTIONED_TYPES and \
+                len(text) <= MAX_CAPTION_LENGTH:
+            return [(text, media)]
+        return SpyBot._text_parts(text) + [(None, media)]
+
+    @staticmethod
+    def _text_parts(text):
+        """ Compose messages to forward a text. Escaping and the header can
+        make a forwarded text longer than a message, so it is split.
+
+        Arguments:
+            text (:obj:`str`): A forwarded message text
+
+        Return:
+            :obj:`list`: a list of tuples of a text and no media of every
+                message to send
+        """
+        return [(chunk, None) for chunk in split_message([text])]
+
+    def _fan_out(self, from_chat_id, text, parts, prefetched=None):
+        """ Queue a spied message for delivery to all Masters subscribed on
+        the chat whose filters match it.
+
+        Arguments:
+            from_chat_id (:obj:`int`): An id of the spied chat
+            text (:obj:`str`): A text of the spied message to filter by
+            parts (:obj:`list`): Tuples of a text and media of every message
+                to send to a Master
+            prefetched (:obj:`dict`): (Optional) subscribers of chats looked
+                up for a batch of updates, the store is read if omitted
+        """
+        subscribers = None
+        if prefetched is not None:
+            subscribers = prefetched.get(from_chat_id)
+        if subscribers is None:
+            subscribers = self._store.get_subscribers(from_chat_id)
+        subscribers = self._filters.filter(from_chat_id, text, subscribers)
+
+        # Only plain texts can be collected into digests
+        textual = all(media is None for _, media in parts)
+        # Everybody gets digests while the bot catches up with a backlog
+        overloaded = self._updates.overloaded
+        # Deliveries are sent on other threads within the trace of the update
+        trace = self._tracer.context()
+        for chat_id, master_ids, digest in \
+                SpyBot._group_by_destination(subscribers):
+            # A collected digest is not overtaken by later messages
+            digest = digest or overloaded or chat_id in self._digests
+            for forwarded_message, media in parts:
+                outbox_id = self._outbox.append(
+                    chat_id, forwarded_message, master_ids, media) \
+                    if self._outbox is not None else None
+
+                if digest and textual:
+                    self._digests.add(chat_id, forwarded_message, master_ids,
+                                      outbox_id=outbox_id)
+                else:
+                    self._deliveries.put(Delivery(chat_id, forwarded_message,
+                                                  master_ids,
+                                                  outbox_id=outbox_id,
+                                                  media=media,
+                                                  trace=trace))
+
+    @staticmethod
+    def _group_by_destination(subscribers):
+        """ Group subscribers by their report chats, so that every chat
+        receives a spied message once no matter how many Masters read it.
+
+        Arguments:
+            subscribers (:obj:`list`): A list of ``MasterSettings``
+
+        Return:
+            :obj:`list`: a list of tuples of a report chat ID, a list of
+                IDs of Masters reading the chat, and whether all of them
+                prefer digests
+        """
+        destinations = dict()
         for subscriber in subscribers:
             chat_id = subscriber.report_chat_id
+            destination = destinations.get(chat_id)
+            if destination is None:
+                destinations[chat_id] = ([subscriber.master_id],
+                                         subscriber.digest)
+            else:
+                master_ids, digest = destination
+                master_ids.append(subscriber.master_id)
+                # Digests are sent only to chats where all Masters want them
+                destinations[chat_id] = (master_ids,
+                                         digest and subscriber.digest)
 
-            try:
-                bot.send_message(chat_id, forwarded_message,
-                                 parse_mode=ParseMode.MARKDOWN)
-
-            except ChatMigrated as err:
-                # Id of the chat with the Master has changed
-                self._log.warning("Chat ID changed from %s to %s",
-                                  chat_id, err.new_chat_id)
-                # Update Master settings with the new chat ID
-                master_settings = MasterSettings(subscriber.master_id,
-                                                 err.new_chat_id)
-                self._store.save_or_update_master(master_settings)
-                # Retry forwarding message
-                bot.send_message(chat_id, forwarded_message)
-
-            except Unauthorized:
-                # The bot was removed or banned in the chat
-                logging.exception("The bot was removed or banned in chat %s",
+        return [(chat_id, master_ids, digest)
+                for chat_id, (master_ids, digest) in destinations.items()]
+
+    def _flush_digests(self, bot, job):
+        """ Send digests collected for long enough. Called by the job queue.
+
+        Arguments:
+            bot (:obj:`telegram.Bot`): An instance of the SpyBot
+            job (:obj:`telegram.ext.Job`): The job being run
+        """
+        self._digests.flush_expired()
+
+    def _send_digest(self, chat_id, texts, master_ids, outbox_ids):
+        """ Queue a digest for delivery.
+
+        Arguments:
+            chat_id (:obj:`int`): An id of a chat to send the digest to
+            texts (:obj:`list`): Digest texts that fit into a message each
+            master_ids (:obj:`set`): IDs of Masters the digest is sent to
+            outbox_ids (:obj:`list`): Outbox IDs of the collected messages
+        """
+        master_ids = list(master_ids)
+        for text in texts:
+            outbox_id = self._outbox.append(chat_id, text, master_ids) \
+                if self._outbox is not None else None
+            self._deliveries.put(Delivery(chat_id, text, master_ids,
+                                          outbox_id=outbox_id))
+
+        # Collected messages are replaced by the digest in the outbox
+        if self._outbox is not None:
+            for outbox_id in outbox_ids:
+                self._outbox.ack(outbox_id)
+
+    def _delivered(self, delivery):
+        """ Acknowledge a delivery that has been sent or given up on.
+
+        Arguments:
+            delivery (:obj:`bot.delivery.Delivery`): A finished delivery
+        """
+        if self._outbox is not None and delivery.outbox_id is not None:
+            self._outbox.ack(delivery.outbox_id)
+
+    def _send(self, delivery, bot):
+        """ Send a forwarded message to a Master. Called by delivery workers.
+
+        Errors that can be retried are raised to the delivery queue.
+
+        Arguments:
+            delivery (:obj:`bot.delivery.Delivery`): A message to send
+            bot (:obj:`telegram.Bot`): A bot to send the message with
+        """
+        chat_id = delivery.chat_id
+        try:
+            media = delivery.media
+            with self._tracer.span('send_message', context=delivery.trace,
+                                   chat_id=chat_id,
+                                   attempt=delivery.attempts):
+                if media is None:
+                    bot.send_message(chat_id, delivery.text,
+                                     parse_mode=ParseMode.MARKDOWN)
+                elif isinstance(media, list):
+                    bot.send_media_group(chat_id, [SpyBot._input_media(item)
+                                                   for item in media])
+                else:
+                    # Metadata of the file are passed as they are
+                    kwargs = dict((name, value)
+                                  for name, value in media.items()
+                                  if name not in ('type', 'file_id'))
+                    if delivery.text:
+                        kwargs.update(caption=delivery.text,
+                                      parse_mode=ParseMode.MARKDOWN)
+                    getattr(bot, 'send_' + media['type'])(
+                        chat_id, media['file_id'], **kwargs)
+            self._metrics.sends.inc()
+
+        except ChatMigrated as err:
+            # Id of the chat with the Master has changed
+            self._log.warning("Chat ID changed from %s to %s",
+                              chat_id, err.new_chat_id)
+            # Update Masters settings with the new chat ID
+            for master_id in delivery.master_ids:
+                master_settings = self._store.get_master(master_id)
+                if master_settings:
+                    self._store.save_or_update_master(MasterSettings(
+                        master_id, err.new_chat_id, master_settings.digest))
+            self._deliveries.migrate(chat_id, err.new_chat_id)
+            self._metrics.migrations.inc()
+            # The queue retries the message in the new chat
+            raise
+
+        except Unauthorized:
+            if bot is not self._updater.bot:
+                # A sender whose token has been revoked is taken out of the
+                # pool, and another one sends the message
+                if self._deliveries.retire(bot, delivery):
+                    raise Redirected()
+                # Otherwise the sender is refused in this chat only, and
+                # the main bot sends there instead
+                self._log.warning("A sender is refused in chat %s, "
+                                  "sending there with the main bot",
                                   chat_id)
-                # Remove the Master
-                self._store.remove_master(subscriber.master_id)
+                if self._deliveries.refuse(delivery):
+                    raise Redirected()
 
-            except NetworkError:
-                # A network error has occurred
-                self._log.exception(
-                    "A network error has occurred when forwarding message "
-                    "'%s' to chat %s", update.message.text, chat_id)
-                # Retry forwarding message
-                bot.send_message(chat_id, forwarded_message)
+            # The bot was removed or banned in the chat
+            logging.exception("The bot was removed or banned in chat %s",
+                              chat_id)
+            # Remove the Masters
+            for master_id in delivery.master_ids:
+                # The Master may have been removed by an earlier delivery
+                if self._store.get_master(master_id):
+                    self._store.remove_master(master_id)
+                    self._filters.invalidate()
+                    self._metrics.removals.inc()
 
-            # Sleep after sending a message to a chat in order to avoid
-            # hitting Telegram message limits.
-            time.sleep(SpyBot._FORWARD_DELAY_SEC)
+    @staticmethod
+    def _input_media(item):
+        """ Build an album item to send.
+
+        Arguments:
+            item (:obj:`dict`): A description of a photo or a video
+
+        Return:
+            :obj:`telegram.InputMedia`: the album item
+        """
+        caption = item.get('caption')
+        parse_mode = ParseMode.MARKDOWN if caption else None
+        if item['type'] == 'photo':
+            return InputMediaPhoto(item['file_id'], caption=caption,
+                                   parse_mode=parse_mode)
+        return InputMediaVideo(item['file_id'], caption=caption,
+                               width=item.get('width'),
+                               height=item.get('height'),
+                               duration=item.get('duration'),
+                               parse_mode=parse_mode)
 
     def _status_update(self, bot, update):
         """ Watch for groups status updates.
@@ -285,6 +1146,7 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
         # Check if the bot has left the group
         if message.left_chat_member and message.left_chat_member.id == bot.id:
             self._store.unsubscribe(chat_id)
+            self._filters.invalidate(chat_id)
 
             self._log.info(
                 "Left from chat '%s' (%s)",
@@ -333,26 +1195,8 @@ Easy, isn't it? Try it now. I'm awaiting your orders.
         Return:
             :obj:`str`: A message text to forward
         """
-        from_chat_title = update.effective_chat.title or 'Untitled'
-        from_chat_username = update.effective_chat.username
-
-        # Use a reference to a chat whenever possible,
-        # otherwise just show chat name in italic
-        from_chat_ref = '@' + from_chat_username if from_chat_username \
-            else '_{}_'.format(from_chat_title)
-
-        from_user_id = update.effective_user.id
-        from_user_name = update.effective_user.first_name
-
-        # Show full user name whenever possible
-        if update.effective_user.last_name:
-            from_user_name += ' ' + update.effective_user.last_name
-
-        # Show a link to a user profile
-        from_user_link = "[{user_name}](tg://user?id={user_id})"\
-            .format(user_name=from_user_name,
-                    user_id=from_user_id)
-
-        return "{user} @ {chat}:\n{text}".format(user=from_user_link,
-                                                 chat=from_chat_ref,
-                                                 text=update.message.text)
+        message = update.message
+        with self._tracer.span('render'):
+            return self._renderer.render(update.effective_chat,
+                                         update.effective_user,
+                                         message.text or message.caption or '')
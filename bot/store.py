@@ -1,19 +1,33 @@
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from array import array
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from snapshot import INT64, DeltaLog, Snapshot, collections_paused
 
 
 class MasterSettings(object):
     """ A simple class for storing SpyBot's Masters settings. """
 
-    def __init__(self, master_id, report_chat_id):
+    def __init__(self, master_id, report_chat_id, digest=False):
         """ Create new MasterSettings.
 
         Arguments:
             master_id (:obj:`int`): a Telegram user id of the bot's Master
             report_chat_id (:obj:`int`): an id of a Telegram chat to forward
                 spied messaged to
+            digest (:obj:`bool`): whether spied messages are collected
+                and forwarded in digests rather than one by one
         """
         self._master_id = master_id
         self._report_chat_id = report_chat_id
+        self._digest = bool(digest)
 
     @property
     def master_id(self):
@@ -27,10 +41,15 @@ class MasterSettings(object):
     def report_chat_id(self, new_report_chat_id):
         self._report_chat_id = new_report_chat_id
 
+    @property
+    def digest(self):
+        return self._digest
+
     def __str__(self):
-        return 'MasterSettings({master_id}, {report_chat_id})' \
+        return 'MasterSettings({master_id}, {report_chat_id}, {digest})' \
             .format(master_id=self._master_id,
-                    report_chat_id=self.report_chat_id)
+                    report_chat_id=self.report_chat_id,
+                    digest=self._digest)
 
     def __eq__(self, other):
         return isinstance(other, MasterSettings) and \
@@ -98,78 +117,1230 @@ class AbstractStore:
 
     @abstractmethod
     def get_subscribers(self, chat_id):
-        """ Return a list of all subscribers on the specified chat.
+        """ Return all subscribers on the specified chat.
+
+        Arguments:
+            chat_id (:obj:`int`): A Telegram chat ID
+
+        Return:
+            :obj:`list`: a sequence of ``MasterSettings``. It may be shared
+                between calls and must not be modified.
+        """
+
+    @abstractmethod
+    def set_filters(self, master_id, chat_id, patterns):
+        """ Replace filters of a Master's subscription on the chat.
+
+        Arguments:
+            master_id (:obj:`int`): a Telegram ID of a Master user
+            chat_id (:obj:`int`): a Telegram chat ID
+            patterns (:obj:`list`): keywords and ``/regular expressions/``.
+                If empty, all messages from the chat are forwarded.
+        """
+        pass
+
+    @abstractmethod
+    def get_filters(self, chat_id):
+        """ Return filters of all subscribers on the specified chat.
 
         Arguments:
             chat_id (:obj:`int`): A Telegram chat ID
 
         Return:
-            :obj:`list`: a list of ``MasterSettings``
+            :obj:`dict`: a map of IDs of Masters who filter messages from
+                the chat to tuples of their patterns. It may be shared between
+                calls and must not be modified.
+        """
+
+    @abstractmethod
+    def save_or_update_masters(self, masters_settings):
+        """ Register new Masters or update existing ones at once.
+
+        Arguments:
+            masters_settings (:obj:`list`): a list of ``MasterSettings``
+        """
+        pass
+
+    @abstractmethod
+    def subscribe_many(self, subscriptions):
+        """ Subscribe Masters to chats at once.
+
+        Arguments:
+            subscriptions (:obj:`list`): a list of tuples of a Master's
+                Telegram user ID and a Telegram chat ID
+        """
+        pass
+
+    @abstractmethod
+    def unsubscribe_many(self, subscriptions):
+        """ Remove subscriptions on chats at once. Subscriptions that do not
+        exist are ignored.
+
+        Arguments:
+            subscriptions (:obj:`list`): a list of tuples of a Telegram chat
+                ID and a Master's Telegram user ID. If the Master's ID is
+                ``None``, all subscriptions on the chat are canceled.
+        """
+        pass
+
+    @abstractmethod
+    def get_subscribers_many(self, chat_ids):
+        """ Return all subscribers on each of the specified chats.
+
+        Arguments:
+            chat_ids (:obj:`list`): Telegram chat IDs
+
+        Return:
+            :obj:`dict`: a map of every chat ID to a sequence of
+                ``MasterSettings`` like ``get_subscribers`` returns
+        """
+
+    @abstractmethod
+    def get_chats(self, master_id):
+        """ Return all chats the specified Master subscribes to.
+
+        Arguments:
+            master_id (:obj:`int`): a Telegram user id of the bot's Master
+
+        Return:
+            :obj:`list`: a list of Telegram chat IDs
         """
 
 
+def _materialize(value):
+    # Iterators are consumed by a call, so they are logged as lists
+    if isinstance(value, (list, tuple, dict, MasterSettings, bytes,
+                          type(u''))) or not hasattr(value, '__iter__'):
+        return value
+    return list(value)
+
+
+def _encode(value):
+    if isinstance(value, MasterSettings):
+        return {'master': [value.master_id, value.report_chat_id,
+                           value.digest]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        return MasterSettings(*value['master'])
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _journaled(method):
+    """ Make a method of the InMemoryStore change data under the store lock
+    and record the change in the delta log, if there is one.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with InMemoryStore._LOCK:
+            if self._delta_log is None:
+                return method(self, *args, **kwargs)
+
+            args = tuple(_materialize(arg) for arg in args)
+            result = method(self, *args, **kwargs)
+            # Only changes that have been made are recorded
+            self._delta_log.append(
+                InMemoryStore._generation, method.__name__, _encode(args),
+                dict((name, _encode(value))
+                     for name, value in kwargs.items()))
+            return result
+    return wrapper
+
+
 class InMemoryStore(AbstractStore):
-    """ A simple in-memory implementation of the AbstractStore. """
+    """ A simple in-memory implementation of the AbstractStore.
+
+    The store is safe to use from many threads. Changes are serialized by
+    a lock, while reads of subscribers take no lock: collections of them are
+    immutable and replaced on every change, so a reader always sees
+    a consistent one. Chats of Masters are changed in place and read under
+    the lock. Subscribers of a chat are cached once read. A cache
+    entry is filled and dropped under a lock of the chat's stripe, so reading
+    different chats does not contend, and a stale entry is never cached.
+
+    Data can be persisted with periodic snapshots written in background and,
+    optionally, a delta log of changes made since the last snapshot. Both are
+    loaded when a store is created. Data is shared by all instances, so only
+    one of them should be given a snapshot path.
+    """
+
+    # Seconds between snapshots
+    SNAPSHOT_INTERVAL_SEC = 300
 
     # A map of Master IDs to Master Settings
     _MASTERS = dict()
-    # A map of Chat IDs to a collection of IDs of subscribed Masters
+    # A map of Chat IDs to frozen sets of IDs of subscribed Masters
     _CHATS = dict()
+    # A map of Master IDs to sets of IDs of chats they subscribed to. The sets
+    # are changed in place, so they are only used with the lock held.
+    _MASTER_CHATS = dict()
+    # A map of Chat IDs to cached tuples of subscribers' Master Settings
+    _SUBSCRIBERS = dict()
+    # A map of Chat IDs to maps of Master IDs to tuples of filter patterns.
+    # The maps are replaced rather than modified, so they can be shared.
+    _FILTERS = dict()
+    # Filters of chats where nobody filters messages
+    _NO_FILTERS = dict()
+    # Held while data is changed or copied into a snapshot. Not reentrant,
+    # an RLock is written in Python in Python 2 and slows every change down.
+    _LOCK = threading.Lock()
+    # Locks of cached subscribers of chats, by stripes of chat IDs
+    _STRIPES = 64
+    _STRIPE_LOCKS = [threading.Lock() for _ in range(_STRIPES)]
+    # A number of the last snapshot
+    _generation = 0
+
+    def __init__(self, snapshot_path=None,
+                 snapshot_interval=SNAPSHOT_INTERVAL_SEC, delta_log=False):
+        """ Create a new InMemoryStore.
+
+        Arguments:
+            snapshot_path (:obj:`str`): (Optional) a path to a snapshot file
+                to load data from and to write snapshots to
+            snapshot_interval (:obj:`float`): seconds between snapshots
+                taken in background
+            delta_log (:obj:`bool`): whether changes made since the last
+                snapshot are logged to a file next to the snapshot, so that
+                they are not lost if the process dies
+        """
+        self._log = logging.getLogger(InMemoryStore.__name__)
+        self._snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        self._delta_log = None
+        # Serializes snapshots
+        self._snapshot_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        if snapshot_path is not None:
+            self._restore(delta_log)
+
+    def _restore(self, delta_log):
+        """ Load data from the snapshot and the delta log. """
+        started = time.time()
+        if os.path.exists(self._snapshot_path):
+            try:
+                self.load(Snapshot.read(self._snapshot_path))
+            except ValueError:
+                # The file is kept for inspection rather than replaced by
+                # the next snapshot
+                corrupt_path = self._snapshot_path + '.corrupt'
+                self._log.exception("Failed to load the snapshot %s, "
+                                    "starting empty and moving it to %s",
+                                    self._snapshot_path, corrupt_path)
+                os.rename(self._snapshot_path, corrupt_path)
+        self._log.info("Loaded %s subscriptions from %s in %.3f seconds",
+                       sum(len(chat) for chat in InMemoryStore._CHATS
+                           .values()),
+                       self._snapshot_path, time.time() - started)
+        if not delta_log:
+            return
 
+        log = DeltaLog(self._snapshot_path + '.log')
+        changes = log.replay(InMemoryStore._generation)
+        for method, args, kwargs in changes:
+            try:
+                getattr(self, method)(*_decode(args), **dict(
+                    (name, _decode(value)) for name, value in kwargs.items()))
+            except AssertionError:
+                # A change that failed the same way when it was made
+                pass
+        self._delta_log = log
+        if changes:
+            self._log.info("Replayed %s changes", len(changes))
+            # Fold the changes into a snapshot, so they are replayed once
+            self.snapshot()
+
+    def load(self, snapshot):
+        """ Replace all data with data of a snapshot.
+
+        Arguments:
+            snapshot (:obj:`bot.snapshot.Snapshot`): a snapshot
+        """
+        masters = snapshot.masters
+        fields = [iter(masters)] * 3
+        # Chats of Masters are not kept in snapshots
+        master_chats = defaultdict(list)
+        with collections_paused():
+            for chat_id, master_ids in snapshot.chats.items():
+                for master_id in master_ids:
+                    master_chats[master_id].append(chat_id)
+            master_chats = dict((master_id, set(chat_ids))
+                                for master_id, chat_ids
+                                in master_chats.items())
+        with InMemoryStore._LOCK:
+            InMemoryStore._MASTERS.clear()
+            InMemoryStore._MASTERS.update(
+                (master_id, MasterSettings(master_id, report_chat_id,
+                                           digest))
+                for master_id, report_chat_id, digest in zip(*fields))
+            InMemoryStore._CHATS.clear()
+            InMemoryStore._CHATS.update(snapshot.chats)
+            InMemoryStore._MASTER_CHATS.clear()
+            InMemoryStore._MASTER_CHATS.update(master_chats)
+            InMemoryStore._FILTERS.clear()
+            InMemoryStore._FILTERS.update(snapshot.filters)
+            InMemoryStore._generation = snapshot.generation
+            with InMemoryStore._striped(range(InMemoryStore._STRIPES)):
+                InMemoryStore._SUBSCRIBERS.clear()
+
+    def snapshot(self):
+        """ Write a snapshot of all data and start a new delta log.
+
+        Data is copied under the store lock and packed and written without
+        it. Collections of subscribers are immutable, so only maps of them
+        are copied, and changes wait only for the copying.
+        """
+        with self._snapshot_lock:
+            with InMemoryStore._LOCK:
+                InMemoryStore._generation += 1
+                masters = array(INT64)
+                for settings in InMemoryStore._MASTERS.values():
+                    masters.extend((settings.master_id,
+                                    settings.report_chat_id,
+                                    int(settings.digest)))
+                snapshot = Snapshot(InMemoryStore._generation, masters,
+                                    dict(InMemoryStore._CHATS),
+                                    dict(InMemoryStore._FILTERS))
+                if self._delta_log is not None:
+                    self._delta_log.rotate()
+
+            Snapshot.save(self._snapshot_path, snapshot.pack())
+            if self._delta_log is not None:
+                self._delta_log.commit()
+
+    def start(self):
+        """ Start taking snapshots in background. """
+        if self._snapshot_path is None:
+            return
+        self._thread = threading.Thread(target=self._run, name='snapshots')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Take a final snapshot and stop taking snapshots. """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._snapshot_path is not None:
+            self.snapshot()
+        if self._delta_log is not None:
+            self._delta_log.close()
+            self._delta_log = None
+
+    def _run(self):
+        while not self._stopped.wait(self._snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception:
+                self._log.exception("Failed to write the snapshot %s",
+                                    self._snapshot_path)
+
+    @_journaled
     def save_or_update_master(self, master_settings):
-        InMemoryStore._MASTERS[master_settings.master_id] = master_settings
+        master_id = master_settings.master_id
+        InMemoryStore._MASTERS[master_id] = master_settings
+
+        # Cached subscribers still refer to the previous settings
+        self._invalidate(InMemoryStore._MASTER_CHATS.get(master_id, ()))
 
     def get_master(self, master_id):
         return InMemoryStore._MASTERS.get(master_id, None)
 
+    @_journaled
     def remove_master(self, master_id):
         # Remove Master settings
         master_settings = InMemoryStore._MASTERS.pop(master_id, None)
         # Ensure consistency
         assert master_settings, "Master should be registered first"
 
-        # Remove the Master from the list of subscribers
-        for chat_id, subscribers in InMemoryStore._CHATS.iteritems():
-            if master_settings in subscribers:
-                # Remove master settings from the set
-                subscribers -= {master_settings}
-                # If a chat has no subscribers, remove the chat
-                if not subscribers:
-                    del InMemoryStore._CHATS[chat_id]
+        # Remove the Master from subscribers of its chats only
+        chats = InMemoryStore._MASTER_CHATS.pop(master_id, ())
+        for chat_id in chats:
+            self._remove_subscriber(chat_id, master_id)
+        self._invalidate(chats)
 
+    @_journaled
     def subscribe(self, master_id, chat_id):
-        # Get Master settings
-        master_settings = InMemoryStore._MASTERS.get(master_id, None)
         # Ensure consistency
-        assert master_settings, "Master should be registered first"
+        assert master_id in InMemoryStore._MASTERS, \
+            "Master should be registered first"
 
-        if chat_id in InMemoryStore._CHATS:
-            # Add the Master to the list of subscribers
-            InMemoryStore._CHATS[chat_id] |= {master_settings}
-        else:
-            # Create a new list of subscribers for this chat
-            InMemoryStore._CHATS[chat_id] = {master_settings}
+        InMemoryStore._add(InMemoryStore._CHATS, chat_id, (master_id,))
+        InMemoryStore._MASTER_CHATS.setdefault(master_id, set()).add(chat_id)
+        self._invalidate((chat_id,))
 
+    @_journaled
     def unsubscribe(self, chat_id, master_id=None):
         if not master_id:
             # Delete all subscribers of this chat
             subscribers = InMemoryStore._CHATS.pop(chat_id, None)
             # Ensure consistency
             assert subscribers, "Chat should be registered first"
+
+            InMemoryStore._FILTERS.pop(chat_id, None)
+            for subscriber_id in subscribers:
+                self._remove_chat(subscriber_id, chat_id)
         else:
-            # Get Master settings
-            master_settings = InMemoryStore._MASTERS.get(master_id, None)
-            # Ensure consistency
-            assert master_settings, "Master should be registered first"
-            # Get chat subscribers
-            subscribers = InMemoryStore._CHATS.get(chat_id, None)
             # Ensure consistency
-            assert subscribers, "Chat should be registered first"
+            assert master_id in InMemoryStore._MASTERS, \
+                "Master should be registered first"
+            assert InMemoryStore._CHATS.get(chat_id), \
+                "Chat should be registered first"
+
             # Remove the master from chat subscribers
-            subscribers -= {master_settings}
+            self._remove_subscriber(chat_id, master_id)
+            self._remove_chat(master_id, chat_id)
+        self._invalidate((chat_id,))
 
     def get_subscribers(self, chat_id):
-        if chat_id in InMemoryStore._CHATS:
-            return list(InMemoryStore._CHATS[chat_id])
+        subscribers = InMemoryStore._SUBSCRIBERS.get(chat_id)
+        if subscribers is None:
+            with InMemoryStore._striped((chat_id,)):
+                subscribers = InMemoryStore._cache_subscribers(chat_id)
+        return subscribers
+
+    @_journaled
+    def set_filters(self, master_id, chat_id, patterns):
+        # Ensure consistency
+        assert master_id in InMemoryStore._CHATS.get(chat_id, ()), \
+            "Master should subscribe to the chat first"
+
+        filters = dict(InMemoryStore._FILTERS.get(chat_id, ()))
+        if patterns:
+            filters[master_id] = tuple(patterns)
+        else:
+            filters.pop(master_id, None)
+        InMemoryStore._set_chat_filters(chat_id, filters)
+
+    def get_filters(self, chat_id):
+        return InMemoryStore._FILTERS.get(chat_id, InMemoryStore._NO_FILTERS)
+
+    @_journaled
+    def save_or_update_masters(self, masters_settings):
+        stale_chats = set()
+        for master_settings in masters_settings:
+            master_id = master_settings.master_id
+            InMemoryStore._MASTERS[master_id] = master_settings
+            stale_chats.update(InMemoryStore._MASTER_CHATS.get(master_id, ()))
+
+        # Cached subscribers still refer to the previous settings
+        self._invalidate(stale_chats)
+
+    @_journaled
+    def subscribe_many(self, subscriptions):
+        subscriptions = list(subscriptions)
+        # Ensure consistency
+        assert all(master_id in InMemoryStore._MASTERS
+                   for master_id, _ in subscriptions), \
+            "Master should be registered first"
+
+        # Every collection is replaced once
+        chats = dict()
+        master_chats = dict()
+        for master_id, chat_id in subscriptions:
+            chats.setdefault(chat_id, []).append(master_id)
+            master_chats.setdefault(master_id, []).append(chat_id)
+        for chat_id, master_ids in chats.items():
+            InMemoryStore._add(InMemoryStore._CHATS, chat_id, master_ids)
+        for master_id, chat_ids in master_chats.items():
+            InMemoryStore._MASTER_CHATS.setdefault(master_id, set()) \
+                .update(chat_ids)
+        self._invalidate(chats)
+
+    @_journaled
+    def unsubscribe_many(self, subscriptions):
+        chat_ids = set()
+        for chat_id, master_id in subscriptions:
+            if master_id is None:
+                InMemoryStore._FILTERS.pop(chat_id, None)
+                for subscriber_id in InMemoryStore._CHATS.pop(chat_id, ()):
+                    self._remove_chat(subscriber_id, chat_id)
+            else:
+                self._remove_subscriber(chat_id, master_id)
+                self._remove_chat(master_id, chat_id)
+            chat_ids.add(chat_id)
+        self._invalidate(chat_ids)
+
+    def get_subscribers_many(self, chat_ids):
+        cached = InMemoryStore._SUBSCRIBERS
+        subscribers = dict()
+        misses = []
+        for chat_id in chat_ids:
+            chat_subscribers = cached.get(chat_id)
+            if chat_subscribers is not None:
+                subscribers[chat_id] = chat_subscribers
+            else:
+                misses.append(chat_id)
+
+        if misses:
+            # Locks of all stripes are taken once for the whole batch
+            with InMemoryStore._striped(misses):
+                for chat_id in misses:
+                    subscribers[chat_id] = \
+                        InMemoryStore._cache_subscribers(chat_id)
+        return subscribers
+
+    def get_chats(self, master_id):
+        with InMemoryStore._LOCK:
+            return list(InMemoryStore._MASTER_CHATS.get(master_id, ()))
+
+    @staticmethod
+    @contextmanager
+    def _striped(chat_ids):
+        """ Hold locks of stripes of chats. Locks are taken in the order of
+        stripes, so that threads holding several of them never deadlock.
+        """
+        locks = [InMemoryStore._STRIPE_LOCKS[stripe] for stripe in sorted(
+            set(hash(chat_id) % InMemoryStore._STRIPES
+                for chat_id in chat_ids))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def _cache_subscribers(chat_id):
+        """ Build a snapshot of subscribers of a chat that is reused until
+        they change. Must be called with the lock of the chat's stripe held.
+        """
+        # A Master being removed may still be listed in the chat
+        masters = InMemoryStore._MASTERS
+        subscribers = tuple(
+            master_settings for master_settings in
+            (masters.get(master_id) for master_id
+             in InMemoryStore._CHATS.get(chat_id, ()))
+            if master_settings is not None)
+        InMemoryStore._SUBSCRIBERS[chat_id] = subscribers
+        return subscribers
+
+    @staticmethod
+    def _invalidate(chat_ids):
+        """ Drop cached subscribers of chats after they have changed. """
+        if not chat_ids:
+            return
+        if len(chat_ids) == 1:
+            # Most changes touch a single chat
+            for chat_id in chat_ids:
+                with InMemoryStore._STRIPE_LOCKS[
+                        hash(chat_id) % InMemoryStore._STRIPES]:
+                    InMemoryStore._SUBSCRIBERS.pop(chat_id, None)
+            return
+        with InMemoryStore._striped(chat_ids):
+            for chat_id in chat_ids:
+                InMemoryStore._SUBSCRIBERS.pop(chat_id, None)
+
+    @staticmethod
+    def _add(groups, key, members):
+        """ Replace a frozen set of a group with a set with more members.
+        """
+        group = groups.get(key)
+        groups[key] = group.union(members) if group is not None \
+            else frozenset(members)
+
+    @staticmethod
+    def _set_chat_filters(chat_id, filters):
+        if filters:
+            InMemoryStore._FILTERS[chat_id] = filters
         else:
-            return list()
+            InMemoryStore._FILTERS.pop(chat_id, None)
+
+    @staticmethod
+    def _remove_subscriber(chat_id, master_id):
+        subscribers = InMemoryStore._CHATS.get(chat_id)
+        if subscribers is not None and master_id in subscribers:
+            subscribers = subscribers - frozenset((master_id,))
+            if subscribers:
+                InMemoryStore._CHATS[chat_id] = subscribers
+            else:
+                # If a chat has no subscribers, remove the chat
+                del InMemoryStore._CHATS[chat_id]
+
+        filters = InMemoryStore._FILTERS.get(chat_id)
+        if filters and master_id in filters:
+            filters = dict(filters)
+            del filters[master_id]
+            InMemoryStore._set_chat_filters(chat_id, filters)
+
+    @staticmethod
+    def _remove_chat(master_id, chat_id):
+        chats = InMemoryStore._MASTER_CHATS.get(master_id)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del InMemoryStore._MASTER_CHATS[master_id]
+
+
+class SqliteStore(AbstractStore):
+    """ An implementation of the AbstractStore backed by an SQLite database.
+
+    The database is opened in WAL mode, so readers are not blocked by
+    writers. All statements are parametrized and reused from the statement
+    cache of the connection. Changes of Masters, subscriptions and filters
+    are recorded by triggers, so that caches of other processes can follow
+    them, see ``get_changes``.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS masters (
+            master_id INTEGER PRIMARY KEY,
+            report_chat_id INTEGER NOT NULL,
+            digest INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id INTEGER NOT NULL,
+            master_id INTEGER NOT NULL
+                REFERENCES masters (master_id) ON DELETE CASCADE,
+            PRIMARY KEY (chat_id, master_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS subscriptions_master_id
+            ON subscriptions (master_id);
+        CREATE TABLE IF NOT EXISTS filters (
+            chat_id INTEGER NOT NULL,
+            master_id INTEGER NOT NULL,
+            pattern TEXT NOT NULL,
+            PRIMARY KEY (chat_id, master_id, pattern),
+            FOREIGN KEY (chat_id, master_id)
+                REFERENCES subscriptions (chat_id, master_id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_id INTEGER,
+            chat_id INTEGER
+        );
+        CREATE TRIGGER IF NOT EXISTS masters_inserted AFTER INSERT ON masters
+        BEGIN
+            INSERT INTO changes (master_id) VALUES (NEW.master_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS masters_updated AFTER UPDATE ON masters
+        BEGIN
+            INSERT INTO changes (master_id) VALUES (NEW.master_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS masters_deleted AFTER DELETE ON masters
+        BEGIN
+            INSERT INTO changes (master_id) VALUES (OLD.master_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS subscriptions_inserted
+        AFTER INSERT ON subscriptions
+        BEGIN
+            INSERT INTO changes (chat_id) VALUES (NEW.chat_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS subscriptions_deleted
+        AFTER DELETE ON subscriptions
+        BEGIN
+            INSERT INTO changes (chat_id) VALUES (OLD.chat_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS filters_inserted AFTER INSERT ON filters
+        BEGIN
+            INSERT INTO changes (chat_id) VALUES (NEW.chat_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS filters_deleted AFTER DELETE ON filters
+        BEGIN
+            INSERT INTO changes (chat_id) VALUES (OLD.chat_id);
+        END;
+        -- Only the last 10000 changes are kept, pruned every 1000 changes
+        CREATE TRIGGER IF NOT EXISTS changes_pruned AFTER INSERT ON changes
+        WHEN NEW.change_id % 1000 = 0
+        BEGIN
+            DELETE FROM changes WHERE change_id <= NEW.change_id - 10000;
+        END;
+    """
+
+    # REPLACE would delete the existing row and cascade to subscriptions,
+    # so an existing Master is updated in place instead
+    _UPDATE_MASTER = """
+        UPDATE masters SET report_chat_id = ?, digest = ? WHERE master_id = ?
+    """
+    _SAVE_MASTER = """
+        INSERT INTO masters (master_id, report_chat_id, digest)
+        VALUES (?, ?, ?)
+    """
+    _GET_MASTER = """
+        SELECT master_id, report_chat_id, digest
+        FROM masters WHERE master_id = ?
+    """
+    # Subscriptions are removed by the ON DELETE CASCADE clause using
+    # the index on subscriptions.master_id
+    _REMOVE_MASTER = """
+        DELETE FROM masters WHERE master_id = ?
+    """
+    _SUBSCRIBE = """
+        INSERT OR IGNORE INTO subscriptions (chat_id, master_id)
+        VALUES (?, ?)
+    """
+    _UNSUBSCRIBE_ALL = """
+        DELETE FROM subscriptions WHERE chat_id = ?
+    """
+    _UNSUBSCRIBE = """
+        DELETE FROM subscriptions WHERE chat_id = ? AND master_id = ?
+    """
+    _HAS_SUBSCRIBERS = """
+        SELECT 1 FROM subscriptions WHERE chat_id = ? LIMIT 1
+    """
+    _GET_SUBSCRIBERS = """
+        SELECT m.master_id, m.report_chat_id, m.digest
+        FROM subscriptions s JOIN masters m ON m.master_id = s.master_id
+        WHERE s.chat_id = ?
+    """
+
+    # Filters are removed with subscriptions by the ON DELETE CASCADE clause
+    _CLEAR_FILTERS = """
+        DELETE FROM filters WHERE chat_id = ? AND master_id = ?
+    """
+    _ADD_FILTER = """
+        INSERT OR IGNORE INTO filters (chat_id, master_id, pattern)
+        VALUES (?, ?, ?)
+    """
+    _GET_FILTERS = """
+        SELECT master_id, pattern FROM filters WHERE chat_id = ?
+    """
+
+    # Bulk statements are executed for many rows in a single transaction.
+    # New Masters are inserted first, then all of them are updated.
+    _SAVE_MASTER_IF_NEW = """
+        INSERT OR IGNORE INTO masters (master_id, report_chat_id, digest)
+        VALUES (?, ?, ?)
+    """
+    _GET_SUBSCRIBERS_MANY = """
+        SELECT s.chat_id, m.master_id, m.report_chat_id, m.digest
+        FROM subscriptions s JOIN masters m ON m.master_id = s.master_id
+        WHERE s.chat_id IN ({})
+    """
+    _GET_CHATS = """
+        SELECT chat_id FROM subscriptions WHERE master_id = ?
+    """
+    _GET_CHANGES = """
+        SELECT change_id, master_id, chat_id FROM changes
+        WHERE change_id > ? ORDER BY change_id
+    """
+    _GET_LAST_CHANGE = """
+        SELECT MAX(change_id) FROM changes
+    """
+    # Chats to look up in a single statement, SQLite allows at most 999
+    # parameters by default
+    _MAX_PARAMETERS = 500
+
+    def __init__(self, path):
+        """ Open or create an SQLite store.
+
+        Arguments:
+            path (:obj:`str`): a path to the database file
+        """
+        # The connection is shared by dispatcher and delivery threads,
+        # access to it is serialized with a lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(SqliteStore._SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """ Upgrade databases created by earlier versions of the store. """
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(masters)')]
+        if 'digest' not in columns:
+            self._db.execute('ALTER TABLE masters '
+                             'ADD COLUMN digest INTEGER NOT NULL DEFAULT 0')
+
+    def close(self):
+        """ Close the database connection. """
+        with self._lock:
+            self._db.close()
+
+    def save_or_update_master(self, master_settings):
+        master_id = master_settings.master_id
+        report_chat_id = master_settings.report_chat_id
+        digest = master_settings.digest
+
+        with self._lock:
+            updated = self._db.execute(SqliteStore._UPDATE_MASTER,
+                                       (report_chat_id, digest, master_id)) \
+                .rowcount
+            if not updated:
+                self._db.execute(SqliteStore._SAVE_MASTER,
+                                 (master_id, report_chat_id, digest))
+
+    def get_master(self, master_id):
+        with self._lock:
+            row = self._db.execute(SqliteStore._GET_MASTER,
+                                   (master_id,)).fetchone()
+        return MasterSettings(*row) if row else None
+
+    def remove_master(self, master_id):
+        with self._lock:
+            removed = self._db.execute(SqliteStore._REMOVE_MASTER,
+                                       (master_id,)).rowcount
+        # Ensure consistency
+        assert removed, "Master should be registered first"
+
+    def subscribe(self, master_id, chat_id):
+        with self._lock:
+            try:
+                self._db.execute(SqliteStore._SUBSCRIBE,
+                                 (chat_id, master_id))
+            except sqlite3.IntegrityError:
+                # Ensure consistency
+                raise AssertionError("Master should be registered first")
+
+    def unsubscribe(self, chat_id, master_id=None):
+        with self._lock:
+            if not master_id:
+                # Delete all subscribers of this chat
+                removed = self._db.execute(SqliteStore._UNSUBSCRIBE_ALL,
+                                           (chat_id,)).rowcount
+                # Ensure consistency
+                assert removed, "Chat should be registered first"
+            else:
+                # Remove the master from chat subscribers
+                removed = self._db.execute(SqliteStore._UNSUBSCRIBE,
+                                           (chat_id, master_id)).rowcount
+                if not removed:
+                    # Ensure consistency
+                    assert self._db.execute(SqliteStore._GET_MASTER,
+                                            (master_id,)).fetchone(), \
+                        "Master should be registered first"
+                    assert self._db.execute(SqliteStore._HAS_SUBSCRIBERS,
+                                            (chat_id,)).fetchone(), \
+                        "Chat should be registered first"
+
+    def get_subscribers(self, chat_id):
+        with self._lock:
+            rows = self._db.execute(SqliteStore._GET_SUBSCRIBERS,
+                                    (chat_id,)).fetchall()
+        return [MasterSettings(*row) for row in rows]
+
+    def set_filters(self, master_id, chat_id, patterns):
+        with self._transaction("Master should subscribe to the chat first"):
+            self._db.execute(SqliteStore._CLEAR_FILTERS,
+                             (chat_id, master_id))
+            self._db.executemany(SqliteStore._ADD_FILTER,
+                                 [(chat_id, master_id, pattern)
+                                  for pattern in patterns])
+
+    def get_filters(self, chat_id):
+        with self._lock:
+            rows = self._db.execute(SqliteStore._GET_FILTERS,
+                                    (chat_id,)).fetchall()
+        filters = dict()
+        for master_id, pattern in rows:
+            filters[master_id] = filters.get(master_id, ()) + (pattern,)
+        return filters
+
+    def save_or_update_masters(self, masters_settings):
+        rows = [(master_settings.master_id, master_settings.report_chat_id,
+                 master_settings.digest)
+                for master_settings in masters_settings]
+        with self._transaction():
+            self._db.executemany(SqliteStore._SAVE_MASTER_IF_NEW, rows)
+            self._db.executemany(SqliteStore._UPDATE_MASTER,
+                                 [(report_chat_id, digest, master_id)
+                                  for master_id, report_chat_id, digest
+                                  in rows])
+
+    def subscribe_many(self, subscriptions):
+        with self._transaction("Master should be registered first"):
+            self._db.executemany(SqliteStore._SUBSCRIBE,
+                                 [(chat_id, master_id)
+                                  for master_id, chat_id in subscriptions])
+
+    def unsubscribe_many(self, subscriptions):
+        subscriptions = list(subscriptions)
+        with self._transaction():
+            self._db.executemany(SqliteStore._UNSUBSCRIBE_ALL,
+                                 [(chat_id,)
+                                  for chat_id, master_id in subscriptions
+                                  if master_id is None])
+            self._db.executemany(SqliteStore._UNSUBSCRIBE,
+                                 [(chat_id, master_id)
+                                  for chat_id, master_id in subscriptions
+                                  if master_id is not None])
+
+    def get_subscribers_many(self, chat_ids):
+        chat_ids = list(set(chat_ids))
+        subscribers = dict((chat_id, []) for chat_id in chat_ids)
+
+        step = SqliteStore._MAX_PARAMETERS
+        with self._lock:
+            for start in range(0, len(chat_ids), step):
+                batch = chat_ids[start:start + step]
+                statement = SqliteStore._GET_SUBSCRIBERS_MANY.format(
+                    ', '.join('?' * len(batch)))
+                for row in self._db.execute(statement, batch):
+                    subscribers[row[0]].append(MasterSettings(*row[1:]))
+        return subscribers
+
+    def get_chats(self, master_id):
+        with self._lock:
+            return [row[0] for row in
+                    self._db.execute(SqliteStore._GET_CHATS, (master_id,))]
+
+    def get_changes(self, after=None):
+        """ Return Masters and chats changed by any process since a change.
+
+        Arguments:
+            after (:obj:`int`): (Optional) an ID of the last known change
+
+        Return:
+            :obj:`tuple`: an ID of the last change, IDs of changed Masters
+                and IDs of chats with changed subscribers or filters. Both
+                sets of IDs are ``None`` if changes since ``after`` are not
+                known, e.g. they have been pruned.
+        """
+        with self._lock:
+            rows = []
+            if after is not None:
+                rows = self._db.execute(SqliteStore._GET_CHANGES,
+                                        (after,)).fetchall()
+            if rows:
+                last = rows[-1][0]
+            else:
+                last = self._db.execute(
+                    SqliteStore._GET_LAST_CHANGE).fetchone()[0] or 0
+
+        # IDs of changes follow each other unless changes have been pruned
+        first = rows[0][0] if rows else last + 1
+        if after is None or first != after + 1:
+            return last, None, None
+        master_ids = set(master_id for _, master_id, _ in rows
+                         if master_id is not None)
+        chat_ids = set(chat_id for _, _, chat_id in rows
+                       if chat_id is not None)
+        return last, master_ids, chat_ids
+
+    @contextmanager
+    def _transaction(self, integrity_error=None):
+        """ Run statements in a transaction with the lock held.
+
+        Arguments:
+            integrity_error (:obj:`str`): (Optional) a message of an
+                ``AssertionError`` raised instead of an integrity error
+        """
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                yield
+            except sqlite3.IntegrityError:
+                self._db.execute('ROLLBACK')
+                if integrity_error is None:
+                    raise
+                # Ensure consistency
+                raise AssertionError(integrity_error)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+
+class _Cache(object):
+    """ A bounded LRU cache with entries that expire after a time to live.
+
+    Not thread-safe, callers are expected to synchronize access to it.
+    """
+
+    # A value returned for keys that are not cached
+    MISSING = object()
+
+    def __init__(self, ttl, max_size):
+        self._ttl = ttl
+        self._max_size = max_size
+        # A map of keys to (expiration time, value) in the LRU order
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= now:
+            return _Cache.MISSING
+        # Move the entry to the end of the LRU
+        self._entries[key] = entry
+        return entry[1]
+
+    def put(self, key, value, now):
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self._ttl, value)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class CachingStore(AbstractStore):
+    """ A read-through cache in front of another store.
+
+    Masters, subscribers and filters read from the wrapped store are cached
+    for a limited time. Changes made through the caching store invalidate
+    affected entries at once, so they are never served stale. Changes made
+    to the wrapped store by other means, e.g. by other processes, become
+    visible once cached entries expire. If the wrapped store records changes
+    like ``SqliteStore.get_changes`` does, they are followed by reads at most
+    every ``sync_interval`` seconds and invalidate affected entries as well.
+    """
+
+    # Seconds to keep cached entries for
+    TTL_SEC = 60
+    # A maximum number of entries in each of the caches
+    MAX_SIZE = 10000
+    # Seconds between checks for changes made by other processes
+    SYNC_INTERVAL_SEC = 0.5
+
+    def __init__(self, store, ttl=TTL_SEC, max_size=MAX_SIZE,
+                 sync_interval=SYNC_INTERVAL_SEC):
+        """ Wrap a store.
+
+        Arguments:
+            store (:obj:`AbstractStore`): a store to cache
+            ttl (:obj:`float`): seconds to keep cached entries for
+            max_size (:obj:`int`): a maximum number of entries in each of
+                the caches
+            sync_interval (:obj:`float`): seconds between checks for
+                changes recorded by the wrapped store
+        """
+        self._store = store
+        self._get_changes = getattr(store, 'get_changes', None)
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._masters = _Cache(ttl, max_size)
+        self._subscribers = _Cache(ttl, max_size)
+        self._filters = _Cache(ttl, max_size)
+        # A map of Master IDs to IDs of chats with cached subscribers
+        # including them
+        self._master_chats = dict()
+        # Incremented on every invalidation, so that entries read from
+        # the store before it are not cached
+        self._generation = 0
+        # An ID of the last change recorded by the store that was followed
+        self._change_id = None
+        self._synced_at = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """ Drop all cached entries. """
+        with self._lock:
+            self._clear()
+
+    def save_or_update_master(self, master_settings):
+        try:
+            self._store.save_or_update_master(master_settings)
+        finally:
+            self._invalidate_master(master_settings.master_id)
+
+    def get_master(self, master_id):
+        return self._read(self._masters, master_id,
+                          self._store.get_master)
+
+    def remove_master(self, master_id):
+        try:
+            self._store.remove_master(master_id)
+        finally:
+            self._invalidate_master(master_id)
+            with self._lock:
+                # Filters are not indexed by Masters
+                self._filters.clear()
+
+    def subscribe(self, master_id, chat_id):
+        try:
+            self._store.subscribe(master_id, chat_id)
+        finally:
+            self._invalidate_chat(chat_id)
+
+    def unsubscribe(self, chat_id, master_id=None):
+        try:
+            self._store.unsubscribe(chat_id, master_id)
+        finally:
+            self._invalidate_chat(chat_id)
+
+    def get_subscribers(self, chat_id):
+        return self._read(self._subscribers, chat_id,
+                          self._store.get_subscribers, self._index_chat)
+
+    def set_filters(self, master_id, chat_id, patterns):
+        try:
+            self._store.set_filters(master_id, chat_id, patterns)
+        finally:
+            self._invalidate_chat(chat_id)
+
+    def get_filters(self, chat_id):
+        return self._read(self._filters, chat_id, self._store.get_filters)
+
+    def save_or_update_masters(self, masters_settings):
+        masters_settings = list(masters_settings)
+        try:
+            self._store.save_or_update_masters(masters_settings)
+        finally:
+            for master_settings in masters_settings:
+                self._invalidate_master(master_settings.master_id)
+
+    def subscribe_many(self, subscriptions):
+        subscriptions = list(subscriptions)
+        try:
+            self._store.subscribe_many(subscriptions)
+        finally:
+            for _, chat_id in subscriptions:
+                self._invalidate_chat(chat_id)
+
+    def unsubscribe_many(self, subscriptions):
+        subscriptions = list(subscriptions)
+        try:
+            self._store.unsubscribe_many(subscriptions)
+        finally:
+            for chat_id, _ in subscriptions:
+                self._invalidate_chat(chat_id)
+
+    def get_subscribers_many(self, chat_ids):
+        self._sync()
+        subscribers = dict()
+        missing = []
+        with self._lock:
+            now = time.time()
+            for chat_id in chat_ids:
+                chat_subscribers = self._subscribers.get(chat_id, now)
+                if chat_subscribers is _Cache.MISSING:
+                    missing.append(chat_id)
+                else:
+                    subscribers[chat_id] = chat_subscribers
+            self.hits += len(subscribers)
+            self.misses += len(missing)
+            generation = self._generation
+
+        if not missing:
+            return subscribers
+
+        # Load all missing chats with a single call
+        loaded = self._store.get_subscribers_many(missing)
+        subscribers.update(loaded)
+
+        with self._lock:
+            # Do not cache values that were changed while they were loaded
+            if generation == self._generation:
+                now = time.time()
+                for chat_id, chat_subscribers in loaded.items():
+                    self._index_chat(chat_id, chat_subscribers)
+                    self._subscribers.put(chat_id, chat_subscribers, now)
+        return subscribers
+
+    def get_chats(self, master_id):
+        # Rarely needed, so not cached
+        return self._store.get_chats(master_id)
+
+    def _read(self, cache, key, load, on_load=None):
+        """ Return a cached value or load it from the store.
+
+        Arguments:
+            cache (:obj:`_Cache`): a cache to read
+            key (:obj:`object`): a key of the value
+            load (:obj:`callable`): a function that loads a value by the key
+            on_load (:obj:`callable`): (Optional) a function called with
+                the key and a loaded value before it is cached
+
+        Return:
+            :obj:`object`: the value
+        """
+        self._sync()
+        with self._lock:
+            value = cache.get(key, time.time())
+            if value is not _Cache.MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self._generation
+
+        value = load(key)
+
+        with self._lock:
+            # Do not cache a value that was changed while it was loaded
+            if generation == self._generation:
+                if on_load:
+                    on_load(key, value)
+                cache.put(key, value, time.time())
+        return value
+
+    def _index_chat(self, chat_id, subscribers):
+        """ Remember which Masters are included into cached subscribers.
+
+        Must be called with the lock held.
+        """
+        for subscriber in subscribers:
+            chats = self._master_chats.get(subscriber.master_id)
+            if chats is None:
+                chats = self._master_chats[subscriber.master_id] = set()
+            chats.add(chat_id)
+
+    def _sync(self):
+        """ Invalidate entries changed by other processes since the last
+        check, if it is time to check.
+        """
+        if self._get_changes is None:
+            return
+        with self._lock:
+            now = time.time()
+            if now - self._synced_at < self._sync_interval:
+                return
+            self._synced_at = now
+            change_id = self._change_id
+
+        change_id, master_ids, chat_ids = self._get_changes(change_id)
+
+        with self._lock:
+            if change_id == self._change_id:
+                return
+            self._change_id = change_id
+            if master_ids is None:
+                # Changes are not known, any entry may be stale
+                self._clear()
+                return
+            for master_id in master_ids:
+                self._drop_master(master_id)
+            for chat_id in chat_ids:
+                self._drop_chat(chat_id)
+
+    def _invalidate_master(self, master_id):
+        with self._lock:
+            self._drop_master(master_id)
+
+    def _invalidate_chat(self, chat_id):
+        with self._lock:
+            self._drop_chat(chat_id)
+
+    def _drop_master(self, master_id):
+        """ Must be called with the lock held. """
+        self._generation += 1
+        self._masters.invalidate(master_id)
+        # Cached subscribers include previous settings of the Master
+        for chat_id in self._master_chats.pop(master_id, ()):
+            self._subscribers.invalidate(chat_id)
+
+    def _drop_chat(self, chat_id):
+        """ Must be called with the lock held. """
+        self._generation += 1
+        self._subscribers.invalidate(chat_id)
+        self._filters.invalidate(chat_id)
+
+    def _clear(self):
+        """ Must be called with the lock held. """
+        self._generation += 1
+        self._masters.clear()
+        self._subscribers.clear()
+        self._filters.clear()
+        self._master_chats.clear()
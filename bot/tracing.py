@@ -0,0 +1,324 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from store import AbstractStore
+
+
+class _NullSpan(object):
+    """ A span of an update that is not traced. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """ A timed part of handling an update. """
+
+    __slots__ = ('_tracer', '_trace_id', '_name', '_attrs', '_queued',
+                 '_root', '_start')
+
+    def __init__(self, tracer, trace_id, name, attrs, queued=None,
+                 root=False):
+        self._tracer = tracer
+        self._trace_id = trace_id
+        self._name = name
+        self._attrs = attrs
+        self._queued = queued
+        self._root = root
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        if self._root:
+            self._tracer._local.trace = (self._trace_id, self._start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        if self._root:
+            self._tracer._local.trace = None
+        record = dict(self._attrs)
+        record.update(trace=self._trace_id, span=self._name,
+                      start=self._start,
+                      ms=round((end - self._start) * 1000, 3),
+                      thread=threading.current_thread().name)
+        if self._queued is not None:
+            # Time the span waited for since it was queued, e.g. for limits
+            record['waited_ms'] = round((self._start - self._queued) * 1000,
+                                        3)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self._tracer._write(record)
+        return False
+
+
+class Tracer(object):
+    """ Records spans of handling updates to a JSON lines file.
+
+    A trace is started by a handler of an update, and spans started on the
+    same thread while it runs belong to it. Work queued for other threads,
+    like deliveries, carries a context of the trace to record its spans in
+    it. A tracer without a path records nothing, and its spans cost next to
+    nothing.
+    """
+
+    # Seconds between flushes of recorded spans to the file
+    FLUSH_INTERVAL_SEC = 1.0
+
+    def __init__(self, path=None, sample=1.0):
+        """ Create a new Tracer.
+
+        Arguments:
+            path (:obj:`str`): (Optional) a path to a file to append spans
+                to. Nothing is recorded without it.
+            sample (:obj:`float`): a fraction of updates to trace
+        """
+        self._sample = sample
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a') if path else None
+
+    @property
+    def enabled(self):
+        """ Return whether spans are recorded. """
+        return self._file is not None
+
+    def trace(self, name, **attrs):
+        """ Start a trace of an update on the current thread, or a span of
+        the running trace.
+
+        Arguments:
+            name (:obj:`str`): a name of the span
+            attrs: attributes of the span
+
+        Return:
+            a context manager of the span
+        """
+        if self._file is None:
+            return _NULL_SPAN
+        if getattr(self._local, 'trace', None) is not None:
+            return self.span(name, **attrs)
+        if self._sample < 1 and random.random() >= self._sample:
+            return _NULL_SPAN
+        return Span(self, '{:016x}'.format(random.getrandbits(64)), name,
+                    attrs, root=True)
+
+    def span(self, name, context=None, **attrs):
+        """ Start a span of the running trace.
+
+        Arguments:
+            name (:obj:`str`): a name of the span
+            context (:obj:`tuple`): (Optional) a context of a trace started
+                on another thread, see ``context``
+            attrs: attributes of the span
+
+        Return:
+            a context manager of the span, which records nothing if there
+            is no trace
+        """
+        if self._file is None:
+            return _NULL_SPAN
+        if context is not None:
+            return Span(self, context[0], name, attrs, queued=context[1])
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return _NULL_SPAN
+        return Span(self, trace[0], name, attrs)
+
+    def context(self):
+        """ Return a context of the running trace to pass to other threads.
+
+        Return:
+            :obj:`tuple`: an ID of the trace and a time the context was
+                taken at, or ``None`` if there is no trace
+        """
+        if self._file is None:
+            return None
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return None
+        return trace[0], time.time()
+
+    def flush(self):
+        """ Write recorded spans to the file. Should be called every
+        ``FLUSH_INTERVAL_SEC``.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """ Write recorded spans and close the file. """
+        if self._file is not None:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+
+class TracedStore(AbstractStore):
+    """ A store that records a span of every call to another store. """
+
+    def __init__(self, store, tracer):
+        """ Wrap a store.
+
+        Arguments:
+            store (:obj:`bot.store.AbstractStore`): a store to wrap
+            tracer (:obj:`Tracer`): a tracer to record spans with
+        """
+        self._store = store
+        self._tracer = tracer
+
+    def save_or_update_master(self, master_settings):
+        with self._tracer.span('store.save_or_update_master'):
+            return self._store.save_or_update_master(master_settings)
+
+    def get_master(self, master_id):
+        with self._tracer.span('store.get_master'):
+            return self._store.get_master(master_id)
+
+    def remove_master(self, master_id):
+        with self._tracer.span('store.remove_master'):
+            return self._store.remove_master(master_id)
+
+    def subscribe(self, master_id, chat_id):
+        with self._tracer.span('store.subscribe'):
+            return self._store.subscribe(master_id, chat_id)
+
+    def unsubscribe(self, chat_id, master_id=None):
+        with self._tracer.span('store.unsubscribe'):
+            return self._store.unsubscribe(chat_id, master_id)
+
+    def get_subscribers(self, chat_id):
+        with self._tracer.span('store.get_subscribers'):
+            return self._store.get_subscribers(chat_id)
+
+    def set_filters(self, master_id, chat_id, patterns):
+        with self._tracer.span('store.set_filters'):
+            return self._store.set_filters(master_id, chat_id, patterns)
+
+    def get_filters(self, chat_id):
+        with self._tracer.span('store.get_filters'):
+            return self._store.get_filters(chat_id)
+
+    def save_or_update_masters(self, masters_settings):
+        with self._tracer.span('store.save_or_update_masters'):
+            return self._store.save_or_update_masters(masters_settings)
+
+    def subscribe_many(self, subscriptions):
+        with self._tracer.span('store.subscribe_many'):
+            return self._store.subscribe_many(subscriptions)
+
+    def unsubscribe_many(self, subscriptions):
+        with self._tracer.span('store.unsubscribe_many'):
+            return self._store.unsubscribe_many(subscriptions)
+
+    def get_subscribers_many(self, chat_ids):
+        with self._tracer.span('store.get_subscribers_many'):
+            return self._store.get_subscribers_many(chat_ids)
+
+    def get_chats(self, master_id):
+        with self._tracer.span('store.get_chats'):
+            return self._store.get_chats(master_id)
+
+
+class SamplingProfiler(object):
+    """ A profiler that samples stacks of all threads of the process.
+
+    Sampled stacks are counted by functions they pass through, and written
+    periodically in the collapsed format of flame graph tools, one stack per
+    line from the root to the leaf followed by a number of samples. Nothing
+    is sampled until the profiler is started.
+    """
+
+    # Seconds between samples
+    INTERVAL_SEC = 0.01
+    # Seconds between writes of the profile
+    WRITE_INTERVAL_SEC = 60
+
+    def __init__(self, path, interval=INTERVAL_SEC,
+                 write_interval=WRITE_INTERVAL_SEC):
+        """ Create a new SamplingProfiler.
+
+        Arguments:
+            path (:obj:`str`): a path to a file to write the profile to. The
+                file is replaced with all samples taken so far.
+            interval (:obj:`float`): seconds between samples
+            write_interval (:obj:`float`): seconds between writes of the
+                profile
+        """
+        self._log = logging.getLogger(SamplingProfiler.__name__)
+        self._path = path
+        self._interval = interval
+        self._write_interval = write_interval
+        # A map of collapsed stacks to numbers of samples
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start sampling in background. """
+        self._thread = threading.Thread(target=self._run, name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling and write the profile. """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def write(self):
+        """ Write all samples taken so far. """
+        lines = ['{} {}\n'.format(stack, count)
+                 for stack, count in self._stacks.most_common()]
+        # Readers never see a half-written profile
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as profile:
+            profile.writelines(lines)
+        os.rename(temp_path, self._path)
+
+    def sample(self):
+        """ Take a sample of stacks of all threads but the profiler. """
+        current = threading.current_thread().ident
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current:
+                continue
+            functions = []
+            while frame is not None:
+                code = frame.f_code
+                functions.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self._stacks[';'.join(reversed(functions))] += 1
+
+    def _run(self):
+        written = time.time()
+        while not self._stopped.wait(self._interval):
+            self.sample()
+            if time.time() - written >= self._write_interval:
+                written = time.time()
+                try:
+                    self.write()
+                except (IOError, OSError):
+                    self._log.exception("Failed to write the profile %s",
+                                        self._path)
@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from telegram import Update
+
+from benchmarks.fake_bot import FakeBot
+from bot.spybot import SpyBot
+from bot.store import CachingStore, SqliteStore
+
+FIRST_MASTER_ID = 1001
+SECOND_MASTER_ID = 1002
+GROUP_ID = -100200
+OTHER_GROUP_ID = -100300
+
+
+def _settings(subscribers):
+    """ Return IDs of Masters and their report chats, sorted. """
+    return sorted((master_settings.master_id, master_settings.report_chat_id)
+                  for master_settings in subscribers)
+
+
+class _SlowStore(SqliteStore):
+    """ An SQLite store that pauses after reading subscribers, until it is
+    let go, to make a load race an invalidation.
+    """
+
+    def __init__(self, path):
+        super(_SlowStore, self).__init__(path)
+        self.paused = False
+        self.loaded = threading.Event()
+        self.resume = threading.Event()
+
+    def get_subscribers(self, chat_id):
+        subscribers = super(_SlowStore, self).get_subscribers(chat_id)
+        self._pause()
+        return subscribers
+
+    def get_subscribers_many(self, chat_ids):
+        subscribers = super(_SlowStore, self).get_subscribers_many(chat_ids)
+        self._pause()
+        return subscribers
+
+    def _pause(self):
+        if self.paused:
+            self.loaded.set()
+            self.resume.wait()
+
+
+class CachingStoreTest(unittest.TestCase):
+    """ Subscribers read through a CachingStore follow changes. """
+
+    TTL_SEC = 0.2
+    SYNC_INTERVAL_SEC = 0.1
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'spybot.db')
+        self._backend = _SlowStore(self._path)
+        # Changes made by other means are not followed until they expire
+        self._store = CachingStore(self._backend, ttl=self.TTL_SEC,
+                                   sync_interval=60)
+        self._bot = FakeBot(latency=0, jitter=0)
+        self._spybot = SpyBot(store=self._store, bot=self._bot)
+        self._update_ids = iter(range(1, 1000))
+
+        for master_id in (FIRST_MASTER_ID, SECOND_MASTER_ID):
+            self._command(master_id, master_id, '/start')
+            self._command(GROUP_ID, master_id, '/spy')
+            self._command(OTHER_GROUP_ID, master_id, '/spy')
+
+    def tearDown(self):
+        self._backend.close()
+        shutil.rmtree(self._dir)
+
+    def test_dismiss(self):
+        self._assert_subscribers(GROUP_ID, [
+            (FIRST_MASTER_ID, FIRST_MASTER_ID),
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+        self._command(GROUP_ID, FIRST_MASTER_ID, '/dismiss')
+
+        self._assert_subscribers(GROUP_ID, [
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+        self._assert_subscribers(OTHER_GROUP_ID, [
+            (FIRST_MASTER_ID, FIRST_MASTER_ID),
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+    def test_report_here(self):
+        self._assert_subscribers(GROUP_ID, [
+            (FIRST_MASTER_ID, FIRST_MASTER_ID),
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+        self._command(OTHER_GROUP_ID, FIRST_MASTER_ID, '/report_here')
+
+        for chat_id in (GROUP_ID, OTHER_GROUP_ID):
+            self._assert_subscribers(chat_id, [
+                (FIRST_MASTER_ID, OTHER_GROUP_ID),
+                (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+    def test_remove_master(self):
+        self._assert_subscribers(GROUP_ID, [
+            (FIRST_MASTER_ID, FIRST_MASTER_ID),
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+        self._store.remove_master(SECOND_MASTER_ID)
+
+        self.assertIsNone(self._store.get_master(SECOND_MASTER_ID))
+        for chat_id in (GROUP_ID, OTHER_GROUP_ID):
+            self._assert_subscribers(chat_id, [
+                (FIRST_MASTER_ID, FIRST_MASTER_ID)])
+
+    def test_ttl(self):
+        self._assert_subscribers(GROUP_ID, [
+            (FIRST_MASTER_ID, FIRST_MASTER_ID),
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+        # A change made by other means is served stale until it expires
+        self._backend.unsubscribe(GROUP_ID, FIRST_MASTER_ID)
+        self._assert_subscribers(GROUP_ID, [
+            (FIRST_MASTER_ID, FIRST_MASTER_ID),
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+        time.sleep(self.TTL_SEC * 1.5)
+        self._assert_subscribers(GROUP_ID, [
+            (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+
+    def test_other_process(self):
+        # Another process opens the database with a connection of its own
+        # and keeps entries until it notices changes
+        other_backend = SqliteStore(self._path)
+        other = CachingStore(other_backend, ttl=60,
+                             sync_interval=self.SYNC_INTERVAL_SEC)
+        try:
+            for _ in range(2):
+                self.assertEqual(_settings(other.get_subscribers(GROUP_ID)), [
+                    (FIRST_MASTER_ID, FIRST_MASTER_ID),
+                    (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+                self.assertEqual(
+                    other.get_master(SECOND_MASTER_ID).report_chat_id,
+                    SECOND_MASTER_ID)
+
+            self._command(GROUP_ID, FIRST_MASTER_ID, '/dismiss')
+            self._command(OTHER_GROUP_ID, SECOND_MASTER_ID, '/report_here')
+            time.sleep(self.SYNC_INTERVAL_SEC * 1.5)
+
+            self.assertEqual(_settings(other.get_subscribers(GROUP_ID)), [
+                (SECOND_MASTER_ID, OTHER_GROUP_ID)])
+            self.assertEqual(
+                other.get_master(SECOND_MASTER_ID).report_chat_id,
+                OTHER_GROUP_ID)
+            self.assertEqual(
+                _settings(other.get_subscribers_many(
+                    [OTHER_GROUP_ID])[OTHER_GROUP_ID]), [
+                    (FIRST_MASTER_ID, FIRST_MASTER_ID),
+                    (SECOND_MASTER_ID, OTHER_GROUP_ID)])
+        finally:
+            other_backend.close()
+
+    def test_load_racing_invalidation(self):
+        for load in (self._store.get_subscribers,
+                     lambda chat_id: self._store.get_subscribers_many(
+                         [chat_id])[chat_id]):
+            self._store.invalidate()
+            self._backend.loaded.clear()
+            self._backend.resume.clear()
+            self._backend.paused = True
+
+            # Subscribers are read before the Master is dismissed, and
+            # returned after it
+            loader = threading.Thread(target=load, args=(GROUP_ID,))
+            loader.start()
+            self.assertTrue(self._backend.loaded.wait(5))
+            self._backend.paused = False
+            self._command(GROUP_ID, FIRST_MASTER_ID, '/dismiss')
+            self._backend.resume.set()
+            loader.join()
+
+            self._assert_subscribers(GROUP_ID, [
+                (SECOND_MASTER_ID, SECOND_MASTER_ID)])
+            self._command(GROUP_ID, FIRST_MASTER_ID, '/spy')
+
+    def _assert_subscribers(self, chat_id, expected):
+        """ Check subscribers of a chat as read one by one and in a batch.
+        They are read twice, so that cached ones are checked too.
+        """
+        expected = sorted(expected)
+        for _ in range(2):
+            self.assertEqual(
+                _settings(self._store.get_subscribers(chat_id)), expected)
+            self.assertEqual(
+                _settings(self._store.get_subscribers_many(
+                    [chat_id, chat_id])[chat_id]),
+                expected)
+
+    def _command(self, chat_id, user_id, text):
+        """ Handle a command sent by a user to a chat. """
+        update_id = next(self._update_ids)
+        chat = {'id': chat_id, 'type': 'private'} if chat_id > 0 \
+            else {'id': chat_id, 'type': 'supergroup', 'title': 'Plans'}
+        self._spybot.process_update(Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': {'id': user_id, 'is_bot': False,
+                         'first_name': 'Master'},
+                'chat': chat,
+                'date': 1540000000,
+                'text': text,
+                'entities': [{'offset': 0, 'length': len(text),
+                              'type': 'bot_command'}],
+            },
+        }, self._bot))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from bot.delivery import Delivery, DeliveryQueue, Redirected, SenderPool, \
+    SharedChatLimits
+
+GROUP_ID = -100200
+OTHER_GROUP_ID = -100300
+
+
+class SharedChatLimitsTest(unittest.TestCase):
+    """ Queues of several processes respect the limit of a chat together. """
+
+    RATE = 20
+    MESSAGES = 10
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._lock = threading.Lock()
+        self._sent = []
+        # Every queue stands for a process with a connection of its own
+        self._limits = [SharedChatLimits(os.path.join(self._dir, 'spybot.db'))
+                        for _ in range(3)]
+        self._queues = [DeliveryQueue(self._send, workers=2, global_rate=1000,
+                                      group_chat_rate=self.RATE,
+                                      shared_limits=limits)
+                        for limits in self._limits]
+        for queue in self._queues:
+            queue.start()
+
+    def tearDown(self):
+        for queue in self._queues:
+            queue.stop()
+        for limits in self._limits:
+            limits.close()
+        shutil.rmtree(self._dir)
+
+    def test_chat_limit(self):
+        for i in range(self.MESSAGES):
+            for queue in self._queues:
+                queue.put(Delivery(GROUP_ID, str(i), []))
+                queue.put(Delivery(OTHER_GROUP_ID, str(i), []))
+
+        deadline = time.time() + 10
+        expected = 2 * self.MESSAGES * len(self._queues)
+        while len(self._sent) < expected and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self._sent), expected)
+
+        for chat_id in (GROUP_ID, OTHER_GROUP_ID):
+            times = sorted(sent_at for sent_chat_id, sent_at in self._sent
+                           if sent_chat_id == chat_id)
+            # Queues on their own would send all messages in a third of it
+            self.assertGreater(times[-1] - times[0],
+                               0.9 * (len(times) - 1) / self.RATE)
+
+    def _send(self, delivery):
+        with self._lock:
+            self._sent.append((delivery.chat_id, time.time()))
+
+
+class ChatLimitsTest(unittest.TestCase):
+    """ Rate limiters of chats the bot no longer sends to are dropped. """
+
+    CHATS = 3000
+
+    def setUp(self):
+        self._sent = []
+        self._queue = DeliveryQueue(self._sent.append, workers=1,
+                                    global_rate=1e6, private_chat_rate=1000)
+        self._queue.start()
+
+    def tearDown(self):
+        self._queue.stop()
+
+    def test_idle_chats(self):
+        for chat_id in range(1, self.CHATS + 1):
+            self._queue.put(Delivery(chat_id, 'Hi', []))
+            # Limiters refill to their capacity in a millisecond
+            time.sleep(0.002 if chat_id % 100 == 0 else 0)
+
+        deadline = time.time() + 10
+        while len(self._sent) < self.CHATS and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self._sent), self.CHATS)
+        self.assertLessEqual(len(self._queue._chat_limits),
+                             2 * DeliveryQueue.MIN_CHAT_LIMITS)
+
+
+class SenderPoolTest(unittest.TestCase):
+    """ Senders send texts, and the main bot sends media from a queue of
+    its own.
+    """
+
+    PHOTO = {'type': 'photo', 'file_id': 'AgADBAAD'}
+
+    def setUp(self):
+        self._lock = threading.Lock()
+        self._sent = []
+        self._main_bot = object()
+        self._senders = [object(), object()]
+        # A chat that has not started the senders
+        self._refusing_chat_id = OTHER_GROUP_ID
+        self._pool = SenderPool(self._senders, self._send, workers=1,
+                                main_bot=self._main_bot, global_rate=1000,
+                                group_chat_rate=1000)
+        self._pool.start()
+
+    def tearDown(self):
+        self._pool.stop()
+
+    def test_media(self):
+        for i in range(10):
+            self._pool.put(Delivery(GROUP_ID, str(i), []))
+            self._pool.put(Delivery(GROUP_ID, str(i), [], media=self.PHOTO))
+        self._wait(20)
+
+        # Texts to a chat are sent by one of the senders
+        text_bots = set(bot for _, media, bot in self._sent if media is None)
+        self.assertEqual(len(text_bots), 1)
+        self.assertIn(text_bots.pop(), self._senders)
+        self.assertTrue(all(bot is self._main_bot
+                            for _, media, bot in self._sent
+                            if media is not None))
+        # Every kind arrives in order
+        for is_media in (False, True):
+            self.assertEqual([text for text, media, _ in self._sent
+                              if (media is not None) == is_media],
+                             [str(i) for i in range(10)])
+
+    def test_refused(self):
+        for i in range(10):
+            self._pool.put(Delivery(self._refusing_chat_id, str(i), []))
+        self._wait(10)
+
+        self.assertEqual([text for text, _, _ in self._sent],
+                         [str(i) for i in range(10)])
+        self.assertTrue(all(bot is self._main_bot
+                            for _, _, bot in self._sent))
+
+    def _wait(self, expected):
+        deadline = time.time() + 10
+        while len(self._sent) < expected and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self._sent), expected)
+
+    def _send(self, delivery, bot):
+        if bot is not self._main_bot and \
+                delivery.chat_id == self._refusing_chat_id:
+            self.assertTrue(self._pool.refuse(delivery))
+            raise Redirected()
+        with self._lock:
+            self._sent.append((delivery.text, delivery.media, bot))
+
+
+if __name__ == '__main__':
+    unittest.main()
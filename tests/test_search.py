@@ -0,0 +1,109 @@
+import shutil
+import tempfile
+import unittest
+
+from telegram import Update
+
+from benchmarks.fake_bot import FakeBot
+from bot.archive import MessageArchive
+from bot.spybot import SpyBot
+from bot.store import InMemoryStore
+
+FIRST_MASTER_ID = 1001
+SECOND_MASTER_ID = 1002
+SPY_ID = 2002
+GROUP_ID = -100200
+OTHER_GROUP_ID = -100300
+# Titles with letters SQLite does not lower
+GROUP_TITLE = u'\u041f\u043b\u0430\u043d\u044b'
+OTHER_GROUP_TITLE = u'\u00c9quipe'
+
+
+class SearchTest(unittest.TestCase):
+    """ Masters search archived messages of chats they spy on. """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._sent = []
+        self._bot = FakeBot(latency=0, jitter=0, on_send=self._on_send)
+        self._archive = MessageArchive(self._dir)
+        self._store = InMemoryStore()
+        self._spybot = SpyBot(store=self._store, bot=self._bot,
+                              archive=self._archive)
+        self._update_ids = iter(range(1, 1000))
+
+        self._message(FIRST_MASTER_ID, FIRST_MASTER_ID, u'/start')
+        self._message(GROUP_ID, FIRST_MASTER_ID, u'/spy')
+        self._message(SECOND_MASTER_ID, SECOND_MASTER_ID, u'/start')
+        self._message(OTHER_GROUP_ID, SECOND_MASTER_ID, u'/spy')
+        self._message(GROUP_ID, SPY_ID, u'Meet at noon')
+        self._message(OTHER_GROUP_ID, SPY_ID, u'Lunch at noon')
+        self._archive.flush()
+        del self._sent[:]
+
+    def tearDown(self):
+        for master_id in (FIRST_MASTER_ID, SECOND_MASTER_ID):
+            self._store.remove_master(master_id)
+        self._archive.stop()
+        shutil.rmtree(self._dir)
+
+    def test_subscribed_chats_only(self):
+        self.assertEqual(self._search(FIRST_MASTER_ID, u'noon'),
+                         [u'Meet at noon'])
+        self.assertEqual(self._search(SECOND_MASTER_ID, u'noon'),
+                         [u'Lunch at noon'])
+        self.assertEqual(self._search(SECOND_MASTER_ID, u'meet'), [])
+
+    def test_title(self):
+        for master_id, title, text in (
+                (FIRST_MASTER_ID, GROUP_TITLE, u'Meet at noon'),
+                (SECOND_MASTER_ID, OTHER_GROUP_TITLE, u'Lunch at noon')):
+            for name in (title, title.lower(), title.upper()):
+                self.assertEqual(self._search(master_id, u'noon ' + name),
+                                 [text])
+        self.assertEqual(self._archive.find_chats(GROUP_TITLE.upper()),
+                         [GROUP_ID])
+
+        # A title of a chat the Master does not spy on is searched for
+        self.assertEqual(
+            self._search(FIRST_MASTER_ID, u'noon ' + OTHER_GROUP_TITLE), [])
+
+    def _search(self, master_id, query):
+        """ Search as a Master and return texts of found messages. """
+        del self._sent[:]
+        self._message(master_id, master_id, u'/search ' + query)
+        self.assertEqual(len(self._sent), 1, self._sent)
+        chat_id, text = self._sent[0]
+        self.assertEqual(chat_id, master_id)
+        if text == 'I found nothing, Master.':
+            return []
+        # Every result is a header line and a text line
+        return text.split(u'\n')[1::2]
+
+    def _on_send(self, chat_id, text):
+        self._sent.append((chat_id, text))
+
+    def _message(self, chat_id, user_id, text):
+        """ Handle a message sent by a user to a chat. """
+        update_id = next(self._update_ids)
+        chat = {'id': chat_id, 'type': 'private'} if chat_id > 0 \
+            else {'id': chat_id, 'type': 'supergroup',
+                  'title': GROUP_TITLE if chat_id == GROUP_ID
+                  else OTHER_GROUP_TITLE}
+        message = {
+            'message_id': update_id,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Eve'},
+            'chat': chat,
+            'date': 1540000000,
+            'text': text,
+        }
+        if text.startswith(u'/'):
+            message['entities'] = [{'offset': 0,
+                                    'length': len(text.split()[0]),
+                                    'type': 'bot_command'}]
+        self._spybot.process_update(Update.de_json(
+            {'update_id': update_id, 'message': message}, self._bot))
+
+
+if __name__ == '__main__':
+    unittest.main()
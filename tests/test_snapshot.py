@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+from bot.snapshot import INT64, Snapshot
+from bot.store import InMemoryStore, MasterSettings
+
+FIRST_MASTER_ID = 1001
+SECOND_MASTER_ID = 1002
+THIRD_MASTER_ID = 1003
+GROUP_ID = -100200
+OTHER_GROUP_ID = -100300
+
+
+def _data():
+    """ Return all data of the in-memory store in comparable form. """
+    return (sorted((master_id, settings.report_chat_id, settings.digest)
+                   for master_id, settings in
+                   InMemoryStore._MASTERS.items()),
+            dict((chat_id, sorted(master_ids)) for chat_id, master_ids in
+                 InMemoryStore._CHATS.items()),
+            dict((master_id, sorted(chat_ids)) for master_id, chat_ids in
+                 InMemoryStore._MASTER_CHATS.items()),
+            dict(InMemoryStore._FILTERS))
+
+
+def _clear():
+    """ Drop all data, as if a new process started. """
+    InMemoryStore().load(Snapshot(0, array(INT64), dict(), dict()))
+
+
+class SnapshotTest(unittest.TestCase):
+    """ The in-memory store is restored from a snapshot and a delta log. """
+
+    def setUp(self):
+        _clear()
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'spybot.snapshot')
+
+    def tearDown(self):
+        _clear()
+        shutil.rmtree(self._dir)
+
+    def test_snapshot(self):
+        store = InMemoryStore(self._path)
+        self._fill(store)
+        expected = _data()
+        store.stop()
+
+        _clear()
+        InMemoryStore(self._path)
+        self.assertEqual(_data(), expected)
+
+    def test_delta_log(self):
+        store = InMemoryStore(self._path, delta_log=True)
+        self._fill(store)
+        store.snapshot()
+        # Changes made after the snapshot are only in the log
+        store.unsubscribe(GROUP_ID, SECOND_MASTER_ID)
+        store.save_or_update_master(
+            MasterSettings(SECOND_MASTER_ID, OTHER_GROUP_ID))
+        store.remove_master(THIRD_MASTER_ID)
+        expected = _data()
+
+        # A change torn by a crash in the middle of a write is skipped
+        with open(self._path + '.log', 'ab') as log:
+            log.write(b'{"g": 1, "op": "remove_master", "ar')
+
+        _clear()
+        InMemoryStore(self._path, delta_log=True)
+        self.assertEqual(_data(), expected)
+        self.assertEqual(
+            sorted(settings.master_id for settings in
+                   InMemoryStore().get_subscribers(GROUP_ID)),
+            [FIRST_MASTER_ID])
+
+    def test_truncated(self):
+        store = InMemoryStore(self._path)
+        self._fill(store)
+        store.stop()
+        size = os.path.getsize(self._path)
+
+        for length in (0, 20, size // 2, size - 1):
+            with open(self._path, 'rb') as snapshot:
+                data = snapshot.read(length)
+            with open(self._path + '.cut', 'wb') as snapshot:
+                snapshot.write(data)
+            self.assertRaises(ValueError, Snapshot.read, self._path + '.cut')
+
+        # A store starts empty rather than failing to start
+        os.rename(self._path + '.cut', self._path)
+        _clear()
+        InMemoryStore(self._path)
+        self.assertEqual(_data(), ([], {}, {}, {}))
+        self.assertTrue(os.path.exists(self._path + '.corrupt'))
+
+    @staticmethod
+    def _fill(store):
+        store.save_or_update_masters([
+            MasterSettings(FIRST_MASTER_ID, FIRST_MASTER_ID),
+            MasterSettings(SECOND_MASTER_ID, SECOND_MASTER_ID, digest=True),
+            MasterSettings(THIRD_MASTER_ID, GROUP_ID)])
+        store.subscribe_many([(FIRST_MASTER_ID, GROUP_ID),
+                              (SECOND_MASTER_ID, GROUP_ID),
+                              (SECOND_MASTER_ID, OTHER_GROUP_ID)])
+        store.subscribe(THIRD_MASTER_ID, OTHER_GROUP_ID)
+        store.set_filters(SECOND_MASTER_ID, OTHER_GROUP_ID,
+                          [u'noon', u'\u043f\u043b\u0430\u043d'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import random
+import sys
+import threading
+import time
+import unittest
+from array import array
+
+from bot.snapshot import INT64, Snapshot
+from bot.store import CachingStore, InMemoryStore, MasterSettings
+
+MASTERS = 50
+CHATS = 200
+WRITERS = 4
+READERS = 8
+
+
+def _clear():
+    """ Drop all data of the in-memory store. """
+    InMemoryStore().load(Snapshot(0, array(INT64), dict(), dict()))
+
+
+class StoreThreadsTest(unittest.TestCase):
+    """ The in-memory store stays consistent while Masters subscribe and
+    dismiss chats from many threads, and messages are forwarded at once.
+    """
+
+    DURATION_SEC = 1.0
+
+    def setUp(self):
+        _clear()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._errors = []
+        # Switch threads often to expose races
+        if hasattr(sys, 'setswitchinterval'):
+            self._interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-5)
+        else:
+            self._interval = sys.getcheckinterval()
+            sys.setcheckinterval(10)
+
+    def tearDown(self):
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(self._interval)
+        else:
+            sys.setcheckinterval(self._interval)
+        _clear()
+
+    def test_store(self):
+        self._run(InMemoryStore())
+
+    def test_caching_store(self):
+        self._run(CachingStore(InMemoryStore()))
+
+    def _run(self, store):
+        threads = [threading.Thread(target=self._guard,
+                                    args=(target, store, random.Random(i)))
+                   for i, target in enumerate([self._write] * WRITERS +
+                                              [self._forward] * READERS)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        time.sleep(self.DURATION_SEC)
+        self._stopped.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self._errors, [])
+        self._check(store)
+
+    def _guard(self, target, store, rand):
+        try:
+            while not self._stopped.is_set():
+                target(store, rand)
+        except Exception as error:
+            with self._lock:
+                self._errors.append('{!r} in {}'.format(error,
+                                                        target.__name__))
+
+    @staticmethod
+    def _write(store, rand):
+        master_id = rand.randint(1, MASTERS)
+        chat_id = -rand.randint(1, CHATS)
+        action = rand.random()
+        try:
+            if action < 0.4:
+                # A Master adds the bot to a group or sends /spy
+                if store.get_master(master_id) is None:
+                    store.save_or_update_master(
+                        MasterSettings(master_id, master_id))
+                store.subscribe(master_id, chat_id)
+            elif action < 0.6:
+                # A Master sends /dismiss
+                store.unsubscribe(chat_id, master_id=master_id)
+            elif action < 0.7:
+                # The bot leaves a group
+                store.unsubscribe(chat_id)
+            elif action < 0.8:
+                # The bot is blocked in a report chat
+                store.remove_master(master_id)
+            elif action < 0.9:
+                # A Master sends /report_here or /digest
+                store.save_or_update_master(MasterSettings(
+                    master_id, rand.randint(1, 1000), rand.random() < 0.5))
+            else:
+                store.subscribe_many((master_id, -rand.randint(1, CHATS))
+                                     for _ in range(5))
+        except AssertionError:
+            # Concurrent writers race for the same Masters and chats
+            pass
+
+    @staticmethod
+    def _forward(store, rand):
+        # Forwarding looks subscribers up, filters and groups them
+        chat_id = -rand.randint(1, CHATS)
+        for subscriber in store.get_subscribers(chat_id):
+            if subscriber.master_id is None or \
+                    subscriber.report_chat_id is None:
+                raise AssertionError('Broken subscriber of chat {}'
+                                     .format(chat_id))
+        store.get_filters(chat_id)
+        store.get_subscribers_many([chat_id, -rand.randint(1, CHATS)])
+
+    def _check(self, store):
+        """ Check invariants of the store once all threads have stopped. """
+        masters = InMemoryStore._MASTERS
+        chats = InMemoryStore._CHATS
+        master_chats = InMemoryStore._MASTER_CHATS
+
+        for chat_id, master_ids in chats.items():
+            self.assertTrue(master_ids, chat_id)
+            for master_id in master_ids:
+                self.assertIn(master_id, masters)
+                self.assertIn(chat_id, master_chats.get(master_id, ()))
+        for master_id, chat_ids in master_chats.items():
+            for chat_id in chat_ids:
+                self.assertIn(master_id, chats.get(chat_id, ()))
+
+        # Cached subscribers must match the data they were read from
+        for chat_id in range(-CHATS, 0):
+            expected = sorted((masters[master_id].master_id,
+                               masters[master_id].report_chat_id,
+                               masters[master_id].digest)
+                              for master_id in chats.get(chat_id, ())
+                              if master_id in masters)
+            actual = sorted((subscriber.master_id,
+                             subscriber.report_chat_id, subscriber.digest)
+                            for subscriber in store.get_subscribers(chat_id))
+            self.assertEqual(actual, expected, chat_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
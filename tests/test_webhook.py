@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from benchmarks.fake_bot import FakeBot
+from bot.spybot import SpyBot
+from bot.store import SqliteStore
+
+MASTER_ID = 1001
+SPY_ID = 2002
+GROUP_ID = -100123456789
+
+# Updates as Telegram posts them to a webhook
+START = {
+    'update_id': 500000001,
+    'message': {
+        'message_id': 1,
+        'from': {'id': MASTER_ID, 'is_bot': False, 'first_name': 'Master',
+                 'username': 'master', 'language_code': 'en'},
+        'chat': {'id': MASTER_ID, 'first_name': 'Master',
+                 'username': 'master', 'type': 'private'},
+        'date': 1540000000,
+        'text': '/start',
+        'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}],
+    },
+}
+SPY = {
+    'update_id': 500000002,
+    'message': {
+        'message_id': 41,
+        'from': {'id': MASTER_ID, 'is_bot': False, 'first_name': 'Master',
+                 'username': 'master', 'language_code': 'en'},
+        'chat': {'id': GROUP_ID, 'title': 'Plans',
+                 'type': 'supergroup'},
+        'date': 1540000010,
+        'text': '/spy',
+        'entities': [{'offset': 0, 'length': 4, 'type': 'bot_command'}],
+    },
+}
+GROUP_MESSAGE = {
+    'update_id': 500000003,
+    'message': {
+        'message_id': 42,
+        'from': {'id': SPY_ID, 'is_bot': False, 'first_name': 'Eve',
+                 'language_code': 'en'},
+        'chat': {'id': GROUP_ID, 'title': 'Plans',
+                 'type': 'supergroup'},
+        'date': 1540000020,
+        'text': 'Meet at noon',
+    },
+}
+
+
+def _free_port():
+    """ Return an ephemeral port nobody listens on. """
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class WebhookTest(unittest.TestCase):
+    """ Updates posted to the local webhook endpoint are handled. """
+
+    URL_PATH = 'hook'
+    TIMEOUT_SEC = 10
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._sent = []
+        self._cond = threading.Condition()
+        self._bot = FakeBot(latency=0, jitter=0, on_send=self._on_send)
+        self._store = SqliteStore(os.path.join(self._dir, 'spybot.db'))
+        self._spybot = SpyBot(store=self._store, bot=self._bot)
+        self._port = _free_port()
+
+        self._spybot.start()
+        self._spybot.start_webhook('https://example.com/' + self.URL_PATH,
+                                   listen='127.0.0.1', port=self._port,
+                                   url_path=self.URL_PATH)
+
+    def tearDown(self):
+        self._spybot.stop()
+        self._store.close()
+        shutil.rmtree(self._dir)
+
+    def test_updates(self):
+        self.assertEqual(self._bot.webhook_url,
+                         'https://example.com/' + self.URL_PATH)
+
+        self._post(START)
+        chat_id, text = self._wait_for(1)[0]
+        self.assertEqual(chat_id, MASTER_ID)
+        self.assertIn('Yeess, Master?', text)
+
+        self._post(SPY)
+        chat_id, text = self._wait_for(2)[1]
+        self.assertEqual(chat_id, GROUP_ID)
+        self.assertIn('I will spy on this group', text)
+
+        self._post(GROUP_MESSAGE)
+        chat_id, text = self._wait_for(3)[2]
+        self.assertEqual(chat_id, MASTER_ID)
+        self.assertEqual(text, u'[Eve](tg://user?id={}) @ _Plans_:\n'
+                               u'Meet at noon'.format(SPY_ID))
+
+    def _on_send(self, chat_id, text):
+        with self._cond:
+            self._sent.append((chat_id, text))
+            self._cond.notify_all()
+
+    def _post(self, update):
+        """ Post an update the way Telegram does, once the server is up. """
+        request = urllib2.Request(
+            'http://127.0.0.1:{}/{}'.format(self._port, self.URL_PATH),
+            json.dumps(update), {'Content-Type': 'application/json'})
+        deadline = time.time() + self.TIMEOUT_SEC
+        while True:
+            try:
+                response = urllib2.urlopen(request, timeout=self.TIMEOUT_SEC)
+                break
+            except urllib2.URLError as err:
+                if isinstance(err, urllib2.HTTPError) or \
+                        time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.assertEqual(response.getcode(), 200)
+
+    def _wait_for(self, count):
+        """ Wait for a number of messages to be sent and return them. """
+        deadline = time.time() + self.TIMEOUT_SEC
+        with self._cond:
+            while len(self._sent) < count and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            self.assertEqual(len(self._sent), count, self._sent)
+            return list(self._sent)
+
+
+if __name__ == '__main__':
+    unittest.main()